@@ -25,17 +25,18 @@ __license__ = "MIT License"
 
 import os
 import sys
-import time
 import copy
+import time
 import string
 import socket
 import random
 import getpass
+import threading
 
-from sheepdog.server import get_server
+from sheepdog.server import get_server, get_progress, wait_for_progress
 from sheepdog.storage import Storage
-from sheepdog.deployment import Deployer
-from sheepdog.job_file import job_file
+from sheepdog.deployment import get_deployer
+from sheepdog.job_file import job_file, runtime
 
 from sheepdog import serialisation
 
@@ -46,14 +47,26 @@ default_config = {
     "ssh_dir": ".sheepdog",
     "dbfile": "./sheepdog.sqlite",
     "port": None,
+    "server_processes": 1,
     "ge_opts": ["-wd $HOME/.sheepdog/", "-o $HOME/.sheepdog/",
                 "-e $HOME/.sheepdog/"],
     "shell": "/usr/bin/python",
+    "chunk_size": 1,
+    "workers": None,
+    "compression": None,
+    "out_of_band": False,
+    "memoize": False,
+    "speculate": None,
     "localhost": socket.getfqdn()
 }
 
 
 session_password = None
+_session_password_lock = threading.Lock()
+
+# How often, in seconds, get_results looks for straggling tasks when the
+# speculate option is set.
+SPECULATE_INTERVAL = 30
 
 
 def map_async(f, args, config, ns=None):
@@ -67,7 +80,6 @@ def map_async(f, args, config, ns=None):
        Optionally *ns* is a dict containing a namespace to execute the function
        in, which may itself contain additional functions.
     """
-    global session_password
     if not ns:
         ns = {}
 
@@ -75,49 +87,171 @@ def map_async(f, args, config, ns=None):
     conf.update(config)
 
     func_bin = serialisation.serialise_function(f)
-    args_bin = serialisation.serialise_args(args)
+    args_bin = serialisation.serialise_args(args, conf['out_of_band'])
     namespace_bin = serialisation.serialise_namespace(ns)
 
     storage = Storage(dbfile=conf['dbfile'])
     storage.initdb()
     request_id = storage.new_request(func_bin, namespace_bin, args_bin)
 
-    if not session_password:
-        session_password = ''.join(random.choice(string.ascii_letters)
-                                   for _ in range(30))
+    n_args = len(args)
+    job_indices = None
+    if conf['memoize']:
+        job_indices = storage.memoize(request_id)
+        if not job_indices:
+            return request_id
+        if len(job_indices) == n_args:
+            job_indices = None
+
+    _deploy_request(conf, request_id, n_args, job_indices)
+    return request_id
+
+def resubmit(request_id, config, which="missing"):
+    """Submit again just the tasks of an existing request *request_id* which
+       have not succeeded, for instance after nodes died or tasks ran out of
+       memory. The function, namespace and arguments are reused from the
+       database, and results already received are kept.
+
+       *which* is "missing" to resubmit the tasks with neither a result nor
+       an error, or "errors" to resubmit the tasks which reported an error,
+       clearing those errors.
+
+       *config* is as for :py:func:`map_async`, and should use the same
+       *dbfile*.
 
-    server = get_server(conf['port'], session_password, conf['dbfile'])
+       Returns the number of tasks resubmitted.
+    """
+    conf = copy.copy(default_config)
+    conf.update(config)
+
+    storage = Storage(dbfile=conf['dbfile'])
+    storage.initdb()
+    if which == "missing":
+        job_indices = storage.get_missing(request_id)
+    elif which == "errors":
+        job_indices = storage.get_failed(request_id)
+    else:
+        raise ValueError("which must be 'missing' or 'errors'.")
+    if not job_indices:
+        return 0
+    storage.reset_tasks(request_id, job_indices)
+
+    n_args = storage.count_tasks(request_id)
+    n_tasks = len(job_indices)
+    if n_tasks == n_args:
+        job_indices = None
+    _deploy_request(conf, request_id, n_args, job_indices)
+    return n_tasks
+
+def speculate_stragglers(request_id, config, backed_up=None):
+    """Submit backup copies of the tasks of *request_id* which have been
+       running for more than the config's ``speculate`` times the median task
+       duration, once at least a few tasks have finished. Whichever copy of a
+       task reports first is kept and later results are discarded.
+
+       *config* is as for :py:func:`map_async`. *backed_up*, if given, is a
+       set of job indices which already have backups and won't be given
+       another; it is updated with the new ones.
+
+       The originals keep their leases, and the backups are submitted as one
+       array task each even when the config has ``chunk_size`` or
+       ``workers`` set, so that persistent workers don't pick the tasks up
+       a third time. Tasks which were run in chunks have no known start time
+       and are never backed up.
+
+       Returns the number of backups submitted.
+    """
+    conf = copy.copy(default_config)
+    conf.update(config)
+    if backed_up is None:
+        backed_up = set()
+
+    storage = Storage(dbfile=conf['dbfile'])
+    stragglers = [job_index for job_index in
+                  storage.get_stragglers(request_id, conf['speculate'])
+                  if job_index not in backed_up]
+    if not stragglers:
+        return 0
+    backup_conf = dict(conf, chunk_size=1, workers=None)
+    _deploy_request(backup_conf, request_id, storage.count_tasks(request_id),
+                    stragglers)
+    backed_up.update(stragglers)
+    return len(stragglers)
+
+def _get_session_password():
+    """Return the password for this session's servers, choosing it the first
+       time. Locked, as aio.map_async may call this from several threads.
+    """
+    global session_password
+    with _session_password_lock:
+        if not session_password:
+            session_password = ''.join(random.choice(string.ascii_letters)
+                                       for _ in range(30))
+        return session_password
+
+def _deploy_request(conf, request_id, n_args, job_indices):
+    """Start the local server if required, then deploy and submit a job
+       running the tasks of *request_id* with the given *job_indices* (or all
+       *n_args* of them if None).
+    """
+    password = _get_session_password()
+    server = get_server(conf['port'], password, conf['dbfile'],
+                        conf['server_processes'])
     port = server.port
     url = "http://{0}:{1}/".format(conf['localhost'], port)
 
-    n_args = len(args)
-    jf = job_file(url, session_password, request_id, n_args,
-                  conf['shell'], conf['ge_opts'])
+    jf = job_file(url, password, request_id, n_args,
+                  conf['shell'], conf['ge_opts'], conf['chunk_size'],
+                  conf['workers'], os.path.join(conf['ssh_dir'], "cache"),
+                  conf['compression'], conf['out_of_band'], job_indices,
+                  conf['ssh_dir'])
 
-    deployer = Deployer(
+    deployer = get_deployer(
         conf['host'], conf['ssh_port'], conf['ssh_user'], conf['ssh_keyfile'])
+    runtime_name, runtime_code = runtime()
+    deployer.deploy_runtime(runtime_name, runtime_code, conf['ssh_dir'],
+                            conf['shell'])
     deployer.deploy(jf, request_id, conf['ssh_dir'])
     deployer.submit(request_id, conf['ssh_dir'])
 
-    return request_id
-
-def get_results(request_id, dbfile, block=True, verbose=False):
+def get_results(request_id, dbfile, block=True, verbose=False, start=0,
+                stop=None, args=True, results=True, stack=False,
+                config=None):
     """Fetch results for *request_id*. If *block* is true, wait until all the
     results are in. Otherwise, return just what has been received so far.
 
-    If *verbose* is true, print a status message every second with the current
-    number of results.
+    If *verbose* is true, print a status message whenever the number of
+    results changes.
+
+    Only the results for arguments from position *start* up to but not
+    including *stop* in the original list are fetched, by default all of
+    them; when blocking, only these are waited for. If *args* is false, the
+    arguments aren't fetched and None is given in their place, and likewise
+    for the results if *results* is false.
 
     Returns a list of (arg, result) tuples.
 
     Where an error occured or no result has been submitted yet, result will be
     None.
+
+    If *stack* is true, the results are instead assembled into a NumPy masked
+    array as they are deserialised, without the arguments. See
+    :py:func:`stack_results`. Requires NumPy.
+
+    If *config* is given, it is the config the request was submitted with.
+    If its ``speculate`` option is set, backup copies of straggling tasks are
+    submitted while waiting, and whichever copy reports first is kept.
     """
     storage = Storage(dbfile=dbfile)
+    progress = get_progress(dbfile)
     n_args = storage.count_tasks(request_id)
     n_results = 0
     last_count = None
+    speculate = config is not None and config.get('speculate')
+    backed_up = set()
+    next_check = time.time() + SPECULATE_INTERVAL
     while True:
+        seen = progress.value if progress else None
         n_results = storage.count_results(request_id)
         n_errors = storage.count_errors(request_id)
         if verbose and n_results + n_errors != last_count:
@@ -125,16 +259,204 @@ def get_results(request_id, dbfile, block=True, verbose=False):
                   n_results, n_args, n_errors))
             sys.stdout.flush()
         last_count = n_results + n_errors
-        if not block or n_results + n_errors == n_args:
+        if not block:
             break
-        time.sleep(1)
-
-    results = []
-    for r in storage.get_tasks_with_results(request_id):
-        r1 = r[1] if r[1] is None else serialisation.deserialise_pickle(r[1])
-        results.append((serialisation.deserialise_pickle(r[0]), r1))
+        if speculate and time.time() >= next_check:
+            next_check = time.time() + SPECULATE_INTERVAL
+            n_backups = speculate_stragglers(request_id, config, backed_up)
+            if verbose and n_backups:
+                print("Submitted backups of {} straggling tasks".format(
+                      n_backups))
+        # Tasks may have both an error and a result when backup copies were
+        # run, so count unfinished tasks rather than subtracting.
+        if storage.count_unfinished(request_id, *_job_range(start, stop)) == 0:
+            break
+        wait_for_progress(progress, seen)
+
+    if stack:
+        return stack_results(iter_results(request_id, dbfile, start, stop,
+                                          args=False),
+                             len(range(n_args)[start:stop]), start)
+    return [(arg, result) for index, arg, result in
+            iter_results(request_id, dbfile, start, stop, args, results)]
+
+def iter_results(request_id, dbfile, start=0, stop=None, args=True,
+                 results=True):
+    """Iterate over the results received so far for *request_id*, reading
+    them from the database a page at a time so that memory use stays bounded
+    for very large requests.
+
+    *start*, *stop*, *args* and *results* are as for
+    :py:func:`get_results`.
+
+    Yields (index, arg, result) tuples in the order of the original list of
+    arguments, where result is None if an error occured or no result has been
+    submitted yet.
+    """
+    storage = Storage(dbfile=dbfile)
+    for job_index, arg, result in storage.iter_tasks_with_results(
+            request_id, *_job_range(start, stop), args=args,
+            results=results):
+        if arg is not None:
+            arg = serialisation.deserialise_pickle(arg)
+        if result is not None:
+            result = serialisation.deserialise_pickle(result)
+        yield job_index - 1, arg, result
+
+def stack_results(results, n, start=0):
+    """Assemble *results*, an iterable of (index, arg, result) tuples such as
+    from :py:func:`iter_results`, into a NumPy masked array of length *n*
+    whose first item is the result at index *start*.
+
+    Each result is copied into one preallocated array as it arrives, so the
+    results are never all held as separate objects. The shape of each item is
+    taken from the first result: a scalar or array gives an array of those
+    stacked together, while a tuple gives a structured array with fields
+    "f0", "f1" etc. Indices without a result are masked.
+
+    If a later result needs a wider type, such as a float after ints or a
+    longer string, the array is converted to a type that holds both. Raises
+    ValueError if a result's shape or fields don't match the first result,
+    or if no common type exists.
+    """
+    import numpy as np
+    stacked = None
+    for index, arg, result in results:
+        if result is None:
+            continue
+        dtype, shape = _result_type(result)
+        if stacked is None:
+            stacked = np.ma.masked_all((n,) + shape, dtype)
+        elif shape != stacked.shape[1:]:
+            raise ValueError("Result at index {0} has shape {1}, expected {2}"
+                             .format(index, shape, stacked.shape[1:]))
+        elif not np.can_cast(dtype, stacked.dtype, 'safe'):
+            stacked = stacked.astype(
+                _promote_types(stacked.dtype, dtype, index))
+        if isinstance(result, tuple):
+            # NumPy only fills structured items from plain tuples.
+            result = tuple(result)
+        stacked[index - start] = result
+    if stacked is None:
+        stacked = np.ma.masked_all((n,))
+    return stacked
+
+def _result_type(result):
+    """Return the NumPy (dtype, shape) for stacking results like *result*."""
+    import numpy as np
+    if isinstance(result, tuple):
+        fields = [np.asarray(field) for field in result]
+        return np.dtype([("f{0}".format(i), field.dtype, field.shape)
+                         for i, field in enumerate(fields)]), ()
+    result = np.asarray(result)
+    return result.dtype, result.shape
+
+def _promote_types(old, new, index):
+    """Return a dtype holding both *old* and *new*, promoting structured
+    dtypes field by field, or raise ValueError naming the result at *index*.
+    """
+    import numpy as np
+    if old.names is None and new.names is None:
+        try:
+            return np.result_type(old, new)
+        except TypeError:
+            raise ValueError("Result at index {0} has type {1}, which can't "
+                             "be stacked with {2}".format(index, new, old))
+    if old.names is None or new.names is None or \
+            len(old.names) != len(new.names):
+        raise ValueError("Result at index {0} has fields {1}, expected {2}"
+                         .format(index, new.names, old.names))
+    fields = []
+    for name in old.names:
+        old_field, new_field = old.fields[name][0], new.fields[name][0]
+        if old_field.shape != new_field.shape:
+            raise ValueError("Result at index {0} has shape {1} in field "
+                             "{2}, expected {3}".format(
+                                 index, new_field.shape, name,
+                                 old_field.shape))
+        fields.append((name, _promote_types(old_field.base, new_field.base,
+                                            index), old_field.shape))
+    return np.dtype(fields)
+
+def _job_range(start, stop):
+    """Convert positions in the list of arguments to job indices."""
+    return start + 1, None if stop is None else stop + 1
+
+def as_completed(request_id, dbfile, verbose=False):
+    """Yield results for *request_id* as soon as each is received, until
+    all the results are in.
+
+    If *verbose* is true, print a status message whenever new results arrive.
+
+    Yields (index, arg, result) tuples, where index is the position of arg in
+    the original list of arguments. Where an error occured, result will be
+    None.
+    """
+    storage = Storage(dbfile=dbfile)
+    progress = get_progress(dbfile)
+    completion = _Completion(storage.count_tasks(request_id), verbose)
+    while not completion.finished:
+        seen = progress.value if progress else None
+        items = completion.take(
+            storage.get_new_results(request_id, completion.last_result),
+            storage.get_new_errors(request_id, completion.last_error))
+        if items is None:
+            wait_for_progress(progress, seen)
+            continue
+        for item in items:
+            yield item
+
+class _Completion:
+    """Keeps track of which results and errors for a request have been
+    yielded by :py:func:`as_completed` or :py:func:`sheepdog.aio.as_completed`.
+
+    `last_result` and `last_error` are the row IDs of the latest result and
+    error seen, to pass to `Storage.get_new_results` and
+    `Storage.get_new_errors`.
+    """
 
-    return results
+    def __init__(self, n_args, verbose=False):
+        self.n_args = n_args
+        self.verbose = verbose
+        self.last_result = self.last_error = 0
+        self.done = set()
+        self.n_errors = 0
+
+    @property
+    def finished(self):
+        return len(self.done) >= self.n_args
+
+    def take(self, new_results, new_errors):
+        """Take the rows from `Storage.get_new_results` and
+        `Storage.get_new_errors`, moving past them.
+
+        Returns a list of (index, arg, result) tuples to yield, one for each
+        task not yielded before, where result is None for errors; or None if
+        there were no new rows at all. If verbose, also prints the totals so
+        far whenever there are new rows.
+        """
+        if not (new_results or new_errors):
+            return None
+        items = []
+        for row_id, job_index, arg, result in new_results:
+            self.last_result = row_id
+            if job_index not in self.done:
+                self.done.add(job_index)
+                items.append((job_index - 1,
+                              serialisation.deserialise_pickle(arg),
+                              serialisation.deserialise_pickle(result)))
+        for row_id, job_index, arg, error in new_errors:
+            self.last_error = row_id
+            if job_index not in self.done:
+                self.done.add(job_index)
+                self.n_errors += 1
+                items.append((job_index - 1,
+                              serialisation.deserialise_pickle(arg), None))
+        if self.verbose:
+            print("{}/{} results, {} errors\r".format(
+                  len(self.done) - self.n_errors, self.n_args, self.n_errors))
+            sys.stdout.flush()
+        return items
 
 def get_errors(request_id, dbfile):
     """Fetch all the errors returned so-far for *request_id*."""
@@ -144,7 +466,44 @@ def get_errors(request_id, dbfile):
         errors.append((serialisation.deserialise_pickle(error[0]), error[1]))
     return errors
 
-def map(f, args, config, ns=None, verbose=True):
+def get_status(request_id, dbfile):
+    """Count the tasks of *request_id* in each state, going by the heartbeats
+    workers send while they run.
+
+    Returns a dict with the number of tasks "queued" (not started yet),
+    "running", "stalled" (whose worker stopped sending heartbeats recently),
+    "lost" (whose worker stopped sending heartbeats over 10 minutes ago) and
+    "finished" (with a result or an error).
+    """
+    return Storage(dbfile=dbfile).count_states(request_id)
+
+def imap_unordered(f, args, config, ns=None, verbose=True):
+    """Submit *f* with each of *args* on GridEngine, then yield
+       (index, arg, result) tuples as soon as each result comes in, where
+       index is the position of arg in *args*. If an error occured for an arg,
+       result is None. Call `get_errors` to get details on the errors that
+       occured.
+
+       For details on *config*, see the documentation at:
+       http://sheepdog.readthedocs.org/en/latest/configuration.html
+       Or in docs/configuration.rst.
+
+       Optionally *ns* is a dict containing a namespace to execute the function
+       in, which may itself contain additional functions.
+
+       If *verbose* is true, print out how many results are in so-far while
+       waiting.
+    """
+    request_id = map_async(f, args, config, ns)
+    if verbose:
+        print("Deployed with request ID", request_id)
+
+    conf = copy.copy(default_config)
+    conf.update(config)
+    for item in as_completed(request_id, conf['dbfile'], verbose=verbose):
+        yield item
+
+def map(f, args, config, ns=None, verbose=True, stack=False):
     """Submit *f* with each of *args* on GridEngine, wait until all the results
        are in, and return them in the same order as *args*. If an error occured
        for an arg, None is returned in that position. Call `get_errors` to get
@@ -159,6 +518,9 @@ def map(f, args, config, ns=None, verbose=True):
 
        If *verbose* is true, print out how many results are in so-far while
        waiting.
+
+       If *stack* is true, return the results in a NumPy masked array instead
+       of a list, with errors masked. See `stack_results`.
     """
     request_id = map_async(f, args, config, ns)
     if verbose:
@@ -166,11 +528,14 @@ def map(f, args, config, ns=None, verbose=True):
 
     conf = copy.copy(default_config)
     conf.update(config)
-    results = get_results(request_id, conf['dbfile'], block=True, verbose=True)
+    results = get_results(request_id, conf['dbfile'], block=True, verbose=True,
+                          args=False, stack=stack, config=conf)
     storage = Storage(dbfile=conf['dbfile'])
 
     if verbose and storage.count_errors(request_id) != 0:
         print("Some errors occured, view them with get_errors({}, '{}')"
               .format(request_id, conf['dbfile']), file=sys.stderr)
 
+    if stack:
+        return results
     return [r[1] for r in results]
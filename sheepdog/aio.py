@@ -0,0 +1,157 @@
+# Sheepdog
+# Copyright 2013, 2014 Adam Greig
+#
+# Released under the MIT license. See LICENSE file for details.
+
+"""
+asyncio versions of Sheepdog's submission and result functions, so that one
+event loop can drive many requests at once. Requires Python 3.6 or newer.
+
+Deployment and database access run in the event loop's default executor, and
+waiting for results never blocks the loop.
+"""
+
+import sys
+import copy
+import asyncio
+import functools
+
+import sheepdog
+from sheepdog.storage import Storage
+from sheepdog.server import get_progress
+
+# How often, in seconds, to check a local server's progress while waiting for
+# results. Without a local server the database is checked every second.
+PROGRESS_INTERVAL = 0.05
+
+
+def _run(f, *args, **kwargs):
+    """Run *f* in the default executor, returning an awaitable."""
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, functools.partial(f, *args, **kwargs))
+
+async def _wait_for_progress(progress, seen, timeout=1.0):
+    """Wait up to *timeout* seconds, returning early if *progress* changes
+    from *seen*.
+    """
+    if progress is None:
+        await asyncio.sleep(timeout)
+        return
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while progress.value == seen and loop.time() < deadline:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+def _count(request_id, dbfile):
+    storage = Storage(dbfile=dbfile)
+    return (storage.count_tasks(request_id),
+            storage.count_results(request_id),
+            storage.count_errors(request_id))
+
+def _count_unfinished(request_id, dbfile, start, stop):
+    storage = Storage(dbfile=dbfile)
+    return storage.count_unfinished(request_id,
+                                    *sheepdog._job_range(start, stop))
+
+def _get_new(request_id, dbfile, last_result, last_error):
+    storage = Storage(dbfile=dbfile)
+    return (storage.get_new_results(request_id, last_result),
+            storage.get_new_errors(request_id, last_error))
+
+async def map_async(f, args, config, ns=None):
+    """Coroutine version of :py:func:`sheepdog.map_async`, returning the
+    request ID once the job is submitted.
+    """
+    return await _run(sheepdog.map_async, f, args, config, ns)
+
+async def get_results(request_id, dbfile, block=True, verbose=False, start=0,
+                      stop=None, args=True, results=True, stack=False,
+                      config=None):
+    """Coroutine version of :py:func:`sheepdog.get_results`, returning a list
+    of (arg, result) tuples, or a NumPy masked array of the results if
+    *stack* is true.
+    """
+    progress = get_progress(dbfile)
+    last_count = None
+    speculate = config is not None and config.get('speculate')
+    backed_up = set()
+    loop = asyncio.get_event_loop()
+    next_check = loop.time() + sheepdog.SPECULATE_INTERVAL
+    while True:
+        seen = progress.value if progress else None
+        n_args, n_results, n_errors = await _run(_count, request_id, dbfile)
+        if verbose and n_results + n_errors != last_count:
+            print("{}/{} results, {} errors\r".format(
+                  n_results, n_args, n_errors))
+            sys.stdout.flush()
+        last_count = n_results + n_errors
+        if not block:
+            break
+        if speculate and loop.time() >= next_check:
+            next_check = loop.time() + sheepdog.SPECULATE_INTERVAL
+            n_backups = await _run(sheepdog.speculate_stragglers, request_id,
+                                   config, backed_up)
+            if verbose and n_backups:
+                print("Submitted backups of {} straggling tasks".format(
+                      n_backups))
+        unfinished = await _run(_count_unfinished, request_id, dbfile,
+                                start, stop)
+        if unfinished == 0:
+            break
+        await _wait_for_progress(progress, seen)
+    return await _run(sheepdog.get_results, request_id, dbfile, block=False,
+                      start=start, stop=stop, args=args, results=results,
+                      stack=stack)
+
+async def as_completed(request_id, dbfile, verbose=False):
+    """Asynchronous iterator version of :py:func:`sheepdog.as_completed`,
+    yielding (index, arg, result) tuples as each result arrives.
+    """
+    progress = get_progress(dbfile)
+    n_args = (await _run(_count, request_id, dbfile))[0]
+    completion = sheepdog._Completion(n_args, verbose)
+    while not completion.finished:
+        seen = progress.value if progress else None
+        items = completion.take(*await _run(
+            _get_new, request_id, dbfile, completion.last_result,
+            completion.last_error))
+        if items is None:
+            await _wait_for_progress(progress, seen)
+            continue
+        for item in items:
+            yield item
+
+async def imap_unordered(f, args, config, ns=None, verbose=True):
+    """Asynchronous iterator version of :py:func:`sheepdog.imap_unordered`.
+    """
+    request_id = await map_async(f, args, config, ns)
+    if verbose:
+        print("Deployed with request ID", request_id)
+
+    conf = copy.copy(sheepdog.default_config)
+    conf.update(config)
+    async for item in as_completed(request_id, conf['dbfile'], verbose):
+        yield item
+
+async def map(f, args, config, ns=None, verbose=True, stack=False):
+    """Coroutine version of :py:func:`sheepdog.map`, returning the results in
+    the same order as *args*.
+    """
+    request_id = await map_async(f, args, config, ns)
+    if verbose:
+        print("Deployed with request ID", request_id)
+
+    conf = copy.copy(sheepdog.default_config)
+    conf.update(config)
+    results = await get_results(request_id, conf['dbfile'], block=True,
+                                verbose=verbose, args=False, stack=stack,
+                                config=conf)
+    n_errors = (await _run(_count, request_id, conf['dbfile']))[2]
+
+    if verbose and n_errors != 0:
+        print("Some errors occured, view them with get_errors({}, '{}')"
+              .format(request_id, conf['dbfile']), file=sys.stderr)
+
+    if stack:
+        return results
+    return [r[1] for r in results]
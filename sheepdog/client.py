@@ -11,11 +11,13 @@ only used by pasting it into a job file (as workers don't generally have
 sheepdog itself installed).
 """
 
-import re
+import os
 import time
 import json
 import base64
+import hashlib
 import resource
+import threading
 import traceback
 
 try:
@@ -30,37 +32,102 @@ try:
     deserialise_function
 except NameError:
     from sheepdog.serialisation import (deserialise_function,
-                                        deserialise_arg,
                                         deserialise_namespace,
-                                        serialise_pickle)
+                                        dump_pickle, load_pickle,
+                                        to_raw, from_raw,
+                                        pack_frames, unpack_frames,
+                                        compress, decompress,
+                                        compressors, compression_threshold,
+                                        BLOB_REF)
+
+# The MIME type of requests and responses in the binary format.
+BINARY = "application/octet-stream"
+
+# Headers listing the compression methods a worker or server accepts, and
+# naming the method a request or response body is compressed with.
+ACCEPT_COMPRESSION = "X-Sheepdog-Accept-Compression"
+COMPRESSION = "X-Sheepdog-Compression"
 
 
 class Client:
-    """Find out what to do, do it, report back."""
+    """Find out what to do, do it, report back.
+
+       A Client handles *job_count* consecutive tasks starting at *job_index*,
+       or the tasks listed in *job_indices* if given, fetching all their
+       arguments in one go and then running and reporting on each in turn.
+       When handling more than one task, results and errors are buffered and
+       sent in batches of up to BATCH_SIZE, or once BATCH_INTERVAL seconds
+       have passed since the last batch was sent, which the heartbeat thread
+       also checks so that a long task doesn't hold back earlier results.
+
+       Alternatively, a Client may be used as a persistent worker by calling
+       `work`, in which case it keeps claiming tasks from the server until
+       there are none left, ignoring *job_index* and *job_count*.
+
+       If *cache_dir* is given, the function and namespace are fetched by
+       their content hash and kept in that directory, so that each is only
+       downloaded once by all the workers sharing it.
+
+       Arguments and results are sent as raw pickles in the binary format from
+       `serialisation.pack_frames` once the server has shown it supports it by
+       replying in that format, and as base64 in JSON or forms otherwise.
+
+       If *compression* is given, it's the name of a compression method from
+       the serialisation module's `compressors` which the server is asked to
+       use for its responses, and which is used for sending results once the
+       server has said it supports it.
+
+       If *out_of_band* is true, results are pickled with out-of-band buffers
+       where this Python supports it (see `serialisation.dump_pickle`).
+
+       If *memlimit* is given, the worker limits its address space to that
+       many bytes before running the function.
+
+       While `go` or `work` runs, a background thread sends a heartbeat to the
+       server every HEARTBEAT_INTERVAL seconds listing the tasks this worker
+       holds, so the server can tell running tasks from stalled or lost ones,
+       and sends any batch older than BATCH_INTERVAL.
+    """
     HTTP_RETRIES = 10
+    BATCH_SIZE = 100
+    BATCH_INTERVAL = 10.0
+    HEARTBEAT_INTERVAL = 30.0
 
-    def __init__(self, url, password, request_id, job_index):
+    def __init__(self, url, password, request_id, job_index, job_count=1,
+                 cache_dir=None, compression=None, out_of_band=False,
+                 job_indices=None, memlimit=None):
         self.url = url
         self.password = password
         self.request_id = request_id
         self.job_index = job_index
+        self.job_count = len(job_indices) if job_indices else job_count
+        self.job_indices = job_indices
+        self.cache_dir = cache_dir
+        self.out_of_band = out_of_band
+        self.memlimit = memlimit
+        self.memlimit_set = False
+        self.binary = False
+        self.compression = compression if compression in compressors else None
+        self.server_compression = []
+        self.batch = None
+        self.batch_lock = threading.RLock()
+        self.report = None
+        self.running = ()
+        self.heartbeat_stop = None
 
         userpass = ("sheepdog:" + self.password).encode()
         authstr = "Basic " + base64.b64encode(userpass).decode()
         self.authhdr = {"Authorization": authstr}
+        if self.compression:
+            self.authhdr[ACCEPT_COMPRESSION] = self.compression
 
-    def set_memlimit(self, fname=__file__):
-        with open(fname) as f:
-            contents = f.read()
-            match = re.search(r"^#\$ -l mem_grab=([0-9]+)([kmgtKMGT]?)$",
-                              contents, re.MULTILINE)
-        if match:
-            units = match.group(2).upper()
-            scale = {'K': 1024, 'M': 1024*1024, 'G': 1024*1024*1024,
-                     'T': 1024*1024*1024*1024, '': 1}[units]
-            limit = int(match.group(1)) * scale
-            print("Setting RLIMIT_AS to {}".format(limit))
-            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    def set_memlimit(self):
+        """Apply *memlimit* to this process, if it was given."""
+        if self.memlimit and not self.memlimit_set:
+            print("Setting RLIMIT_AS to {}".format(self.memlimit))
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (self.memlimit, self.memlimit))
+            self.memlimit_set = True
 
     def get_details(self):
         """Retrieve the function to run and arguments to run with from the
@@ -68,8 +135,94 @@ class Client:
         """
         url = self.url + "?request_id={0}&job_index={1}"
         url = url.format(self.request_id, self.job_index)
+        if self.job_indices and self.job_count > 1:
+            url += "&job_indices=" + ",".join(str(idx)
+                                              for idx in self.job_indices)
+        elif self.job_count > 1:
+            url += "&job_count={0}".format(self.job_count)
+        if self.cache_dir:
+            url += "&blobs=1"
         print("Fetching URL: {}".format(url))
-        req = Request(url, headers=self.authhdr)
+        data, binary = self._get(url, {"Accept": BINARY})
+        if binary:
+            self.binary = True
+            result, payloads = unpack_frames(data)
+            self.tasks = [(idx, self._load_args(args, True))
+                          for idx, args in zip(result['tasks'], payloads)]
+        else:
+            result = json.loads(data.decode())
+            if 'tasks' in result:
+                tasks = result['tasks']
+            else:
+                tasks = [(self.job_index, result['args'])]
+            self.tasks = [(int(idx), self._load_args(args.encode(), False))
+                          for idx, args in tasks]
+        if 'func_hash' in result:
+            result['func'] = self._get_blob(result['func_hash'])
+            result['ns'] = self._get_blob(result['ns_hash'])
+        self.args = load_pickle(self.tasks[0][1])
+        self.ns = deserialise_namespace(result['ns'])
+        self.func = deserialise_function(result['func'], self.ns)
+
+    def _load_args(self, args, binary):
+        """Turn arguments as sent by the server into a raw pickle. They are
+           either a raw pickle already (if *binary*), serialised, or a
+           reference to fetch them from the server's /blob endpoint by.
+        """
+        if args.startswith(BLOB_REF):
+            content_hash = args[len(BLOB_REF):].decode()
+            return to_raw(self._get_blob(content_hash, cache=False))
+        return args if binary else to_raw(args)
+
+    def _get_blob(self, content_hash, cache=True):
+        """Retrieve a function, namespace or arguments by its content hash,
+           from cache_dir if it's been downloaded before, or else from the
+           server, saving it to cache_dir for next time if *cache* is true.
+        """
+        path = None
+        if cache and self.cache_dir:
+            path = os.path.join(self.cache_dir, content_hash)
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except (IOError, OSError):
+                pass
+
+        blob = self._get(self.url + "blob/" + content_hash)[0]
+        if hashlib.sha256(blob).hexdigest() != content_hash:
+            raise RuntimeError("Downloaded blob does not match its hash.")
+        if path is None:
+            return blob
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            pass
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.rename(tmp_path, path)
+        return blob
+
+    def _get(self, url, headers=None):
+        """GET *url*, returning the response body and whether it's binary."""
+        req = Request(url, headers=dict(self.authhdr, **(headers or {})))
+        return self._open(req, "Could not connect to server.")
+
+    def _post(self, url, data, headers):
+        """POST *data* to *url*, returning the response body and whether it's
+           binary.
+        """
+        compressible = headers.get("Content-Type") in (BINARY,
+                                                       "application/json")
+        if (compressible and self.compression in self.server_compression and
+                len(data) > compression_threshold):
+            data = compress(data, self.compression)
+            headers = dict(headers)
+            headers[COMPRESSION] = self.compression
+        req = Request(url, data=data, headers=headers)
+        return self._open(req, "Could not submit to server.")
+
+    def _open(self, req, error):
         tries = 0
         while tries < self.HTTP_RETRIES:
             try:
@@ -80,12 +233,57 @@ class Client:
                 time.sleep(1)
                 continue
         if tries == self.HTTP_RETRIES:
-            raise RuntimeError("Could not connect to server.")
+            raise RuntimeError(error)
+        info = response.info()
+        binary = info.get("Content-Type") == BINARY
+        data = response.read()
+        if info.get(COMPRESSION):
+            data = decompress(data, info.get(COMPRESSION))
+        if info.get(ACCEPT_COMPRESSION):
+            self.server_compression = info.get(ACCEPT_COMPRESSION).split(",")
+        return data, binary
 
-        result = json.loads(response.read().decode())
-        self.args = deserialise_arg(result['args'])
-        self.ns = deserialise_namespace(result['ns'])
-        self.func = deserialise_function(result['func'], self.ns)
+    def start_heartbeat(self):
+        """Start sending heartbeats for the tasks in `running` from a
+           background thread.
+        """
+        self.heartbeat_stop = threading.Event()
+        thread = threading.Thread(target=self._heartbeat_loop,
+                                  args=(self.heartbeat_stop,))
+        thread.daemon = True
+        thread.start()
+
+    def stop_heartbeat(self):
+        """Stop the heartbeat thread, if it's running."""
+        if self.heartbeat_stop is not None:
+            self.heartbeat_stop.set()
+            self.heartbeat_stop = None
+
+    def _heartbeat_loop(self, stop):
+        last_heartbeat = time.time()
+        while not stop.wait(min(self.HEARTBEAT_INTERVAL, self.BATCH_INTERVAL)):
+            if time.time() - last_heartbeat >= self.HEARTBEAT_INTERVAL:
+                last_heartbeat = time.time()
+                self.heartbeat()
+            self.flush_old_batch()
+
+    def heartbeat(self):
+        """Tell the server that this worker still holds the tasks in
+           `running`. Failures are ignored, as there will be another
+           heartbeat along shortly.
+        """
+        running = self.running
+        if not running:
+            return
+        data = urlencode({"request_id": self.request_id,
+                          "job_indices": ",".join(str(idx)
+                                                  for idx in running)})
+        req = Request(self.url + "heartbeat", data=data.encode(),
+                      headers=self.authhdr)
+        try:
+            urlopen(req, timeout=self.HEARTBEAT_INTERVAL).read()
+        except Exception:
+            pass
 
     def run(self):
         """Run the downloaded function, storing the result."""
@@ -101,34 +299,151 @@ class Client:
     def submit_results(self):
         if not hasattr(self, 'result'):
             raise RuntimeError("Must call `run` before `submit_results`.")
-        result = serialise_pickle(self.result)
-        self._submit(self.url, dict(result=result))
+        result = dump_pickle(self.result, self.out_of_band)
+        if self.batch is not None:
+            self._queue('results', result)
+        elif self.report is not None:
+            self.report = dict(job_index=self.job_index, result=result)
+        else:
+            self._submit(self.url, dict(result=result))
 
     def _submit_error(self, error):
-        self._submit(self.url + "error", dict(error=str(error)))
+        if self.batch is not None:
+            self._queue('errors', str(error))
+        elif self.report is not None:
+            self.report = dict(job_index=self.job_index, error=str(error))
+        else:
+            self._submit(self.url + "error", dict(error=str(error)))
+
+    def _queue(self, kind, item):
+        """Add *item* to the current batch of *kind* ('results' or 'errors'),
+           sending the batch if it is big or old enough.
+        """
+        with self.batch_lock:
+            self.batch[kind].append([self.job_index, item])
+            size = len(self.batch['results']) + len(self.batch['errors'])
+            age = time.time() - self.batch_time
+            if size >= self.BATCH_SIZE or age >= self.BATCH_INTERVAL:
+                self.flush()
+
+    def flush_old_batch(self):
+        """Send the buffered results and errors if the last batch was sent
+           over BATCH_INTERVAL seconds ago. Called from the heartbeat thread,
+           so failures are ignored and the batch is kept for the next try.
+        """
+        with self.batch_lock:
+            if (self.batch is None or
+                    time.time() - self.batch_time < self.BATCH_INTERVAL):
+                return
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def flush(self):
+        """Send any buffered results and errors to the server."""
+        with self.batch_lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.batch or not (self.batch['results'] or
+                                  self.batch['errors']):
+            return
+        results = self.batch['results']
+        data = {"request_id": self.request_id, "errors": self.batch['errors']}
+        headers = dict(self.authhdr)
+        if self.binary:
+            data['results'] = [idx for idx, result in results]
+            data = pack_frames(data, [result for idx, result in results])
+            headers["Content-Type"] = BINARY
+        else:
+            data['results'] = [[idx, from_raw(result).decode()]
+                               for idx, result in results]
+            data = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
+        self._post(self.url + "batch", data, headers)
+        self.batch = {'results': [], 'errors': []}
+        self.batch_time = time.time()
 
     def _submit(self, url, data):
         data.update(
             {"request_id": self.request_id, "job_index": self.job_index})
-        encoded_data = urlencode(data).encode()
-        req = Request(url, data=encoded_data, headers=self.authhdr)
-        tries = 0
-        while tries < self.HTTP_RETRIES:
-            try:
-                urlopen(req)
-                break
-            except URLError:
-                tries += 1
-                time.sleep(1)
-                continue
-        if tries == self.HTTP_RETRIES:
-            raise RuntimeError("Could not submit to server.")
+        return self._post(url, *self._encode(data))
+
+    def _encode(self, data):
+        """Encode the POST parameters *data*, where any "result" is a raw
+           pickle, in the binary format if the server supports it or as a form
+           otherwise. Returns the encoded data and the headers to send it with.
+        """
+        data = dict(data)
+        headers = dict(self.authhdr, Accept=BINARY)
+        result = data.pop('result', None)
+        if self.binary:
+            headers["Content-Type"] = BINARY
+            payloads = [] if result is None else [result]
+            return pack_frames(data, payloads), headers
+        if result is not None:
+            data['result'] = from_raw(result)
+        return urlencode(data).encode(), headers
 
     def go(self):
-        """Call get_details(), run(), submit_results().
+        """Call get_details(), then run() and submit_results() for each task.
            Just for convenience.
         """
         self.get_details()
-        self.run()
-        if hasattr(self, 'result'):
-            self.submit_results()
+        if len(self.tasks) > 1:
+            self.batch = {'results': [], 'errors': []}
+            self.batch_time = time.time()
+        self.running = tuple(idx for idx, args in self.tasks)
+        self.start_heartbeat()
+        try:
+            for position, (job_index, args) in enumerate(self.tasks):
+                self.job_index = job_index
+                self.args = load_pickle(args)
+                if hasattr(self, 'result'):
+                    del self.result
+                self.run()
+                self.running = tuple(idx for idx, args
+                                     in self.tasks[position + 1:])
+                if hasattr(self, 'result'):
+                    self.submit_results()
+        finally:
+            self.stop_heartbeat()
+        self.flush()
+
+    def work(self):
+        """Act as a persistent worker: claim the next task from the server,
+           run it, and report its result while claiming the following task,
+           until no unclaimed tasks remain.
+        """
+        self.report = {}
+        self.start_heartbeat()
+        try:
+            self._work()
+        finally:
+            self.stop_heartbeat()
+
+    def _work(self):
+        while True:
+            data = dict(self.report, request_id=self.request_id)
+            data, binary = self._post(self.url + "next", *self._encode(data))
+            if binary:
+                self.binary = True
+                task, payloads = unpack_frames(data)
+            else:
+                task = json.loads(data.decode())
+                payloads = [task['args'].encode()] if 'args' in task else []
+            if task['job_index'] is None:
+                break
+            self.job_index = task['job_index']
+            self.running = (self.job_index,)
+            if not hasattr(self, 'func'):
+                self.get_details()
+            self.args = load_pickle(self._load_args(payloads[0], binary))
+            if hasattr(self, 'result'):
+                del self.result
+            self.report = {}
+            self.run()
+            self.running = ()
+            if hasattr(self, 'result'):
+                self.submit_results()
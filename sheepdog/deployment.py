@@ -7,11 +7,22 @@
 Code for deploying code to servers and executing jobs on GridEngine.
 """
 
+import atexit
+import socket
 import os.path
+import threading
 import paramiko
 
+# Seconds between SSH keepalive packets on pooled connections, so that idle
+# connections are not dropped by firewalls or bastion hosts.
+KEEPALIVE = 30
+
 class Deployer:
-    """Connect to a remote SSH server, copy a file over, run qsub."""
+    """Connect to a remote SSH server, copy a file over, run qsub.
+
+       Should usually be used via get_deployer(host, port, user, keyfile) to
+       reuse connections between requests.
+    """
 
     def __init__(self, host, port, user, keyfile=None):
         """__init__ takes (host, port, user, keyfile) to specify which SSH
@@ -22,13 +33,42 @@ class Deployer:
         self.user = user
         self.keyfile = keyfile
         self.sock = None
+        self.proxycommand = None
+        self.ssh = None
+        self.lock = threading.Lock()
 
-        self.ssh = paramiko.SSHClient()
-        self.ssh.load_system_host_keys()
         self._process_config()
+        self.connect()
 
+    def connect(self):
+        """(Re)connect to the remote host, discarding any previous connection.
+        """
+        self.close()
+        if self.proxycommand:
+            self.sock = paramiko.ProxyCommand(self.proxycommand)
+
+        self.ssh = paramiko.SSHClient()
+        self.ssh.load_system_host_keys()
         self.ssh.connect(self.host, self.port, self.user,
-                         key_filename=keyfile, sock=self.sock)
+                         key_filename=self.keyfile, sock=self.sock)
+
+        transport = self.ssh.get_transport()
+        if transport is not None:
+            transport.set_keepalive(KEEPALIVE)
+        self._sftp = None
+        self._directories = set()
+        self._runtimes = set()
+
+    def is_active(self):
+        """Check whether the connection to the remote host is still up."""
+        transport = self.ssh.get_transport() if self.ssh else None
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        """Close the connection to the remote host, if open."""
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
 
     def deploy(self, jobfile, request_id, directory):
         """Copy *jobfile* (a string of the file contents) to the connected
@@ -36,24 +76,104 @@ class Deployer:
            *request_id*.
         """
         path = self._get_jobfile_path(request_id, directory)
-        sftp = self.ssh.open_sftp()
+        self._with_reconnect(self._deploy, jobfile, path, directory)
+
+    def _deploy(self, jobfile, path, directory):
+        if self._sftp is None:
+            self._sftp = self.ssh.open_sftp()
+        self._make_directory(directory)
+        with self._sftp.open(path, 'w') as f:
+            f.write(jobfile)
+
+    def _make_directory(self, directory):
+        """Create *directory* on the remote host if it doesn't exist."""
+        if directory not in self._directories:
+            try:
+                self._sftp.mkdir(directory, mode=0o750)
+            except (IOError, OSError):
+                pass
+            self._directories.add(directory)
 
+    def deploy_runtime(self, name, code, directory, shell):
+        """Copy the worker runtime *code* to the connected remote host as the
+           module *name* in *directory*, unless it's already there, and
+           compile it to bytecode using the Python at *shell*.
+
+           Raises RuntimeError if it doesn't compile, for instance because
+           *shell* isn't a suitable Python, removing the module so that it's
+           deployed again next time.
+        """
+        path = os.path.join(directory, name + ".py")
+        if path not in self._runtimes:
+            self._with_reconnect(self._deploy_runtime, code, path, directory,
+                                 shell)
+            self._runtimes.add(path)
+
+    def _deploy_runtime(self, code, path, directory, shell):
+        if self._sftp is None:
+            self._sftp = self.ssh.open_sftp()
         try:
-            sftp.mkdir(directory, mode=0o750)
+            self._sftp.stat(path)
+            return
         except (IOError, OSError):
             pass
 
-        with sftp.open(path, 'w') as f:
-            f.write(jobfile)
+        self._make_directory(directory)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with self._sftp.open(tmp_path, 'w') as f:
+            f.write(code)
+        try:
+            self._sftp.rename(tmp_path, path)
+        except (IOError, OSError):
+            # Someone else deployed it first.
+            self._sftp.remove(tmp_path)
+        si, so, se = self.ssh.exec_command(
+            "{0} -m py_compile {1}".format(shell, path))
+        if so.channel.recv_exit_status() != 0:
+            error = se.read().decode("utf-8", "replace").strip()
+            try:
+                self._sftp.remove(path)
+            except (IOError, OSError):
+                pass
+            raise RuntimeError("Could not compile the worker runtime with "
+                               "{0}: {1}".format(shell, error))
 
     def submit(self, request_id, directory):
         """Submit a job to the GridEngine cluster on the connected remote host.
            Calls qsub with the job identified by request_id and directory.
         """
         path = self._get_jobfile_path(request_id, directory)
+        return self._with_reconnect(self._submit, path, retry=False)
+
+    def _submit(self, path):
         si, so, se = self.ssh.exec_command("qsub {}".format(path))
         return so.read()
 
+    def _with_reconnect(self, f, *args, **kwargs):
+        """Call *f* with *args*, reconnecting first if the connection has
+           dropped since it was last used, and trying once more if it drops
+           during the call.
+
+           With *retry* false, a connection dropping during the call raises a
+           RuntimeError instead, for commands such as qsub which may already
+           have run and must not be run twice.
+        """
+        retry = kwargs.pop('retry', True)
+        with self.lock:
+            if not self.is_active():
+                self.connect()
+            try:
+                return f(*args)
+            except (paramiko.SSHException, socket.error, EOFError):
+                if not retry:
+                    self.close()
+                    raise RuntimeError(
+                        "Connection to {0} dropped while running {1}, which "
+                        "may or may not have completed.".format(
+                            self.host, f.__name__.lstrip("_")))
+                self.connect()
+                return f(*args)
+
     def _get_jobfile_path(self, request_id, directory):
         """Put together the path at which the job file for a given *request_id*
            will be found, given *directory*.
@@ -80,4 +200,27 @@ class Deployer:
         self.port = host_config.get('port', self.port)
 
         if 'proxycommand' in host_config:
-            self.sock = paramiko.ProxyCommand(host_config['proxycommand'])
+            self.proxycommand = host_config['proxycommand']
+
+_deployers = {}
+_deployers_lock = threading.Lock()
+def get_deployer(host, port, user, keyfile=None):
+    """Either connect a new Deployer or retrieve the existing one for this
+       (host, port, user, keyfile), so the SSH connection and SFTP session are
+       reused across requests. Dropped connections are reconnected when next
+       used.
+    """
+    key = (host, port, user, keyfile)
+    with _deployers_lock:
+        if key not in _deployers:
+            _deployers[key] = Deployer(host, port, user, keyfile)
+        return _deployers[key]
+
+def _cleanup_deployers():
+    """Close all connections in _deployers"""
+    global _deployers
+    for deployer in _deployers.values():
+        deployer.close()
+    _deployers = {}
+
+atexit.register(_cleanup_deployers)
@@ -0,0 +1,361 @@
+# Sheepdog
+# Copyright 2013 Adam Greig
+#
+# Released under the MIT license. See LICENSE file for details.
+
+"""
+Native Tornado request handlers for the endpoints workers use most.
+
+These serve GET / and /blob and POST /, /error, /batch, /next and /heartbeat
+without blocking the IOLoop: all database work runs on a single dedicated
+thread, so a slow commit only delays the requests waiting on the database
+rather than every connected worker, and external blobs are read a chunk at a
+time on other threads as they are sent. Results, errors and heartbeats arriving together are
+committed in groups by a `GroupWriter`. Any other request falls back to the
+Flask app in `sheepdog.server`.
+
+Only imported by the server when Tornado is available. Needs
+`concurrent.futures`, which on Python 2 comes from the `futures` package;
+without it the server runs everything through the Flask app instead.
+"""
+
+import os
+import base64
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler, FallbackHandler
+from tornado.wsgi import WSGIContainer
+
+from sheepdog import server, serialisation
+
+# Results and errors reported within GROUP_WAIT seconds of each other are
+# committed in one transaction, up to GROUP_SIZE of them at a time.
+GROUP_SIZE = 1000
+GROUP_WAIT = 0.005
+
+# External blobs are sent to workers BLOB_CHUNK bytes at a time, read by one
+# of BLOB_THREADS threads.
+BLOB_CHUNK = 256 * 1024
+BLOB_THREADS = 4
+
+# The database thread and its connection, and the blob reading threads, keyed
+# by process ID. Threads do not survive a fork, so each process that uses them
+# starts its own.
+_executors = {}
+_local = threading.local()
+
+
+def _get_storage():
+    """Retrieve the database thread's connection, creating it if required."""
+    storage = getattr(_local, 'storage', None)
+    if storage is None or storage.dbfile != server.app.config['DBFILE']:
+        storage = server.make_storage()
+        _local.storage = storage
+    return storage
+
+def _get_executor(name, threads):
+    """Retrieve this process's thread pool *name*, creating it if required."""
+    key = (name, os.getpid())
+    if key not in _executors:
+        _executors[key] = ThreadPoolExecutor(max_workers=threads)
+    return _executors[key]
+
+def run_db(f, *args):
+    """Call f(storage, *args) on the database thread, returning a Future."""
+    return _get_executor("db", 1).submit(lambda: f(_get_storage(), *args))
+
+def read_blob(f):
+    """Read the next BLOB_CHUNK bytes of the file *f* on a blob reading
+       thread, returning a Future.
+    """
+    return _get_executor("blob", BLOB_THREADS).submit(f.read, BLOB_CHUNK)
+
+def find_blob(storage, content_hash):
+    """Look up the blob with *content_hash*, returning (path, None) if it's in
+       the external blob store, (None, blob) if it's in the database, or
+       (None, None) if there is no such blob.
+    """
+    path = storage.blob_path(content_hash)
+    if path is not None:
+        return path, None
+    try:
+        return None, storage.get_blob(content_hash)
+    except ValueError:
+        return None, None
+
+
+class GroupWriter:
+    """Commit results, errors and lease renewals in groups rather than one
+       at a time, so a burst of workers finishing together, or thousands of
+       workers sending heartbeats, needs only a few transactions.
+
+       Groups are committed when they reach `size` items or `wait` seconds
+       after their first one arrived, whichever is sooner.
+       While one group commits the next one builds up behind it.
+    """
+
+    def __init__(self, size=GROUP_SIZE, wait=GROUP_WAIT):
+        self.size = size
+        self.wait = wait
+        self.pending = []
+        self.leases = []
+        self.count = 0
+        self.timeout = None
+
+    def store(self, rows):
+        """Queue the (request_id, results, errors) *rows* for the next group.
+
+           Returns a Future which completes once they have been committed, or
+           fails with the error from storing them.
+        """
+        future = Future()
+        self.pending.append((rows, future))
+        self._add(len(rows[1]) + len(rows[2]))
+        return future
+
+    def renew(self, leases):
+        """Queue renewing the (request_id, job_index, expires) *leases* with
+           the next group. Heartbeats are sent regularly, so nothing waits for
+           this to be committed and a failed renewal is simply dropped.
+        """
+        self.leases += leases
+        self._add(len(leases))
+
+    def _add(self, n):
+        """Count *n* more items queued, flushing or scheduling a flush."""
+        self.count += n
+        if self.count >= self.size:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = IOLoop.current().add_timeout(
+                timedelta(seconds=self.wait), self.flush)
+
+    @gen.coroutine
+    def flush(self):
+        """Commit the pending group now."""
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+        group, self.pending, self.count = self.pending, [], 0
+        leases, self.leases = self.leases, []
+        if not group and not leases:
+            return
+        try:
+            yield run_db(server.store_rows, [rows for rows, _ in group],
+                         leases)
+        except Exception:
+            # Retry each on its own so one bad report only fails its request.
+            for rows, future in group:
+                try:
+                    yield run_db(server.store_rows, [rows])
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+        else:
+            for rows, future in group:
+                future.set_result(None)
+
+
+class WorkerHandler(RequestHandler):
+    """Common handling of authentication, request bodies, replies and
+       metrics.
+    """
+
+    # The endpoint each HTTP method is counted as in the server's Metrics.
+    endpoints = {}
+
+    def initialize(self, writer):
+        self.writer = writer
+        self.metrics = server.app.config.get('METRICS')
+        self.bytes_out = 0
+
+    def prepare(self):
+        if self.metrics is not None:
+            self.metrics.add_in_flight(1)
+        auth = self.request.headers.get("Authorization", "")
+        username = password = None
+        if auth.startswith("Basic "):
+            try:
+                userpass = base64.b64decode(auth[6:].encode()).decode()
+                username, _, password = userpass.partition(":")
+            except (ValueError, UnicodeDecodeError):
+                pass
+        if not server.check_auth(username, password):
+            self.set_status(401)
+            self.finish("Unauthorized")
+
+    def mimetype(self):
+        return self.request.headers.get("Content-Type", "").split(";")[0]
+
+    def accepts_binary(self):
+        return server.BINARY in self.request.headers.get("Accept", "")
+
+    def data(self):
+        """Retrieve the body of the request, decompressing it if required."""
+        method = self.request.headers.get(server.COMPRESSION)
+        if method:
+            return serialisation.decompress(self.request.body, method)
+        return self.request.body
+
+    def form(self):
+        """Retrieve the POST parameters sent by the worker."""
+        if self.mimetype() == server.BINARY:
+            return server.parse_form(server.BINARY, self.data(), None)
+        form = dict((k, self.get_argument(k, strip=False))
+                    for k in self.request.arguments)
+        return server.parse_form(self.mimetype(), None, form)
+
+    @gen.coroutine
+    def store_report(self, form):
+        """Store the result or error reported in *form*, if any, returning
+           once it has been committed.
+        """
+        rows = server.report_rows(form)
+        if rows is not None:
+            yield self.writer.store(rows)
+
+    def reply(self, body, binary=False):
+        """Send *body*, compressed if the worker asked for that."""
+        if not isinstance(body, bytes):
+            body = body.encode()
+        if binary:
+            self.set_header("Content-Type", server.BINARY)
+        accepted = self.request.headers.get(server.ACCEPT_COMPRESSION)
+        body, headers = server.compress_reply(accepted, body)
+        for name, value in headers.items():
+            self.set_header(name, value)
+        self.bytes_out = len(body)
+        self.finish(body)
+
+    def on_finish(self):
+        if self.metrics is not None:
+            self.metrics.add_in_flight(-1)
+            self.metrics.observe_request(
+                self.endpoints.get(self.request.method),
+                self.request.request_time(), len(self.request.body),
+                self.bytes_out)
+
+
+class RootHandler(WorkerHandler):
+    """GET / and POST /, see `server.get_config` and `server.submit_result`.
+    """
+    endpoints = {"GET": "get_config", "POST": "submit_result"}
+
+    @gen.coroutine
+    def get(self):
+        args = dict((k, self.get_argument(k, strip=False))
+                    for k in self.request.arguments)
+        body, binary = yield run_db(server.config_reply, args,
+                                    self.accepts_binary())
+        self.reply(body, binary)
+
+    @gen.coroutine
+    def post(self):
+        yield self.store_report(self.form())
+        self.reply("OK")
+
+
+class ErrorHandler(WorkerHandler):
+    """POST /error, see `server.report_error`."""
+    endpoints = {"POST": "report_error"}
+
+    @gen.coroutine
+    def post(self):
+        yield self.store_report(self.form())
+        self.reply("OK")
+
+
+class BatchHandler(WorkerHandler):
+    """POST /batch, see `server.submit_batch`."""
+    endpoints = {"POST": "submit_batch"}
+
+    @gen.coroutine
+    def post(self):
+        yield self.writer.store(server.batch_rows(self.mimetype(),
+                                                  self.data()))
+        self.reply("OK")
+
+
+class NextHandler(WorkerHandler):
+    """POST /next, see `server.next_task`."""
+    endpoints = {"POST": "next_task"}
+
+    @gen.coroutine
+    def post(self):
+        form = self.form()
+        yield self.store_report(form)
+        body, binary = yield run_db(server.claim_reply,
+                                    int(form['request_id']),
+                                    self.accepts_binary())
+        self.reply(body, binary)
+
+
+class BlobHandler(WorkerHandler):
+    """GET /blob/<content_hash>, see `server.get_blob`."""
+    endpoints = {"GET": "get_blob"}
+
+    @gen.coroutine
+    def get(self, content_hash):
+        etag = '"{0}"'.format(content_hash)
+        self.set_header("Etag", etag)
+        if_none_match = self.request.headers.get("If-None-Match", "")
+        if etag in [t.strip() for t in if_none_match.split(",")]:
+            self.set_status(304)
+            self.finish()
+            return
+        path, blob = yield run_db(find_blob, content_hash)
+        if path is not None:
+            yield self.stream(path)
+        elif blob is not None:
+            self.reply(blob, binary=True)
+        else:
+            self.set_status(404)
+            self.reply("Not Found")
+
+    @gen.coroutine
+    def stream(self, path):
+        """Send the file at *path*, reading it a chunk at a time."""
+        self.set_header("Content-Type", server.BINARY)
+        self.set_header("Content-Length", str(os.path.getsize(path)))
+        with open(path, 'rb') as f:
+            while True:
+                chunk = yield read_blob(f)
+                if not chunk:
+                    break
+                self.write(chunk)
+                self.bytes_out += len(chunk)
+                # Before Tornado 4, flush doesn't wait for the chunk to send.
+                flushed = self.flush()
+                if flushed is not None:
+                    yield flushed
+        self.finish()
+
+
+class HeartbeatHandler(WorkerHandler):
+    """POST /heartbeat, see `server.heartbeat`."""
+    endpoints = {"POST": "heartbeat"}
+
+    def post(self):
+        self.writer.renew(server.heartbeat_leases(self.form()))
+        self.reply("OK")
+
+
+def make_application():
+    """Create the Tornado application serving all of Sheepdog's endpoints."""
+    fallback = dict(fallback=WSGIContainer(server.app))
+    writer = dict(writer=GroupWriter())
+    return Application([
+        (r"/", RootHandler, writer),
+        (r"/error", ErrorHandler, writer),
+        (r"/batch", BatchHandler, writer),
+        (r"/next", NextHandler, writer),
+        (r"/heartbeat", HeartbeatHandler, writer),
+        (r"/blob/([0-9a-f]+)", BlobHandler, writer),
+        (r".*", FallbackHandler, fallback),
+    ])
@@ -10,6 +10,8 @@ The template is filled in with the job specifics and the formatted string is
 returned ready for deployment.
 """
 
+import re
+import hashlib
 import inspect
 from sheepdog import client, serialisation
 
@@ -20,6 +22,13 @@ template = """#!{shell}
 # Autogenerated by Sheepdog. Don't edit by hand.
 # See https://github.com/adamgreig/sheepdog
 
+import os
+{runtime_code}
+
+cache_dir = {cache_dir_code}
+{run_code}"""
+
+runtime_template = """\
 ###########################################################
 ## Serialisation code from Sheepdog:
 
@@ -34,14 +43,44 @@ template = """#!{shell}
 {client_code}
 
 ##
-###########################################################
+###########################################################"""
 
-import os
-job_index = os.environ['SGE_TASK_ID']
-Client("{url}", "{password}", {request_id}, job_index).go()
+runtime_module_template = """# Sheepdog Worker Runtime
+# Autogenerated by Sheepdog. Don't edit by hand.
+# See https://github.com/adamgreig/sheepdog
+
+{runtime}
+"""
+
+import_runtime_code = """import sys
+sys.path.insert(0, os.path.join(os.path.expanduser('~'), {runtime_dir!r}))
+from {runtime_name} import Client"""
+
+chunk_run_code = """job_index = int(os.environ['SGE_TASK_ID'])
+job_count = min({chunk_size}, {n_args} - job_index + 1)
+Client("{url}", "{password}", {request_id}, job_index, job_count,
+       cache_dir=cache_dir, compression={compression!r},
+       out_of_band={out_of_band!r}, memlimit={memlimit!r}).go()
+"""
+
+indices_run_code = """job_indices = {job_indices!r}
+position = int(os.environ['SGE_TASK_ID']) - 1
+chunk = job_indices[position:position + {chunk_size}]
+Client("{url}", "{password}", {request_id}, chunk[0],
+       cache_dir=cache_dir, compression={compression!r},
+       out_of_band={out_of_band!r}, memlimit={memlimit!r},
+       job_indices=chunk).go()
 """
 
-def job_file(url, password, request_id, n_args, shell, grid_engine_opts):
+worker_run_code = """job_index = int(os.environ['SGE_TASK_ID'])
+Client("{url}", "{password}", {request_id}, job_index,
+       cache_dir=cache_dir, compression={compression!r},
+       out_of_band={out_of_band!r}, memlimit={memlimit!r}).work()
+"""
+
+def job_file(url, password, request_id, n_args, shell, grid_engine_opts,
+             chunk_size=1, workers=None, cache_dir=None, compression=None,
+             out_of_band=False, job_indices=None, runtime_dir=None):
     """Format the template for a specific job, ready for deployment.
        
        *url* is the URL (including port) that the workers should contact to
@@ -61,11 +100,88 @@ def job_file(url, password, request_id, n_args, shell, grid_engine_opts):
 
        *grid_engine_opts* is a list of string arguments to Grid Engine to
        specify options such as resource requirements. 
+
+       *chunk_size* is the number of consecutive jobs each array task will
+       process, so that only n_args/chunk_size tasks are queued.
+
+       *workers*, if given, is the number of persistent workers to queue
+       instead, each of which claims tasks from the server until none are
+       left. *chunk_size* is ignored in this case.
+
+       *cache_dir*, if given, is the directory on the workers in which to cache
+       the function and namespace, relative to the user's home directory.
+
+       *compression*, if given, is the name of the compression method workers
+       should ask the server to use, from `serialisation.compressors`.
+
+       *out_of_band*, if true, makes workers pickle results with out-of-band
+       buffers, see `serialisation.dump_pickle`.
+
+       *job_indices*, if given, is a list of the job indices to run, when only
+       some of the request's *n_args* jobs need running. The array task then
+       has one task per chunk of the list rather than per job index.
+
+       *runtime_dir*, if given, is the directory on the workers (relative to
+       the user's home directory) into which the worker runtime from
+       `runtime` has been deployed. The job file then imports it from there
+       rather than including the client and serialisation code itself.
     """
     grid_engine_opts = list(grid_engine_opts)
-    grid_engine_opts.append("-t 1-{0}".format(n_args))
+    memlimit = get_memlimit(grid_engine_opts)
+    n_tasks = len(job_indices) if job_indices else n_args
+    if workers:
+        grid_engine_opts.append("-t 1-{0}".format(min(workers, n_tasks)))
+        run_code = worker_run_code.format(**locals())
+    else:
+        if chunk_size > 1:
+            grid_engine_opts.append("-t 1-{0}:{1}".format(n_tasks, chunk_size))
+        else:
+            grid_engine_opts.append("-t 1-{0}".format(n_tasks))
+        if job_indices:
+            run_code = indices_run_code.format(**locals())
+        else:
+            run_code = chunk_run_code.format(**locals())
+    if cache_dir:
+        cache_dir_code = "os.path.join(os.path.expanduser('~'), {0!r})"
+        cache_dir_code = cache_dir_code.format(cache_dir)
+    else:
+        cache_dir_code = None
     grid_engine_opts.append("-S \"{0}\"".format(shell))
     geopts = '\n'.join("#$ {0}".format(opt) for opt in grid_engine_opts)
-    client_code = inspect.getsource(client)
-    serialisation_code = inspect.getsource(serialisation)
+    runtime_name, runtime_code = runtime()
+    if runtime_dir:
+        runtime_code = import_runtime_code.format(**locals())
+    else:
+        runtime_code = _runtime
     return template.format(**locals())
+
+_runtime = None
+def runtime():
+    """Get the worker runtime: the serialisation and client code which jobs
+       need, either included in each job file or deployed once as a module.
+
+       Returns (name, code) where name is the module name to deploy the code
+       as, which changes whenever the code does.
+    """
+    global _runtime
+    if _runtime is None:
+        _runtime = runtime_template.format(
+            serialisation_code=inspect.getsource(serialisation),
+            client_code=inspect.getsource(client))
+    code = runtime_module_template.format(runtime=_runtime)
+    name = "sheepdog_runtime_" + hashlib.sha256(code.encode()).hexdigest()[:16]
+    return name, code
+
+def get_memlimit(grid_engine_opts):
+    """Find the memory limit in bytes requested by a `-l mem_grab=` option in
+       *grid_engine_opts*, for workers to apply to themselves. Returns None if
+       there is no such option.
+    """
+    for opt in grid_engine_opts:
+        match = re.search(r"^-l mem_grab=([0-9]+)([kmgtKMGT]?)$", opt)
+        if match:
+            units = match.group(2).upper()
+            scale = {'K': 1024, 'M': 1024*1024, 'G': 1024*1024*1024,
+                     'T': 1024*1024*1024*1024, '': 1}[units]
+            return int(match.group(1)) * scale
+    return None
@@ -11,11 +11,26 @@ Functions are serialised by getting their code objects and dumping them with
 marshal and encoding the bytes using base64.
 
 Arguments are pickled since that should work for any standard arguments.
+
+Serialised arguments and results may also be turned back into their raw
+pickled bytes with `to_raw` for sending over HTTP in the binary format made by
+`pack_frames`, which avoids the overhead of base64 and URL encoding.
+
+Data sent over HTTP may also be compressed with any of the standard library
+compressors available in `compressors`.
+
+With pickle protocol 5 (Python 3.8 and newer), arguments and results may be
+pickled with their large buffers (such as NumPy array data) kept out of band:
+the buffers are packed after the pickle stream as separate frames instead of
+being copied into it, and are used in place when unpickling.
 """
 
+import json
+import zlib
 import types
 import base64
 import pickle
+import struct
 import marshal
 
 # The protocols used for encoding may be changed by changing these variables.
@@ -27,6 +42,30 @@ else:
     pickle_protocol = pickle.HIGHEST_PROTOCOL
 marshal_version = marshal.version
 
+# Compression methods available on this Python, and the size in bytes below
+# which data is not worth compressing.
+compressors = {"zlib": zlib}
+try:
+    import bz2
+    compressors["bz2"] = bz2
+except ImportError:
+    pass
+try:
+    import lzma
+    compressors["lzma"] = lzma
+except ImportError:
+    pass
+compression_threshold = 1024
+
+# Prefix of raw pickles made with out-of-band buffers, which are followed by
+# frames packed by `pack_frames` holding the pickle stream and each buffer.
+OUT_OF_BAND = b"\x00sheepdog-oob\x00"
+
+# Prefix of the references sent in place of arguments kept in the server's
+# external blob store, followed by their content hash. Workers fetch the data
+# itself from the /blob endpoint.
+BLOB_REF = b"@blob:"
+
 
 def serialise_function(f):
     """Turn a Python function (unbound, no closures, etc) into a base64 byte
@@ -51,24 +90,60 @@ def deserialise_function(f, namespace=None):
     fcode = marshal.loads(fcodebin)
     return types.FunctionType(fcode, namespace)
 
-def serialise_pickle(args):
+def dump_pickle(args, out_of_band=False):
+    """Pickle *args*, returning the raw bytestring.
+
+       If *out_of_band* is true and pickle protocol 5 is available, buffers
+       which support it are packed after the pickle stream rather than copied
+       into it, prefixed by OUT_OF_BAND.
+    """
+    if out_of_band and hasattr(pickle, 'PickleBuffer'):
+        buffers = []
+        data = pickle.dumps(args, 5, buffer_callback=buffers.append)
+        if buffers:
+            return OUT_OF_BAND + pack_frames(
+                {}, [data] + [b.raw() for b in buffers])
+        return data
+    return pickle.dumps(args, pickle_protocol)
+
+def load_pickle(args):
+    """Unpickle the raw bytestring *args*, returning the Python object.
+
+       Out-of-band buffers are used without copying, so for instance NumPy
+       arrays sent that way are read-only views onto *args*.
+    """
+    if args[:len(OUT_OF_BAND)] == OUT_OF_BAND:
+        frames = unpack_frames(memoryview(args)[len(OUT_OF_BAND):])[1]
+        return pickle.loads(frames[0], buffers=frames[1:])
+    return pickle.loads(args)
+
+def serialise_pickle(args, out_of_band=False):
     """Serialise *args* using pickle and base64, returning the b64 bytestring.
+       *out_of_band* is as for `dump_pickle`.
     """
-    return base64.b64encode(pickle.dumps(args, pickle_protocol))
+    return base64.b64encode(dump_pickle(args, out_of_band))
 
 def deserialise_pickle(args):
     """Deserialise *args* using base64 and pickle, returning the Python object.
     """
-    return pickle.loads(base64.b64decode(args))
+    return load_pickle(base64.b64decode(args))
+
+def to_raw(args):
+    """Turn the output of serialise_pickle into the raw pickled bytestring."""
+    return base64.b64decode(args)
+
+def from_raw(args):
+    """Turn a raw pickled bytestring into the output of serialise_pickle."""
+    return base64.b64encode(args)
 
 serialise_arg = serialise_pickle
 deserialise_arg = deserialise_pickle
 
-def serialise_args(args):
+def serialise_args(args, out_of_band=False):
     """Serialise each item in *args* using serialise_pickle, returning a list
        of serialised items.
     """
-    return [serialise_pickle(x) for x in args]
+    return [serialise_pickle(x, out_of_band) for x in args]
 
 def deserialise_args(args):
     """Deserialise each item in *args* using deserialise_pickle, returning a
@@ -99,3 +174,36 @@ def deserialise_namespace(ns):
             ns[key] = deserialise_function(ns[key], ns)
     del ns["__serialised_keys"]
     return ns
+
+def pack_frames(header, payloads):
+    """Pack a JSON-serialisable *header* and a list of bytestring *payloads*
+       into one bytestring, each part preceded by its length as an 8 byte
+       big-endian integer.
+    """
+    parts = [json.dumps(header).encode()] + list(payloads)
+    return b"".join(p for part in parts
+                    for p in (struct.pack("!Q", len(part)), part))
+
+def unpack_frames(data):
+    """Unpack a bytestring made by pack_frames, returning (header, payloads).
+       If *data* is a memoryview, the payloads are memoryviews onto it.
+    """
+    parts = []
+    offset = 0
+    while offset < len(data):
+        length = struct.unpack("!Q", data[offset:offset+8])[0]
+        offset += 8
+        parts.append(data[offset:offset+length])
+        offset += length
+    return json.loads(bytes(parts[0]).decode()), parts[1:]
+
+def compress(data, method):
+    """Compress the bytestring *data* using *method*, one of the names in
+       `compressors`.
+    """
+    return compressors[method].compress(data)
+
+def decompress(data, method):
+    """Decompress the bytestring *data*, previously compressed using *method*.
+    """
+    return compressors[method].decompress(data)
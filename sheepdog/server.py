@@ -7,28 +7,67 @@
 Sheepdog's HTTP server endpoints.
 
 The Server class sets up a server on another subprocess, ready to receive
-requests from workers. Uses Tornado if available, else falls back to the Flask
+requests from workers. Uses Tornado if available, with the native handlers in
+`sheepdog.handlers` for the busiest endpoints, else falls back to the Flask
 debug web server.
 """
 
 import json
+import time
 import atexit
 import socket
+import threading
+from bisect import bisect_left
 from functools import wraps
-from multiprocessing import Process
-from flask import Flask, Response, request, g
-from sheepdog.storage import Storage
+from multiprocessing import Process, Condition, Value, Array
+from flask import Flask, Response, request, g, send_file
+from sheepdog.storage import Storage, LRUCache
+from sheepdog import serialisation
 
 try:
-    from tornado.wsgi import WSGIContainer
     from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
+    from tornado.netutil import bind_sockets
+    from tornado.wsgi import WSGIContainer
     USE_TORNADO = True
 except ImportError:
     USE_TORNADO = False
 
 app = Flask(__name__)
 
+# The MIME type of requests and responses in the binary format.
+BINARY = "application/octet-stream"
+
+# Headers listing the compression methods a worker or server accepts, and
+# naming the method a request or response body is compressed with.
+ACCEPT_COMPRESSION = "X-Sheepdog-Accept-Compression"
+COMPRESSION = "X-Sheepdog-Compression"
+
+# How long a task stays leased to its worker after the worker last started or
+# claimed it or sent a heartbeat for it, in seconds. Workers send heartbeats
+# every Client.HEARTBEAT_INTERVAL seconds, well within this. A task claimed
+# through /next whose lease runs out is considered lost and handed out to
+# another worker.
+HEARTBEAT_LEASE = 90
+
+# How many bytes of request functions, namespaces and task IDs the server
+# keeps in memory rather than reading them from the database each time.
+CACHE_SIZE = 256 * 1024 * 1024
+
+# The endpoints counted separately on /metrics, by view function name. Any
+# other requests are counted as "other".
+METRICS_ENDPOINTS = ("get_config", "get_blob", "submit_result", "report_error",
+                     "submit_batch", "heartbeat", "next_task", "metrics",
+                     "other")
+
+# Upper bounds of the request and commit time histograms on /metrics, in
+# seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0)
+
+# How many of the most recent requests /metrics reports task counts for.
+METRICS_REQUESTS = 20
+
 def check_auth(username, password):
     return username == 'sheepdog' and password == app.config['PASSWORD'] 
 
@@ -55,15 +94,54 @@ def get_config():
        }
 
        with HTTP status 200 on success.
+
+       Workers processing a chunk of tasks may additionally specify
+       `job_count` (integer), in which case the JSON object also contains
+       "tasks", a list of [job_index, (serialised arguments list)] items for
+       the `job_count` tasks starting at `job_index`. Alternatively they may
+       specify `job_indices`, a comma separated list of the tasks to fetch.
+
+       Workers which cache functions and namespaces may specify `blobs`, in
+       which case "func" and "ns" are replaced by "func_hash" and "ns_hash",
+       the content hashes to fetch them by from the /blob endpoint. Such
+       workers are also sent arguments kept in the external blob store as
+       `serialisation.BLOB_REF` followed by the hash to fetch them by.
+
+       Workers which accept application/octet-stream are instead sent frames
+       packed by `serialisation.pack_frames`, where the header is as above
+       except that "tasks" is a list of job indices and "args" is omitted,
+       and the payloads are the raw pickled arguments for each task.
+    """
+    body, binary = config_reply(get_storage(), request.args.to_dict(),
+                                _accepts_binary())
+    return _reply(body, binary)
+
+@app.route('/blob/<content_hash>', methods=['GET'])
+@requires_auth
+def get_blob(content_hash):
+    """Endpoint for workers to fetch a serialised function, namespace or
+       argument by its content hash, as given by the / or /next endpoints.
+
+       Returns the blob with HTTP status 200 and the hash as its ETag, or HTTP
+       status 304 if the request's If-None-Match header already has that ETag.
+       Blobs in the external blob store are streamed straight from their file.
     """
+    if content_hash in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(content_hash)
+        return response
     storage = get_storage()
-    request_id = int(request.args['request_id'])
-    job_index = int(request.args['job_index'])
-    details = storage.get_details(request_id, job_index)
-    func = details[0].decode()
-    ns = details[1].decode()
-    args = details[2].decode()
-    return json.dumps({"func": func, "ns": ns, "args": args})
+    path = storage.blob_path(content_hash)
+    if path is not None:
+        response = send_file(path, mimetype=BINARY)
+    else:
+        try:
+            blob = storage.get_blob(content_hash)
+        except ValueError:
+            return Response("Not Found", 404)
+        response = Response(blob, mimetype=BINARY)
+    response.set_etag(content_hash)
+    return response
 
 @app.route('/', methods=['POST'])
 @requires_auth
@@ -72,39 +150,373 @@ def submit_result():
        execution. Should specify `request_id` (integer), `job_index` (integer)
        and `result` (serialised result) HTTP POST parameters.
 
+       Alternatively the request may be application/octet-stream frames with
+       `request_id` and `job_index` in the header and the raw pickled result as
+       the only payload.
+
        Returns the string "OK" and HTTP 200 on success.
     """
-    storage = get_storage()
-    request_id = int(request.form['request_id'])
-    job_index = int(request.form['job_index'])
-    result = request.form['result'].encode()
-    storage.store_result(request_id, job_index, result)
+    store_report(get_storage(), _get_form())
     return "OK"
 
 @app.route('/error', methods=['POST'])
 @requires_auth
 def report_error():
     """Endpoint for workers to report back errors in function execution.
-       Workers should specify `request_id` (integer), `job_index` (integer) and
-       `error` (an error string) HTTP POST parameters.
+       Workers should specify `request_id` (integer), `job_index` (integer)
+       and `error` (an error string) HTTP POST parameters, or the same in the
+       header of application/octet-stream frames.
 
        Returns the string "OK" and HTTP 200 on success.
     """
-    storage = get_storage()
-    request_id = int(request.form['request_id'])
-    job_index = int(request.form['job_index'])
-    error = str(request.form['error'])
-    storage.store_error(request_id, job_index, error)
+    store_report(get_storage(), _get_form())
     return "OK"
 
+@app.route('/batch', methods=['POST'])
+@requires_auth
+def submit_batch():
+    """Endpoint for workers to submit many results and errors at once.
+       The request body should be a JSON object:
+
+       {"request_id": (integer),
+        "results": [[job_index, (serialised result)], ...],
+        "errors": [[job_index, (error string)], ...]
+       }
+
+       or application/octet-stream frames with the same header except that
+       "results" is a list of job indices, with the raw pickled result for
+       each as the payloads.
+
+       All results and errors are stored in a single transaction.
+
+       Returns the string "OK" and HTTP 200 on success.
+    """
+    store_batch(get_storage(), request.mimetype, _get_data())
+    return "OK"
+
+@app.route('/heartbeat', methods=['POST'])
+@requires_auth
+def heartbeat():
+    """Endpoint for workers to report that they are still running tasks.
+       Workers should specify `request_id` (integer) and `job_indices` (comma
+       separated integers) HTTP POST parameters, or the same in the header of
+       application/octet-stream frames. The lease on each task is renewed
+       for HEARTBEAT_LEASE seconds.
+
+       Returns the string "OK" and HTTP 200 on success.
+    """
+    store_rows(get_storage(), [], heartbeat_leases(_get_form()))
+    return "OK"
+
+@app.route('/metrics', methods=['GET'])
+@requires_auth
+def metrics():
+    """Endpoint for monitoring the server. Returns, in the Prometheus text
+       format, the number of requests to each endpoint with histograms of
+       the time taken to handle them, the bytes received and sent, a
+       histogram of database commit times, the number of requests in flight,
+       and the number of results, errors and pending tasks for each of the
+       METRICS_REQUESTS most recent requests.
+    """
+    requests = get_storage().count_by_request(METRICS_REQUESTS)
+    text = render_metrics(app.config.get('METRICS'), requests)
+    return Response(text, content_type="text/plain; version=0.0.4")
+
+@app.route('/next', methods=['POST'])
+@requires_auth
+def next_task():
+    """Endpoint for persistent workers to claim their next task. Workers
+       should specify `request_id` (integer) and may also report on their
+       previous task with `job_index` (integer) and either `result`
+       (serialised result) or `error` (an error string) HTTP POST parameters,
+       or the same in application/octet-stream frames as for the / endpoint.
+
+       Returns a JSON object:
+
+       {"job_index": (integer),
+        "args": (serialised arguments list)
+       }
+
+       with HTTP status 200 on success, where job_index is null once there
+       are no more unclaimed tasks. Workers which accept
+       application/octet-stream are sent frames with "job_index" in the header
+       and the raw pickled arguments as the only payload.
+
+       Arguments in the external blob store are sent as references, as for
+       the / endpoint.
+    """
+    body, binary = next_reply(get_storage(), _get_form(), _accepts_binary())
+    return _reply(body, binary)
+
+def config_reply(storage, args, binary):
+    """Build the reply to a worker's GET / request with the query parameters
+       *args* (a dict), in the binary format if *binary*.
+
+       Returns (body, binary).
+    """
+    request_id = int(args['request_id'])
+    job_index = int(args['job_index'])
+    refs = 'blobs' in args
+    if 'job_indices' in args:
+        job_indices = [int(idx) for idx in args['job_indices'].split(",")]
+        details = storage.get_tasks_details(request_id, job_indices, refs)
+        tasks = details[2]
+    elif 'job_count' in args:
+        job_count = int(args['job_count'])
+        details = storage.get_chunk_details(request_id, job_index, job_count,
+                                            refs)
+        tasks = details[2]
+    else:
+        details = storage.get_details(request_id, job_index, refs)
+        tasks = [(job_index, details[2])]
+    # Tasks in a chunk run one after another, so only a lone task's start
+    # time is known; chunked tasks are left out of speculation.
+    storage.mark_started(request_id, [idx for idx, args in tasks],
+                         HEARTBEAT_LEASE, started=len(tasks) == 1)
+    config = {"func": details[0].decode(), "ns": details[1].decode()}
+
+    if refs:
+        func_hash, ns_hash = storage.get_hashes(request_id)
+        if func_hash and ns_hash:
+            del config['func'], config['ns']
+            config.update({"func_hash": func_hash, "ns_hash": ns_hash})
+
+    if binary:
+        config['tasks'] = [idx for idx, args in tasks]
+        payloads = [_to_payload(args) for idx, args in tasks]
+        return serialisation.pack_frames(config, payloads), True
+
+    config['args'] = tasks[0][1].decode()
+    if 'job_count' in args or 'job_indices' in args:
+        config['tasks'] = [[idx, args.decode()] for idx, args in tasks]
+    return json.dumps(config), False
+
+def report_rows(form):
+    """Extract the result or error reported by a worker in *form*, the
+       parameters from `parse_form`, as (request_id, results, errors) for
+       `store_rows`. Returns None if it doesn't report one.
+    """
+    if 'job_index' not in form:
+        return None
+    request_id = int(form['request_id'])
+    job_index = int(form['job_index'])
+    if 'result' in form:
+        return request_id, [(job_index, form['result'])], []
+    return request_id, [], [(job_index, str(form['error']))]
+
+def batch_rows(mimetype, data):
+    """Extract the results and errors in a worker's POST /batch body *data*,
+       which is JSON or binary frames according to *mimetype*, as
+       (request_id, results, errors) for `store_rows`.
+    """
+    if mimetype == BINARY:
+        batch, payloads = serialisation.unpack_frames(data)
+        results = [(int(idx), serialisation.from_raw(result))
+                   for idx, result in zip(batch['results'], payloads)]
+    else:
+        batch = json.loads(data.decode())
+        results = [(int(idx), result.encode())
+                   for idx, result in batch.get('results', [])]
+    request_id = int(batch['request_id'])
+    errors = [(int(idx), str(error)) for idx, error in batch.get('errors', [])]
+    return request_id, results, errors
+
+def heartbeat_leases(form):
+    """Extract the task leases to renew from a worker's POST /heartbeat
+       parameters *form*, as (request_id, job_index, expires) items for
+       `store_rows`.
+    """
+    request_id = int(form['request_id'])
+    expires = time.time() + HEARTBEAT_LEASE
+    return [(request_id, int(idx), expires)
+            for idx in str(form.get('job_indices', '')).split(",") if idx]
+
+def store_rows(storage, batches, leases=()):
+    """Store a list of (request_id, results, errors) *batches* and renew the
+       (request_id, job_index, expires) *leases* in a single transaction, and
+       report the progress.
+    """
+    storage.store_group(batches, leases)
+    _report_progress(sum(len(results) + len(errors)
+                         for request_id, results, errors in batches))
+
+def store_report(storage, form):
+    """Store the result or error reported by a worker in *form*, the
+       parameters from `parse_form`, if it reports one.
+    """
+    rows = report_rows(form)
+    if rows is not None:
+        store_rows(storage, [rows])
+
+def store_batch(storage, mimetype, data):
+    """Store the results and errors in a worker's POST /batch body *data*,
+       which is JSON or binary frames according to *mimetype*.
+    """
+    store_rows(storage, [batch_rows(mimetype, data)])
+
+def next_reply(storage, form, binary):
+    """Store any report in a worker's POST /next parameters *form*, then
+       claim its next task and build the reply, in the binary format if
+       *binary*.
+
+       Returns (body, binary).
+    """
+    store_report(storage, form)
+    return claim_reply(storage, int(form['request_id']), binary)
+
+def claim_reply(storage, request_id, binary):
+    """Claim the next task of *request_id* and build the reply to a worker's
+       POST /next, in the binary format if *binary*.
+
+       Returns (body, binary).
+    """
+    task = storage.claim_task(request_id, HEARTBEAT_LEASE, refs=True)
+    if task is None:
+        if binary:
+            return serialisation.pack_frames({"job_index": None}, []), True
+        return json.dumps({"job_index": None}), False
+    if binary:
+        return serialisation.pack_frames({"job_index": task[0]},
+                                         [_to_payload(task[1])]), True
+    return json.dumps({"job_index": task[0], "args": task[1].decode()}), False
+
+def parse_form(mimetype, data, form):
+    """Retrieve the POST parameters sent by a worker, either from the binary
+       frames in *data* if *mimetype* is BINARY or else from the dict of form
+       fields *form*. Any "result" is returned in its serialised form, ready
+       for storage.
+    """
+    if mimetype == BINARY:
+        form, payloads = serialisation.unpack_frames(data)
+        if payloads:
+            form['result'] = serialisation.from_raw(payloads[0])
+        return form
+    if 'result' in form:
+        form['result'] = form['result'].encode()
+    return form
+
+def compress_reply(accepted, data):
+    """Compress a reply *data* to a worker which accepts the comma separated
+       compression methods *accepted*, using the first of them that's
+       available here, if *data* is big enough to be worth it. Also tell the
+       worker which methods it may use for its own requests.
+
+       *data* may be None if the reply shouldn't be compressed.
+
+       Returns (data, headers).
+    """
+    if not accepted:
+        return data, {}
+    headers = {ACCEPT_COMPRESSION: ",".join(sorted(serialisation.compressors))}
+    methods = [m for m in accepted.split(",")
+               if m in serialisation.compressors]
+    if methods and data is not None and \
+            len(data) > serialisation.compression_threshold:
+        data = serialisation.compress(data, methods[0])
+        headers[COMPRESSION] = methods[0]
+    return data, headers
+
+def _accepts_binary():
+    """Check whether the worker accepts binary responses."""
+    return BINARY in request.headers.get('Accept', '')
+
+def _reply(body, binary):
+    """Make a response from the *body* and *binary* returned by one of the
+       reply functions.
+    """
+    if binary:
+        return Response(body, mimetype=BINARY)
+    return body
+
+def _to_payload(args):
+    """Convert stored arguments to a raw pickle for a binary response,
+       leaving references to the external blob store as they are.
+    """
+    if args.startswith(serialisation.BLOB_REF):
+        return args
+    return serialisation.to_raw(args)
+
+def _get_form():
+    """Retrieve the POST parameters sent by a worker with `parse_form`."""
+    if request.mimetype == BINARY:
+        return parse_form(BINARY, _get_data(), None)
+    return parse_form(request.mimetype, None, request.form.to_dict())
+
+def _get_data():
+    """Retrieve the body of the request, decompressing it if required."""
+    method = request.headers.get(COMPRESSION)
+    if method:
+        return serialisation.decompress(request.get_data(), method)
+    return request.get_data()
+
+@app.before_request
+def _start_request():
+    """Count the request as in flight, and note when it started."""
+    metrics = app.config.get('METRICS')
+    if metrics is not None:
+        g._start_time = time.time()
+        metrics.add_in_flight(1)
+
+@app.teardown_request
+def _end_request(exception):
+    metrics = app.config.get('METRICS')
+    if metrics is not None and hasattr(g, '_start_time'):
+        metrics.add_in_flight(-1)
+
+# Registered before compress_response so it runs after it, and counts the
+# bytes actually sent.
+@app.after_request
+def _record_request(response):
+    """Record the time taken and bytes transferred by the request."""
+    metrics = app.config.get('METRICS')
+    if metrics is not None and hasattr(g, '_start_time'):
+        metrics.observe_request(request.endpoint, time.time() - g._start_time,
+                                request.content_length or 0,
+                                response.content_length or 0)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress successful responses using the first compression method the
+       worker asked for that's available here, if they're big enough to be
+       worth it. Also tell the worker which methods it may use for its own
+       requests.
+    """
+    accepted = request.headers.get(ACCEPT_COMPRESSION)
+    if response.status_code != 200 or response.direct_passthrough:
+        data, headers = compress_reply(accepted, None)
+    else:
+        data, headers = compress_reply(accepted, response.get_data())
+    if COMPRESSION in headers:
+        response.set_data(data)
+    response.headers.extend(headers)
+    return response
+
+def _report_progress(n):
+    """Tell the process waiting on this server that `n` more results or
+       errors have been stored.
+    """
+    progress = app.config.get('PROGRESS')
+    if progress is not None:
+        progress.add(n)
+
 def get_storage():
     """Retrieve the request-local database connection, creating it if required.
     """
     if not hasattr(g, '_storage'):
-        dbfile = app.config['DBFILE']
-        g._storage = Storage(dbfile)
+        g._storage = make_storage()
     return g._storage
 
+def make_storage():
+    """Create a database connection for the server, reporting its commit
+       times to the server's Metrics.
+    """
+    storage = Storage(app.config['DBFILE'], cache=app.config.get('CACHE'))
+    metrics = app.config.get('METRICS')
+    if metrics is not None:
+        storage.on_commit = metrics.observe_commit
+    return storage
+
 def _get_free_port():
     """Get a port that should be free on the system."""
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -113,12 +525,175 @@ def _get_free_port():
     s.close()
     return port
 
-def run_server(port, password, dbfile):
+class Progress:
+    """A count of results and errors stored by a server subprocess, shared
+       with the process that started it so callers can wait for new results
+       instead of polling the database.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.count = Value('L', 0, lock=False)
+
+    @property
+    def value(self):
+        """The number of results and errors stored so far."""
+        return self.count.value
+
+    def add(self, n):
+        """Record that `n` more results or errors were stored and wake any
+           waiting processes.
+        """
+        with self.condition:
+            self.count.value += n
+            self.condition.notify_all()
+
+    def wait(self, last, timeout):
+        """Block until the count differs from `last` or `timeout` seconds have
+           passed. Returns the current count.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.count.value == last:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.count.value
+
+class Metrics:
+    """Counters and histograms describing the work done by a server, kept in
+       shared memory so that all its subprocesses add to the same figures and
+       /metrics reports on the whole server whichever process answers it.
+    """
+
+    # Each histogram is a count, a sum, then the count in each bucket.
+    HISTOGRAM_SIZE = 2 + len(LATENCY_BUCKETS)
+
+    def __init__(self):
+        n_histograms = len(METRICS_ENDPOINTS) + 1
+        self.commits = len(METRICS_ENDPOINTS) * self.HISTOGRAM_SIZE
+        self.totals = n_histograms * self.HISTOGRAM_SIZE
+        # The histograms, then bytes received, bytes sent and requests in
+        # flight.
+        self.values = Array('d', self.totals + 3)
+
+    def _observe(self, offset, seconds):
+        self.values[offset] += 1
+        self.values[offset + 1] += seconds
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        if bucket < len(LATENCY_BUCKETS):
+            self.values[offset + 2 + bucket] += 1
+
+    def observe_request(self, endpoint, seconds, bytes_in, bytes_out):
+        """Record a request to *endpoint* (a view function name) which took
+           *seconds* to handle, receiving *bytes_in* and sending *bytes_out*.
+        """
+        if endpoint not in METRICS_ENDPOINTS:
+            endpoint = "other"
+        offset = METRICS_ENDPOINTS.index(endpoint) * self.HISTOGRAM_SIZE
+        with self.values.get_lock():
+            self._observe(offset, seconds)
+            self.values[self.totals] += bytes_in
+            self.values[self.totals + 1] += bytes_out
+
+    def observe_commit(self, seconds):
+        """Record a database commit which took *seconds*."""
+        with self.values.get_lock():
+            self._observe(self.commits, seconds)
+
+    def add_in_flight(self, n):
+        """Record that *n* more requests are being handled."""
+        with self.values.get_lock():
+            self.values[self.totals + 2] += n
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self.values.get_lock():
+            values = self.values[:]
+        lines = _metric_header("sheepdog_requests_total", "counter",
+                               "Requests handled, by endpoint.")
+        for i, endpoint in enumerate(METRICS_ENDPOINTS):
+            lines.append(_sample("sheepdog_requests_total",
+                                 int(values[i * self.HISTOGRAM_SIZE]),
+                                 endpoint=endpoint))
+        lines += _metric_header("sheepdog_request_duration_seconds",
+                                "histogram",
+                                "Time taken to handle requests, by endpoint.")
+        for i, endpoint in enumerate(METRICS_ENDPOINTS):
+            lines += _histogram("sheepdog_request_duration_seconds", values,
+                                i * self.HISTOGRAM_SIZE, endpoint=endpoint)
+        lines += _metric_header("sheepdog_db_commit_duration_seconds",
+                                "histogram",
+                                "Time taken by database commits.")
+        lines += _histogram("sheepdog_db_commit_duration_seconds", values,
+                            self.commits)
+        for i, (name, kind, description) in enumerate([
+                ("sheepdog_received_bytes_total", "counter",
+                 "Bytes received in request bodies."),
+                ("sheepdog_sent_bytes_total", "counter",
+                 "Bytes sent in response bodies."),
+                ("sheepdog_requests_in_flight", "gauge",
+                 "Requests currently being handled.")]):
+            lines += _metric_header(name, kind, description)
+            lines.append(_sample(name, int(values[self.totals + i])))
+        return lines
+
+def _metric_header(name, kind, description):
+    return ["# HELP {0} {1}".format(name, description),
+            "# TYPE {0} {1}".format(name, kind)]
+
+def _sample(name, value, **labels):
+    """Format one Prometheus sample line."""
+    if labels:
+        name += "{" + ",".join('{0}="{1}"'.format(k, labels[k])
+                               for k in sorted(labels)) + "}"
+    return "{0} {1}".format(name, value)
+
+def _histogram(name, values, offset, **labels):
+    """Format the samples of the histogram at *offset* in *values*."""
+    lines = []
+    cumulative = 0
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        cumulative += int(values[offset + 2 + i])
+        lines.append(_sample(name + "_bucket", cumulative, le=repr(bound),
+                             **labels))
+    count = int(values[offset])
+    lines.append(_sample(name + "_bucket", count, le="+Inf", **labels))
+    lines.append(_sample(name + "_sum", repr(values[offset + 1]), **labels))
+    lines.append(_sample(name + "_count", count, **labels))
+    return lines
+
+def render_metrics(metrics, requests):
+    """Render the text of /metrics from a Metrics (or None) and the task
+       counts *requests* from `Storage.count_by_request`.
+    """
+    lines = metrics.render() if metrics is not None else []
+    lines += _metric_header("sheepdog_tasks", "gauge",
+                            "Tasks of recent requests, by state.")
+    for request_id, results, errors, pending in requests:
+        for state, n in (("results", results), ("errors", errors),
+                         ("pending", pending)):
+            lines.append(_sample("sheepdog_tasks", n,
+                                 request_id=request_id, state=state))
+    return "\n".join(lines) + "\n"
+
+def run_server(port, password, dbfile, progress=None, sockets=None,
+               metrics=None):
     """Start up the HTTP server. If Tornado is available it will be used, else
        fall back to the Flask debug server.
+
+       If `progress` is given, it is a Progress which is updated whenever
+       results or errors are stored. If `sockets` is given, Tornado serves
+       these already listening sockets instead of binding to `port`. If
+       `metrics` is given, it is the Metrics shared with the server's other
+       processes, otherwise a new one is used.
     """
     app.config['PASSWORD'] = password
     app.config['DBFILE'] = dbfile
+    app.config['PROGRESS'] = progress
+    app.config['METRICS'] = metrics if metrics is not None else Metrics()
+    app.config['CACHE'] = LRUCache(CACHE_SIZE)
 
     if USE_TORNADO:
         # When running inside an IPython Notebook, the IOLoop
@@ -130,7 +705,14 @@ def run_server(port, password, dbfile):
             del IOLoop._instance
         IOLoop.clear_current()
 
-        HTTPServer(WSGIContainer(app)).listen(port)
+        if make_application is not None:
+            http_server = HTTPServer(make_application())
+        else:
+            http_server = HTTPServer(WSGIContainer(app))
+        if sockets:
+            http_server.add_sockets(sockets)
+        else:
+            http_server.listen(port)
         IOLoop.instance().start()
     else:
         app.run(host='0.0.0.0', port=port)
@@ -143,49 +725,99 @@ class Server:
        running globally.
     """
 
-    def __init__(self, port, password, dbfile):
+    def __init__(self, port, password, dbfile, processes=1):
         """__init__ creates and starts the HTTP server.
+
+           With Tornado, `processes` server processes are started, all
+           accepting connections on the same port. Each has its own database
+           connections, and SQLite serialises their writes.
         """
         if not port:
             port = _get_free_port()
         self.port = port
         self.password = password
         self.dbfile = dbfile
-        self.server = Process(target=run_server, args=(port, password, dbfile))
-        self.server.start()
+        self.progress = Progress()
+        self.metrics = Metrics()
+
+        # Listen before starting the subprocesses, so workers connecting while
+        # they start up wait in the backlog instead of being refused, and so
+        # that every subprocess accepts on the same socket.
+        if USE_TORNADO:
+            sockets = bind_sockets(port)
+        else:
+            sockets = None
+            processes = 1
+        self.servers = [Process(target=run_server,
+                                args=(port, password, dbfile, self.progress,
+                                      sockets, self.metrics))
+                        for _ in range(max(1, processes))]
+        for server in self.servers:
+            server.start()
+        for sock in sockets or []:
+            sock.close()
 
     def stop(self):
-        """Terminate the HTTP server."""
-        self.server.terminate()
-        self.server.join()
+        """Terminate the HTTP server processes."""
+        for server in self.servers:
+            server.terminate()
+        for server in self.servers:
+            server.join()
 
     def __del__(self):
         self.stop()
 
 _servers = {}
-def get_server(port, password, dbfile):
+_servers_lock = threading.Lock()
+def get_server(port, password, dbfile, processes=1):
     """Either start a new server or retrieve a reference to an existing server.
        Only one server may run per port. If the server currently running on
        that port has a different password or dbfile, a RuntimeError is raised.
 
+       A new server runs `processes` server processes; an existing server
+       keeps the number it was started with.
+
        If `None` is specified for port, a port is picked randomly and that
        server is the one referenced for `None` thereafter.
+
+       Safe to call from several threads at once.
     """
     global _servers
-    if port not in _servers:
-        server = Server(port, password, dbfile)
-        _servers[port] = server
+    with _servers_lock:
+        if port not in _servers:
+            server = Server(port, password, dbfile, processes)
+            _servers[port] = server
 
-        # When port is None, this adds another entry for the server on the port
-        # it's actually running on
-        _servers[server.port] = server
-    else:
-        server = _servers[port]
-        if server.password != password or server.dbfile != dbfile:
-            raise RuntimeError("A server is already running on that port with "
-                               "a different password or dbfile.")
+            # When port is None, this adds another entry for the server on the
+            # port it's actually running on
+            _servers[server.port] = server
+        else:
+            server = _servers[port]
+            if server.password != password or server.dbfile != dbfile:
+                raise RuntimeError("A server is already running on that port "
+                                   "with a different password or dbfile.")
     return server
 
+def get_progress(dbfile):
+    """Return the Progress of a server started by this process which stores
+       into `dbfile`, or None if there is no such server (for instance if the
+       server was started elsewhere).
+    """
+    for server in _servers.values():
+        if server.dbfile == dbfile:
+            return server.progress
+    return None
+
+def wait_for_progress(progress, last, timeout=1.0):
+    """Wait for new results to be stored, returning early if `progress` (from
+       get_progress) changes from `last`. Without a progress, simply sleeps for
+       `timeout` seconds.
+    """
+    if progress is None:
+        time.sleep(timeout)
+    else:
+        progress.wait(last, timeout)
+
 def _cleanup_servers():
     """Shut down all running servers in _servers"""
     global _servers
@@ -197,3 +829,13 @@ def _cleanup_servers():
 # if we hold a reference in _servers, so register a handler to get rid of
 # them when this process ends.
 atexit.register(_cleanup_servers)
+
+make_application = None
+if USE_TORNADO:
+    # Imported last as the handlers use this module's reply functions. They
+    # need concurrent.futures, which Python 2 lacks without the futures
+    # package, in which case Tornado serves the Flask app alone.
+    try:
+        from sheepdog.handlers import make_application
+    except ImportError:
+        pass
@@ -9,14 +9,24 @@ Interface to the storage backend.
 Future plans involve porting most of those handwritten SQL to a sensible ORM.
 """
 
+import os
+import re
+import time
 import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from sheepdog.serialisation import BLOB_REF
 
 schema = """
 CREATE TABLE IF NOT EXISTS requests (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     function BLOB,
     namespace BLOB,
-    date_submitted TEXT
+    date_submitted TEXT,
+    function_hash TEXT,
+    namespace_hash TEXT
 );
 
 CREATE TABLE IF NOT EXISTS tasks (
@@ -24,6 +34,9 @@ CREATE TABLE IF NOT EXISTS tasks (
     request_id INTEGER,
     job_index INTEGER,
     args BLOB,
+    lease_expires REAL,
+    args_hash TEXT,
+    started REAL,
     FOREIGN KEY (request_id) REFERENCES requests(id)
 );
 
@@ -31,17 +44,135 @@ CREATE TABLE IF NOT EXISTS results (
     id INTEGER PRIMARY KEY,
     task_id INTEGER,
     result BLOB,
+    stored REAL,
     FOREIGN KEY (task_id) REFERENCES tasks(id)
 );
 
 CREATE TABLE IF NOT EXISTS errors (
-    id INTEGER PRIMARY KEY,
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id INTEGER,
+    error TEXT,
+    FOREIGN KEY (task_id) REFERENCES tasks(id)
+);
+"""
+
+# The schema version is kept in the database's user_version, and initdb
+# brings older databases up to date by running each migration in turn.
+#
+# Version 1 adds task leases, function and namespace hashes, indexes for all
+# the lookups on tasks, results and errors, and allows only one result per
+# task (keeping the first where duplicates were already stored).
+#
+# Version 2 adds a hash of each task's arguments, to find earlier results for
+# the same function, namespace and arguments.
+#
+# Version 3 adds when each task was last started and when each result was
+# stored, to find tasks taking much longer than the rest.
+#
+# Version 4 never reuses error IDs, which as_completed uses to find new errors,
+# even once errors are deleted when their tasks are resubmitted.
+SCHEMA_VERSION = 4
+
+migration_1 = """
+DELETE FROM results WHERE id NOT IN
+    (SELECT MIN(id) FROM results GROUP BY task_id);
+CREATE UNIQUE INDEX IF NOT EXISTS tasks_request_job
+    ON tasks(request_id, job_index);
+CREATE UNIQUE INDEX IF NOT EXISTS results_task ON results(task_id);
+CREATE INDEX IF NOT EXISTS errors_task ON errors(task_id);
+CREATE INDEX IF NOT EXISTS requests_function_hash ON requests(function_hash);
+CREATE INDEX IF NOT EXISTS requests_namespace_hash
+    ON requests(namespace_hash);
+"""
+
+migration_2 = """
+CREATE INDEX IF NOT EXISTS tasks_args_hash ON tasks(args_hash);
+"""
+
+migration_4 = """
+CREATE TABLE errors_autoincrement (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
     task_id INTEGER,
     error TEXT,
     FOREIGN KEY (task_id) REFERENCES tasks(id)
 );
+INSERT INTO errors_autoincrement (id, task_id, error)
+    SELECT id, task_id, error FROM errors;
+DROP TABLE errors;
+ALTER TABLE errors_autoincrement RENAME TO errors;
+CREATE INDEX IF NOT EXISTS errors_task ON errors(task_id);
 """
 
+# Arguments and results bigger than this many bytes are kept in files in a
+# content-addressed store next to the database file, with only a reference
+# (BLOB_REF followed by the content hash) stored in the database itself.
+EXTERNAL_THRESHOLD = 1024 * 1024
+
+# Approximate number of bytes a cached task ID takes up, for LRUCache sizing.
+TASK_ID_SIZE = 100
+
+# How many tasks iter_tasks_with_results reads from the database at a time.
+PAGE_SIZE = 1000
+
+# Errors are only stored for tasks without a result, so that when a backup
+# copy of a task has already succeeded, the other copy's error is discarded.
+# Takes the task ID, the error, then the task ID again.
+INSERT_ERROR = ("INSERT INTO errors (task_id, error) SELECT ?, ?"
+                " WHERE NOT EXISTS (SELECT 1 FROM results WHERE task_id=?)")
+
+def blob_hash(blob):
+    """Compute the content hash used to identify function and namespace
+       blobs, a hex string of the SHA-256 of *blob*.
+    """
+    return hashlib.sha256(blob).hexdigest()
+
+class LRUCache:
+    """A least-recently-used cache holding at most *max_bytes* of values.
+
+    Values are added with `put` along with their size in bytes, and looked
+    up with `get`. Once the total size is over *max_bytes* the least
+    recently used values are discarded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        """Return the value for *key*, or *default* if it's not cached."""
+        with self.lock:
+            if key not in self.items:
+                return default
+            value, size = self.items.pop(key)
+            self.items[key] = (value, size)
+        return value
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, key, value, size):
+        """Add *value* under *key*, taking up *size* bytes."""
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.items.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
 class Storage:
     """Manage persistence for requests and results.
 
@@ -51,24 +182,83 @@ class Storage:
 
     """
 
-    def __init__(self, dbfile):
+    def __init__(self, dbfile, cache=None):
         """__init__ creates a database connection.
 
         dbfile is a file path for the sqlite file.
 
+        cache is an optional LRUCache, shared between Storage instances for
+        the same dbfile, in which request functions and namespaces and task IDs
+        are kept to save reading them from the database again. These never
+        change once a request has been added, so are safe to cache.
+
+        Arguments and results bigger than EXTERNAL_THRESHOLD are kept in the
+        directory dbfile + ".blobs" rather than in the database.
+
+        on_commit, if set to a function, is called with the time taken by
+        each commit made while storing results and claiming or starting
+        tasks, in seconds.
+
         Use of ":memory:" is not advised as the web server runs in a separate
         process so will not share memory with the main interpreter process,
-        making it rather difficult to retrieve results.
+        making it rather difficult to retrieve results. In-memory databases
+        keep all arguments and results in the database.
         """
         self.dbfile = dbfile
+        self.cache = cache
+        self.blob_dir = None if dbfile == ":memory:" else dbfile + ".blobs"
+        self.on_commit = None
         self.conn = sqlite3.connect(dbfile, timeout=30.0)
 
     def initdb(self):
-        """Create the database structure if it doesn't already exist.
+        """Create the database structure if it doesn't already exist, or
+        migrate it to the current SCHEMA_VERSION if it's from an older version
+        of Sheepdog.
+
+        Also switches the database to write-ahead logging, so that reading
+        results doesn't block the server storing new ones.
         """
         c = self.conn.cursor()
         c.executescript(schema)
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version < 1:
+            self._add_column("tasks", "lease_expires", "REAL")
+            self._add_column("requests", "function_hash", "TEXT")
+            self._add_column("requests", "namespace_hash", "TEXT")
+            c.executescript(migration_1)
+        if version < 2:
+            self._add_column("tasks", "args_hash", "TEXT")
+            c.executescript(migration_2)
+        if version < 3:
+            self._add_column("tasks", "started", "REAL")
+            self._add_column("results", "stored", "REAL")
+        if version < 4:
+            c.execute("SELECT sql FROM sqlite_master WHERE name='errors'")
+            if "AUTOINCREMENT" not in c.fetchone()[0]:
+                c.executescript(migration_4)
+        c.execute("PRAGMA user_version={0}".format(SCHEMA_VERSION))
+        self.conn.commit()
+        c.execute("PRAGMA journal_mode=WAL")
+
+    def _add_column(self, table, column, definition):
+        """Add *column* to *table* if it's missing, for databases created by
+           older versions of Sheepdog.
+        """
+        c = self.conn.cursor()
+        c.execute("PRAGMA table_info({0})".format(table))
+        if column not in [r[1] for r in c.fetchall()]:
+            c.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                      table, column, definition))
+
+    def _commit(self):
+        """Commit the current transaction, timing it for `on_commit`."""
+        if self.on_commit is None:
+            self.conn.commit()
+            return
+        start = time.time()
         self.conn.commit()
+        self.on_commit(time.time() - start)
 
     def new_request(self, serialised_function, serialised_namespace,
                     args_list):
@@ -88,35 +278,260 @@ class Storage:
         Returns the new request ID.
         """
         c = self.conn.cursor()
-        c.execute("INSERT INTO requests (function, namespace, date_submitted)"
-                  " VALUES (?, ?, date('now'))",
+        c.execute("INSERT INTO requests (function, namespace, date_submitted,"
+                  " function_hash, namespace_hash)"
+                  " VALUES (?, ?, date('now'), ?, ?)",
                   (sqlite3.Binary(serialised_function),
-                   sqlite3.Binary(serialised_namespace)))
+                   sqlite3.Binary(serialised_namespace),
+                   blob_hash(serialised_function),
+                   blob_hash(serialised_namespace)))
         request_id = c.lastrowid
         tasks_list = []
         for idx, arg in enumerate(args_list):
-            tasks_list.append((request_id, idx + 1, sqlite3.Binary(arg)))
-        c.executemany("INSERT INTO tasks (request_id, job_index, args)"
-                      " VALUES (?, ?, ?)", tasks_list)
+            tasks_list.append((request_id, idx + 1, self._put(arg),
+                               blob_hash(arg)))
+        c.executemany("INSERT INTO tasks (request_id, job_index, args,"
+                      " args_hash) VALUES (?, ?, ?, ?)", tasks_list)
         self.conn.commit()
         return request_id
 
-    def get_details(self, request_id, job_index):
+    def get_details(self, request_id, job_index, refs=False):
         """Get the target function, namespace and arguments for a given job.
+
+        If *refs* is true, arguments in the external blob store are returned
+        as references (see EXTERNAL_THRESHOLD) rather than read in.
         """
+        request = self._get_request(request_id)
         c = self.conn.cursor()
-        c.execute("SELECT requests.function, requests.namespace, tasks.args"
-                  " FROM tasks"
-                  " JOIN requests ON tasks.request_id=requests.id"
+        c.execute("SELECT id, args FROM tasks"
                   " WHERE request_id=? AND job_index=?",
                   (request_id, job_index))
-        details = c.fetchone()
-        if not details:
+        task = c.fetchone()
+        if not task:
+            raise ValueError("No details found for specified request and job.")
+        self._cache_task_id(request_id, job_index, task[0])
+        return (request[0], request[1], self._load(task[1], refs))
+
+    def get_chunk_details(self, request_id, job_index, job_count,
+                          refs=False):
+        """Get the target function, namespace and arguments for a contiguous
+           chunk of *job_count* jobs starting at *job_index*.
+
+           Returns (function, namespace, tasks) where tasks is a list of
+           (job_index, args) items in job index order. *refs* is as for
+           `get_details`.
+        """
+        request = self._get_request(request_id)
+        c = self.conn.cursor()
+        c.execute("SELECT id, job_index, args FROM tasks"
+                  " WHERE request_id=? AND job_index BETWEEN ? AND ?"
+                  " ORDER BY job_index",
+                  (request_id, job_index, job_index + job_count - 1))
+        tasks = []
+        for r in c.fetchall():
+            self._cache_task_id(request_id, r[1], r[0])
+            tasks.append((r[1], self._load(r[2], refs)))
+        if not tasks:
+            raise ValueError("No details found for specified request and job.")
+        return (request[0], request[1], tasks)
+
+    def get_tasks_details(self, request_id, job_indices, refs=False):
+        """Get the target function, namespace and arguments for the jobs in
+           *job_indices*, which need not be contiguous.
+
+           Returns (function, namespace, tasks) as for `get_chunk_details`.
+        """
+        request = self._get_request(request_id)
+        c = self.conn.cursor()
+        tasks = []
+        # Keep well inside SQLite's limit on the number of query parameters.
+        for start in range(0, len(job_indices), 500):
+            group = list(job_indices[start:start + 500])
+            c.execute("SELECT id, job_index, args FROM tasks"
+                      " WHERE request_id=? AND job_index IN ({0})".format(
+                          ",".join("?" * len(group))),
+                      [request_id] + group)
+            for r in c.fetchall():
+                self._cache_task_id(request_id, r[1], r[0])
+                tasks.append((r[1], self._load(r[2], refs)))
+        if not tasks:
             raise ValueError("No details found for specified request and job.")
-        return (bytes(details[0]), bytes(details[1]), bytes(details[2]))
+        return (request[0], request[1], sorted(tasks))
+
+    def memoize(self, request_id):
+        """Store results for the tasks of *request_id* from tasks of earlier
+           requests with the same function, namespace and arguments which
+           already have results.
+
+           Returns a list of the job indices of the tasks still without a
+           result, in order.
+        """
+        c = self.conn.cursor()
+        c.execute("INSERT OR IGNORE INTO results (task_id, result)"
+                  " SELECT new.id, results.result"
+                  " FROM tasks AS new"
+                  " JOIN requests AS new_request"
+                  "     ON new.request_id=new_request.id"
+                  " JOIN requests AS old_request"
+                  "     ON old_request.function_hash=new_request.function_hash"
+                  "     AND old_request.namespace_hash="
+                  "         new_request.namespace_hash"
+                  "     AND old_request.id!=new_request.id"
+                  " JOIN tasks AS old"
+                  "     ON old.request_id=old_request.id"
+                  "     AND old.args_hash=new.args_hash"
+                  " JOIN results ON results.task_id=old.id"
+                  " WHERE new.request_id=?", (request_id,))
+        self.conn.commit()
+        c.execute("SELECT job_index FROM tasks"
+                  " WHERE request_id=?"
+                  " AND NOT EXISTS (SELECT 1 FROM results"
+                  "                 WHERE results.task_id=tasks.id)"
+                  " ORDER BY job_index", (request_id,))
+        return [r[0] for r in c.fetchall()]
+
+    def claim_task(self, request_id, lease, refs=False):
+        """Claim the next task for *request_id* which has no result or error
+           and is not currently leased to another worker, leasing it for
+           *lease* seconds.
+
+           Returns (job_index, args), or None if there are no tasks left.
+           *refs* is as for `get_details`.
+        """
+        now = time.time()
+        c = self.conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("SELECT id, job_index, args FROM tasks"
+                      " WHERE request_id=?"
+                      " AND (lease_expires IS NULL OR lease_expires < ?)"
+                      " AND NOT EXISTS (SELECT 1 FROM results"
+                      "                 WHERE results.task_id=tasks.id)"
+                      " AND NOT EXISTS (SELECT 1 FROM errors"
+                      "                 WHERE errors.task_id=tasks.id)"
+                      " ORDER BY job_index LIMIT 1", (request_id, now))
+            task = c.fetchone()
+            if task:
+                c.execute("UPDATE tasks SET lease_expires=?, started=?"
+                          " WHERE id=?", (now + lease, now, task[0]))
+            self._commit()
+        except:
+            self.conn.rollback()
+            raise
+        if not task:
+            return None
+        self._cache_task_id(request_id, task[1], task[0])
+        return (task[1], self._load(task[2], refs))
+
+    def get_hashes(self, request_id):
+        """Get the content hashes of the function and namespace for a given
+           request, as computed by `blob_hash`.
+
+           Returns (function_hash, namespace_hash), either of which may be
+           None for requests stored by older versions of Sheepdog.
+        """
+        request = self._get_request(request_id)
+        return (request[2], request[3])
+
+    def get_blob(self, content_hash):
+        """Get the function or namespace whose content hash is *content_hash*.
+        """
+        key = ("blob", content_hash)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        c = self.conn.cursor()
+        c.execute("SELECT function FROM requests WHERE function_hash=?"
+                  " UNION ALL"
+                  " SELECT namespace FROM requests WHERE namespace_hash=?"
+                  " LIMIT 1", (content_hash, content_hash))
+        blob = c.fetchone()
+        if not blob:
+            raise ValueError("No blob found with specified hash.")
+        blob = bytes(blob[0])
+        if self.cache is not None:
+            self.cache.put(key, blob, len(blob))
+        return blob
+
+    def blob_path(self, content_hash):
+        """Get the path of the file in the external blob store holding the
+           data whose content hash is *content_hash*, or None if there is no
+           such file.
+        """
+        if self.blob_dir is None or not re.match("^[0-9a-f]+$", content_hash):
+            return None
+        path = os.path.join(self.blob_dir, content_hash[:2], content_hash)
+        return path if os.path.exists(path) else None
+
+    def _put(self, data):
+        """Prepare *data* for storing in the database, moving it to the
+           external blob store and returning a reference to it instead if it
+           is bigger than EXTERNAL_THRESHOLD.
+        """
+        if self.blob_dir is None or len(data) <= EXTERNAL_THRESHOLD:
+            return sqlite3.Binary(data)
+        content_hash = blob_hash(data)
+        if self.blob_path(content_hash) is None:
+            directory = os.path.join(self.blob_dir, content_hash[:2])
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+            path = os.path.join(directory, content_hash)
+            tmp_path = "{0}.{1}.{2}.tmp".format(
+                path, os.getpid(), threading.current_thread().ident)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        return sqlite3.Binary(BLOB_REF + content_hash.encode())
+
+    def _load(self, data, refs=False):
+        """Turn a value read from the database back into the data stored,
+           reading it from the external blob store if it's a reference there,
+           unless *refs* is true. Workers are sent external blobs straight
+           from their files instead, see `blob_path`.
+        """
+        if data is None:
+            return None
+        data = bytes(data)
+        if refs or not data.startswith(BLOB_REF):
+            return data
+        content_hash = data[len(BLOB_REF):].decode()
+        path = self.blob_path(content_hash)
+        if path is None:
+            raise ValueError("Missing external blob {0}.".format(content_hash))
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _get_request(self, request_id):
+        """Retrieve (function, namespace, function_hash, namespace_hash) for
+           a given request ID, from the cache if possible.
+        """
+        key = ("request", request_id)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        c = self.conn.cursor()
+        c.execute("SELECT function, namespace, function_hash, namespace_hash"
+                  " FROM requests WHERE id=?", (request_id,))
+        request = c.fetchone()
+        if not request:
+            raise ValueError("No details found for specified request.")
+        request = (bytes(request[0]), bytes(request[1]),
+                   request[2], request[3])
+        if self.cache is not None:
+            self.cache.put(key, request, len(request[0]) + len(request[1]))
+        return request
 
     def _get_task_id(self, request_id, job_index):
         """Retrieve the task ID for a given request ID and job index."""
+        key = ("task", request_id, job_index)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
         c = self.conn.cursor()
         c.execute("SELECT id FROM tasks"
                   " WHERE request_id=? AND job_index=?",
@@ -124,23 +539,77 @@ class Storage:
         task_id = c.fetchone()
         if not task_id:
             raise ValueError("No task found for specified request and job.")
+        self._cache_task_id(request_id, job_index, task_id[0])
         return task_id[0]
 
+    def _cache_task_id(self, request_id, job_index, task_id):
+        if self.cache is not None:
+            self.cache.put(("task", request_id, job_index), task_id,
+                           TASK_ID_SIZE)
+
     def store_result(self, request_id, job_index, result):
-        """Store a new result from a given request_id and job_index."""
+        """Store a new result from a given request_id and job_index.
+
+        If a result has already been stored for this job it is kept and the
+        new result is discarded.
+        """
         task_id = self._get_task_id(request_id, job_index)
         c = self.conn.cursor()
-        c.execute("INSERT INTO results (task_id, result) VALUES (?, ?)",
-                  (task_id, sqlite3.Binary(result)))
-        self.conn.commit()
+        c.execute("INSERT OR IGNORE INTO results (task_id, result, stored)"
+                  " VALUES (?, ?, ?)",
+                  (task_id, self._put(result), time.time()))
+        self._commit()
 
     def store_error(self, request_id, job_index, error):
-        """Store an error resulting from a computation."""
+        """Store an error resulting from a computation, unless the task
+           already has a result, as when a backup copy of it succeeded.
+        """
         task_id = self._get_task_id(request_id, job_index)
         c = self.conn.cursor()
-        c.execute("INSERT INTO errors (task_id, error) VALUES (?, ?)",
-                  (task_id, error))
-        self.conn.commit()
+        c.execute(INSERT_ERROR, (task_id, error, task_id))
+        self._commit()
+
+    def store_batch(self, request_id, results, errors):
+        """Store many results and errors for a given request_id in a single
+           transaction.
+
+           *results* is a list of (job_index, result) items and *errors* is a
+           list of (job_index, error) items.
+        """
+        self.store_group([(request_id, results, errors)])
+
+    def store_group(self, batches, leases=()):
+        """Store the results and errors from several batches, possibly for
+           different requests, in a single transaction.
+
+           *batches* is a list of (request_id, results, errors) items, each
+           as for store_batch. *leases* is a list of (request_id, job_index,
+           expires) items, task leases to renew in the same transaction.
+        """
+        now = time.time()
+        result_rows = []
+        error_rows = []
+        for request_id, results, errors in batches:
+            result_rows += [(self._get_task_id(request_id, job_index),
+                             self._put(result), now)
+                            for job_index, result in results]
+            for job_index, error in errors:
+                task_id = self._get_task_id(request_id, job_index)
+                error_rows.append((task_id, error, task_id))
+        c = self.conn.cursor()
+        try:
+            c.executemany("INSERT OR IGNORE INTO results"
+                          " (task_id, result, stored) VALUES (?, ?, ?)",
+                          result_rows)
+            c.executemany(INSERT_ERROR, error_rows)
+            c.executemany("UPDATE tasks SET lease_expires=?"
+                          " WHERE request_id=? AND job_index=?",
+                          [(expires, request_id, job_index)
+                           for request_id, job_index, expires in leases])
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self._commit()
 
     def count_results(self, request_id):
         """Count the number of results so far for the given request_id."""
@@ -187,7 +656,7 @@ class Storage:
                   " JOIN tasks ON results.task_id=tasks.id"
                   " WHERE tasks.request_id=?"
                   " ORDER BY tasks.job_index", (request_id,))
-        return [(bytes(r[0]), bytes(r[1])) for r in c.fetchall()]
+        return [(self._load(r[0]), self._load(r[1])) for r in c.fetchall()]
 
     def get_tasks_with_results(self, request_id):
         """Fetch all tasks for a given request_id, including results for
@@ -196,17 +665,248 @@ class Storage:
            Returns a list of (args, result) items in the order of the original
            args_list provided to new_request, where result may be None.
         """
+        return [(args, result) for job_index, args, result
+                in self.iter_tasks_with_results(request_id)]
+
+    def iter_tasks_with_results(self, request_id, start=1, stop=None,
+                                args=True, results=True, page_size=PAGE_SIZE):
+        """Iterate over the tasks for a given request_id with job indices from
+           *start* up to but not including *stop* (or the last task), with
+           results for those where results have come in already.
+
+           Yields (job_index, args, result) items in job index order, where
+           result may be None. If *args* or *results* is false, that column
+           isn't read from the database and None is given in its place.
+
+           Tasks are read *page_size* at a time, so memory use stays bounded
+           however many tasks the request has.
+        """
+        columns = ", ".join(["tasks.args" if args else "NULL",
+                             "results.result" if results else "NULL"])
+        join = (" LEFT OUTER JOIN results ON tasks.id=results.task_id"
+                if results else "")
+        where, params = self._job_range(start, stop)
         c = self.conn.cursor()
-        c.execute("SELECT tasks.args, results.result"
-                  " FROM tasks"
-                  " LEFT OUTER JOIN results ON tasks.id=results.task_id"
-                  " WHERE tasks.request_id=?"
-                  " ORDER BY tasks.job_index", (request_id,))
-        results = []
-        for r in c.fetchall():
-            r1 = r[1] if r[1] is None else bytes(r[1])
-            results.append((bytes(r[0]), r1))
-        return results
+        last = start - 1
+        while True:
+            c.execute("SELECT tasks.job_index, " + columns +
+                      " FROM tasks" + join +
+                      " WHERE tasks.request_id=? AND tasks.job_index>?" +
+                      where +
+                      " ORDER BY tasks.job_index LIMIT ?",
+                      [request_id, last] + params + [page_size])
+            rows = c.fetchall()
+            for r in rows:
+                yield r[0], self._load(r[1]), self._load(r[2])
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def count_unfinished(self, request_id, start=1, stop=None):
+        """Count the tasks for a given request_id with job indices from
+           *start* up to but not including *stop* (or the last task) which
+           have neither a result nor an error yet.
+        """
+        where, params = self._job_range(start, stop)
+        c = self.conn.cursor()
+        c.execute("SELECT COUNT(*) FROM tasks"
+                  " WHERE tasks.request_id=? AND tasks.job_index>=?" + where +
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM results WHERE results.task_id=tasks.id)"
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM errors WHERE errors.task_id=tasks.id)",
+                  [request_id, start] + params)
+        return c.fetchone()[0]
+
+    def mark_started(self, request_id, job_indices, lease=None, started=True):
+        """Record that the tasks for a given request_id with the given job
+           indices have just been started by a worker, leasing them to it for
+           *lease* seconds if given.
+
+           A task keeps the time it was first started, so that a backup copy
+           starting doesn't hide how long the original has been running. If
+           *started* is false, only the leases are taken, for tasks whose
+           start time isn't known.
+        """
+        now = time.time()
+        expires = None if lease is None else now + lease
+        c = self.conn.cursor()
+        c.executemany("UPDATE tasks SET started=CASE WHEN ?"
+                      "  THEN COALESCE(started, ?) ELSE started END,"
+                      " lease_expires=COALESCE(?, lease_expires)"
+                      " WHERE request_id=? AND job_index=?",
+                      [(started, now, expires, request_id, job_index)
+                       for job_index in job_indices])
+        self._commit()
+
+    def count_states(self, request_id, lost_after=600):
+        """Count the tasks for a given request_id in each state, returning a
+           dict with these keys:
+
+           "queued": not yet started by any worker.
+           "running": leased to a worker which is still sending heartbeats.
+           "stalled": with a lease which expired in the last *lost_after*
+           seconds, so its worker has stopped sending heartbeats.
+           "lost": with a lease which expired longer ago than that.
+           "finished": with a result or an error.
+        """
+        now = time.time()
+        c = self.conn.cursor()
+        c.execute("SELECT state, COUNT(*) FROM"
+                  " (SELECT CASE"
+                  "  WHEN EXISTS (SELECT 1 FROM results"
+                  "               WHERE results.task_id=tasks.id)"
+                  "    OR EXISTS (SELECT 1 FROM errors"
+                  "               WHERE errors.task_id=tasks.id)"
+                  "  THEN 'finished'"
+                  "  WHEN lease_expires IS NULL THEN 'queued'"
+                  "  WHEN lease_expires>=? THEN 'running'"
+                  "  WHEN lease_expires>=? THEN 'stalled'"
+                  "  ELSE 'lost' END AS state"
+                  "  FROM tasks WHERE request_id=?)"
+                  " GROUP BY state", (now, now - lost_after, request_id))
+        states = dict.fromkeys(
+            ["queued", "running", "stalled", "lost", "finished"], 0)
+        states.update(c.fetchall())
+        return states
+
+    def get_stragglers(self, request_id, factor, min_finished=10):
+        """Get the job indices of the tasks for a given request_id which were
+           started more than *factor* times the median task duration ago and
+           have neither a result nor an error, in order.
+
+           Returns an empty list until at least *min_finished* tasks have
+           known durations.
+        """
+        c = self.conn.cursor()
+        durations = (" FROM results"
+                     " JOIN tasks ON results.task_id=tasks.id"
+                     " WHERE tasks.request_id=?"
+                     " AND tasks.started IS NOT NULL"
+                     " AND results.stored IS NOT NULL")
+        c.execute("SELECT COUNT(*)" + durations, (request_id,))
+        n_finished = c.fetchone()[0]
+        if n_finished < min_finished:
+            return []
+        c.execute("SELECT results.stored - tasks.started AS duration" +
+                  durations + " ORDER BY duration LIMIT 1 OFFSET ?",
+                  (request_id, n_finished // 2))
+        median = c.fetchone()[0]
+        c.execute("SELECT job_index FROM tasks"
+                  " WHERE request_id=? AND started<?"
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM results WHERE results.task_id=tasks.id)"
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM errors WHERE errors.task_id=tasks.id)"
+                  " ORDER BY job_index",
+                  (request_id, time.time() - factor * median))
+        return [r[0] for r in c.fetchall()]
+
+    def count_by_request(self, limit=20):
+        """Count the tasks of the *limit* most recent requests by state.
+
+        Returns a list of (request_id, results, errors, pending) items, newest
+        request first, where errors counts tasks with an error but no result
+        and pending counts tasks with neither.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT request_id, SUM(done), SUM(failed AND NOT done),"
+                  "       SUM(NOT done AND NOT failed)"
+                  " FROM (SELECT request_id,"
+                  "       EXISTS (SELECT 1 FROM results"
+                  "               WHERE results.task_id=tasks.id) AS done,"
+                  "       EXISTS (SELECT 1 FROM errors"
+                  "               WHERE errors.task_id=tasks.id) AS failed"
+                  "       FROM tasks WHERE request_id IN"
+                  "       (SELECT id FROM requests ORDER BY id DESC LIMIT ?))"
+                  " GROUP BY request_id ORDER BY request_id DESC", (limit,))
+        return [tuple(r) for r in c.fetchall()]
+
+    def get_missing(self, request_id):
+        """Get the job indices of the tasks for a given request_id which have
+           neither a result nor an error, in order.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT job_index FROM tasks"
+                  " WHERE request_id=?"
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM results WHERE results.task_id=tasks.id)"
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM errors WHERE errors.task_id=tasks.id)"
+                  " ORDER BY job_index", (request_id,))
+        return [r[0] for r in c.fetchall()]
+
+    def get_failed(self, request_id):
+        """Get the job indices of the tasks for a given request_id which have
+           reported an error and have no result, in order.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT job_index FROM tasks"
+                  " WHERE request_id=?"
+                  " AND NOT EXISTS"
+                  "  (SELECT 1 FROM results WHERE results.task_id=tasks.id)"
+                  " AND EXISTS"
+                  "  (SELECT 1 FROM errors WHERE errors.task_id=tasks.id)"
+                  " ORDER BY job_index", (request_id,))
+        return [r[0] for r in c.fetchall()]
+
+    def reset_tasks(self, request_id, job_indices):
+        """Prepare the tasks for a given request_id with the given job indices
+           to be run again, deleting their errors, forgetting when they were
+           started and releasing any leases held on them by persistent
+           workers.
+
+           Error IDs are never reused, so `get_new_errors` still finds errors
+           stored after these are deleted.
+        """
+        task_ids = [(self._get_task_id(request_id, job_index),)
+                    for job_index in job_indices]
+        c = self.conn.cursor()
+        c.executemany("DELETE FROM errors WHERE task_id=?", task_ids)
+        c.executemany("UPDATE tasks SET lease_expires=NULL, started=NULL"
+                      " WHERE id=?", task_ids)
+        self.conn.commit()
+
+    def _job_range(self, start, stop):
+        """Return an SQL condition and its parameters limiting job indices
+           to below *stop*, if it's given.
+        """
+        if stop is None:
+            return "", []
+        return " AND tasks.job_index<?", [stop]
+
+    def get_new_results(self, request_id, after=0):
+        """Fetch results for a given request_id which were stored after the
+        result whose row ID is *after*.
+
+        Returns a list of (row_id, job_index, args, result) items in the order
+        the results were stored, so the last row_id may be passed as *after*
+        to fetch only results which have arrived since.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT results.id, tasks.job_index, tasks.args,"
+                  "       results.result"
+                  " FROM results"
+                  " JOIN tasks ON results.task_id=tasks.id"
+                  " WHERE results.id>? AND tasks.request_id=?"
+                  " ORDER BY results.id", (after, request_id))
+        return [(r[0], r[1], self._load(r[2]), self._load(r[3]))
+                for r in c.fetchall()]
+
+    def get_new_errors(self, request_id, after=0):
+        """Fetch errors for a given request_id which were stored after the
+        error whose row ID is *after*.
+
+        Returns a list of (row_id, job_index, args, error) items in the order
+        the errors were stored.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT errors.id, tasks.job_index, tasks.args, errors.error"
+                  " FROM errors"
+                  " JOIN tasks ON errors.task_id=tasks.id"
+                  " WHERE errors.id>? AND tasks.request_id=?"
+                  " ORDER BY errors.id", (after, request_id))
+        return [(r[0], r[1], self._load(r[2]), r[3]) for r in c.fetchall()]
 
     def get_errors(self, request_id):
         """Fetch all errors for a given request_id.
@@ -220,4 +920,4 @@ class Storage:
                   " JOIN tasks ON errors.task_id=tasks.id"
                   " WHERE tasks.request_id=?"
                   " ORDER BY tasks.job_index", (request_id,))
-        return [(bytes(r[0]), r[1]) for r in c.fetchall()]
+        return [(self._load(r[0]), r[1]) for r in c.fetchall()]
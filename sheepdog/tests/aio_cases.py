@@ -0,0 +1,103 @@
+# Sheepdog
+# Copyright 2013 Adam Greig
+#
+# Released under the MIT license. See LICENSE file for details.
+
+"""
+Tests for sheepdog.aio, imported by test_aio on Python 3.6 and newer only as
+they use syntax older versions can't parse.
+"""
+
+import os
+import asyncio
+import tempfile
+from nose.tools import assert_equals
+
+from sheepdog import aio, storage, serialisation
+
+
+class TestAio:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        args = [serialisation.serialise_pickle(a) for a in (1, 2, 3)]
+        self.request_id = self.storage.new_request(b"f", b"ns", args)
+        self.loop = asyncio.new_event_loop()
+
+    def teardown(self):
+        self.loop.close()
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+
+    def store(self, job_index, result):
+        self.storage.store_result(self.request_id, job_index,
+                                  serialisation.serialise_pickle(result))
+
+    def test_gets_partial_results(self):
+        self.store(2, 20)
+        results = self.loop.run_until_complete(
+            aio.get_results(self.request_id, self.dbfile, block=False))
+        assert_equals(results, [(1, None), (2, 20), (3, None)])
+
+    def test_gets_range_of_results(self):
+        self.store(2, 20)
+        self.storage.store_error(self.request_id, 3, "oops")
+        results = self.loop.run_until_complete(
+            aio.get_results(self.request_id, self.dbfile, start=1,
+                            args=False))
+        assert_equals(results, [(None, 20), (None, None)])
+
+    def test_gets_args_without_results(self):
+        self.store(1, 10)
+        results = self.loop.run_until_complete(
+            aio.get_results(self.request_id, self.dbfile, block=False,
+                            stop=2, results=False))
+        assert_equals(results, [(1, None), (2, None)])
+
+    def test_waits_for_results(self):
+        self.store(1, 10)
+        self.storage.store_error(self.request_id, 3, "oops")
+
+        async def store_later():
+            await asyncio.sleep(0.1)
+            self.store(2, 20)
+
+        async def run():
+            task = asyncio.ensure_future(store_later())
+            results = await aio.get_results(self.request_id, self.dbfile)
+            await task
+            return results
+
+        results = self.loop.run_until_complete(run())
+        assert_equals(results, [(1, 10), (2, 20), (3, None)])
+
+    def test_waits_for_tasks_with_errors_and_results(self):
+        self.storage.store_error(self.request_id, 1, "oops")
+        self.store(1, 10)
+        self.store(2, 20)
+
+        async def store_later():
+            await asyncio.sleep(0.1)
+            self.store(3, 30)
+
+        async def run():
+            task = asyncio.ensure_future(store_later())
+            results = await aio.get_results(self.request_id, self.dbfile)
+            await task
+            return results
+
+        results = self.loop.run_until_complete(run())
+        assert_equals(results, [(1, 10), (2, 20), (3, 30)])
+
+    def test_yields_as_completed(self):
+        self.store(3, 30)
+        self.store(1, 10)
+        self.storage.store_error(self.request_id, 2, "oops")
+
+        async def run():
+            return [item async for item in
+                    aio.as_completed(self.request_id, self.dbfile)]
+
+        items = self.loop.run_until_complete(run())
+        assert_equals(items, [(2, 3, 30), (0, 1, 10), (1, 2, None)])
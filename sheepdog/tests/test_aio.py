@@ -0,0 +1,12 @@
+# Sheepdog
+# Copyright 2013 Adam Greig
+#
+# Released under the MIT license. See LICENSE file for details.
+
+import sys
+from unittest import SkipTest
+
+if sys.version_info < (3, 6):
+    raise SkipTest("sheepdog.aio needs Python 3.6 or newer")
+
+from aio_cases import TestAio
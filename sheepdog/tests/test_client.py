@@ -4,6 +4,8 @@
 # Released under the MIT license. See LICENSE file for details.
 
 import os
+import time
+import shutil
 import socket
 import tempfile
 from nose.tools import assert_equal, assert_raises, assert_true
@@ -13,6 +15,11 @@ try:
 except ImportError:
     from mock import Mock, patch
 
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
 from sheepdog import storage, server, serialisation, client
 
 def get_free_port():
@@ -28,6 +35,8 @@ def my_function(a, b):
 
 class TestClient:
     def setup(self):
+        # Some tests replace client.time with a fake, so put it back.
+        client.time = time
         self.db_fd, self.dbfile = tempfile.mkstemp()
 
         self.port = get_free_port()
@@ -65,6 +74,42 @@ class TestClient:
         del self.client.ns["__builtins__"]
         assert_equal(self.client.ns, self.ns)
 
+    def test_gets_details_with_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache_client = client.Client(self.url, self.password,
+                                         self.request_id, self.job_index,
+                                         cache_dir=cache_dir)
+            cache_client.get_details()
+            assert_equal(sorted(os.listdir(cache_dir)),
+                         sorted([storage.blob_hash(self.func_bin),
+                                 storage.blob_hash(self.ns_bin)]))
+
+            # Blobs already in the cache shouldn't be fetched again.
+            with open(os.path.join(cache_dir, "x"), "wb") as f:
+                f.write(self.func_bin)
+            with open(os.path.join(cache_dir, "y"), "wb") as f:
+                f.write(self.ns_bin)
+            cache_client._get = Mock(return_value=(
+                b'{"args": "' + self.args_bin[0] +
+                b'", "func_hash": "x", "ns_hash": "y"}', False))
+            cache_client.get_details()
+            assert_equal(cache_client._get.call_count, 1)
+            assert_equal(cache_client.args, self.args[0])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_fetches_referenced_args(self):
+        content_hash = storage.blob_hash(self.args_bin[0])
+        self.client._get = Mock(side_effect=[
+            (b'{"args": "@blob:' + content_hash.encode() +
+             b'", "func": "' + self.func_bin + b'", "ns": "' + self.ns_bin +
+             b'"}', False),
+            (self.args_bin[0], False)])
+        self.client.get_details()
+        assert_equal(self.client.args, self.args[0])
+        self.client._get.assert_called_with(self.url + "blob/" + content_hash)
+
     def test_get_details_exceeds_retries(self):
         self.client.HTTP_RETRIES = 1
         self.client.url = "http://localhost:1/"
@@ -111,6 +156,34 @@ class TestClient:
         client.time = FakeTime()
         assert_raises(RuntimeError, self.client.submit_results)
 
+    def test_uses_binary_if_supported(self):
+        assert_true(not self.client.binary)
+        body, headers = self.client._encode({"result": b"raw"})
+        assert_equal(body, urlencode(
+            {"result": serialisation.from_raw(b"raw")}).encode())
+        self.client.get_details()
+        assert_true(self.client.binary)
+        body, headers = self.client._encode({"result": b"raw"})
+        assert_equal(headers["Content-Type"], client.BINARY)
+        assert_equal(serialisation.unpack_frames(body), ({}, [b"raw"]))
+
+    def test_compresses_results(self):
+        zclient = client.Client(self.url, self.password, self.request_id,
+                                self.job_index, compression="zlib")
+        zclient.get_details()
+        assert_true("zlib" in zclient.server_compression)
+        zclient.result = "x" * 10000
+        zclient.submit_results()
+        expected = serialisation.serialise_pickle("x" * 10000)
+        assert_equal(self.storage.get_results(self.request_id),
+                     [(self.args_bin[1], expected)])
+
+    def test_ignores_unknown_compression(self):
+        zclient = client.Client(self.url, self.password, self.request_id,
+                                self.job_index, compression="nonsense")
+        assert_equal(zclient.compression, None)
+        assert_true(client.ACCEPT_COMPRESSION not in zclient.authhdr)
+
     def test_submits_errors(self):
         self.client.get_details()
         self.client.run()
@@ -124,6 +197,100 @@ class TestClient:
         assert_equal(self.storage.get_results(self.request_id),
                      [(self.args_bin[1], expected)])
 
+    def test_go_chunk(self):
+        chunk_client = client.Client(self.url, self.password,
+                                     self.request_id, 1, 2)
+        chunk_client.go()
+        expected = [(a, serialisation.serialise_pickle(self.func(*arg)))
+                    for a, arg in zip(self.args_bin, self.args)]
+        assert_equal(self.storage.get_results(self.request_id), expected)
+
+    def test_go_job_indices(self):
+        indices_client = client.Client(self.url, self.password,
+                                       self.request_id, 2, job_indices=[2])
+        indices_client.go()
+        expected = [(self.args_bin[1], serialisation.serialise_pickle(
+            self.func(*self.args[1])))]
+        assert_equal(self.storage.get_results(self.request_id), expected)
+        indices_client = client.Client(self.url, self.password,
+                                       self.request_id, 1, job_indices=[1, 2])
+        indices_client._get = Mock(return_value=(b"{}", False))
+        assert_raises(KeyError, indices_client.get_details)
+        indices_client._get.assert_called_with(
+            self.url + "?request_id=1&job_index=1&job_indices=1,2",
+            {"Accept": client.BINARY})
+
+    def test_go_chunk_batches(self):
+        chunk_client = client.Client(self.url, self.password,
+                                     self.request_id, 1, 2)
+        chunk_client.BATCH_SIZE = 1
+        chunk_client._post = Mock()
+        chunk_client.go()
+        assert_equal(chunk_client._post.call_count, 2)
+        assert_true(chunk_client._post.call_args[0][0].endswith("/batch"))
+
+    def test_works_until_no_tasks_left(self):
+        worker = client.Client(self.url, self.password, self.request_id, 1)
+        worker.work()
+        expected = [(a, serialisation.serialise_pickle(self.func(*arg)))
+                    for a, arg in zip(self.args_bin, self.args)]
+        assert_equal(self.storage.get_results(self.request_id), expected)
+
+    def wait_for_states(self, request_id, **expected):
+        """Wait for the server to commit task states matching *expected*."""
+        for tries in range(100):
+            states = self.storage.count_states(request_id)
+            if all(states[k] == v for k, v in expected.items()):
+                return
+            time.sleep(0.01)
+        assert_equal(dict((k, states[k]) for k in expected), expected)
+
+    def test_sends_heartbeats(self):
+        self.client.heartbeat()
+        self.wait_for_states(self.request_id, queued=2)
+        self.client.running = (1, 2)
+        self.client.heartbeat()
+        self.wait_for_states(self.request_id, running=2)
+
+    def test_heartbeats_while_running(self):
+        def slow_function(a, b):
+            import time
+            time.sleep(0.3)
+            return a + b
+        func_bin = serialisation.serialise_function(slow_function)
+        request_id = self.storage.new_request(func_bin, self.ns_bin,
+                                              self.args_bin)
+        worker = client.Client(self.url, self.password, request_id, 1, 2)
+        worker.HEARTBEAT_INTERVAL = 0.05
+        sent = []
+        worker.heartbeat = lambda: sent.append(worker.running)
+        worker.go()
+        assert_true((1, 2) in sent)
+        assert_true((2,) in sent)
+        assert_equal(worker.heartbeat_stop, None)
+        self.wait_for_states(request_id, finished=2)
+
+    def test_sends_old_batch_during_long_task(self):
+        def slow_function(a, b):
+            import time
+            time.sleep(a / 10.0)
+            return a + b
+        func_bin = serialisation.serialise_function(slow_function)
+        request_id = self.storage.new_request(func_bin, self.ns_bin,
+                                              self.args_bin)
+        worker = client.Client(self.url, self.password, request_id, 1, 2)
+        worker.BATCH_INTERVAL = 0.05
+        sent = []
+        post = worker._post
+        def record_post(url, data, headers):
+            sent.append(worker.running)
+            return post(url, data, headers)
+        worker._post = record_post
+        worker.go()
+        # The first result is sent while the second task is still running.
+        assert_equal(sent, [(2,), ()])
+        self.wait_for_states(request_id, finished=2)
+
     def test_catches_exceptions(self):
         def bad_function(a, b):
             def inner(x):
@@ -139,25 +306,15 @@ class TestClient:
         assert_true("MyOwnException: oopsie!" in
                     self.storage.get_errors(request_id)[0][1])
 
-    memlimit_tests = {
-        '123': 123, '3k': 3*1024, '5K': 5*1024,
-        '2M': 2*1024*1024, '2000m': 2000*1024*1024,
-        '1g': 1024*1024*1024, '8g': 8*1024*1024*1024,
-        '3t': 3*1024*1024*1024*1024, '1T': 1024*1024*1024*1024}
-
     @patch('resource.setrlimit')
-    def check_sets_memlimit(self, k, v, setrlimit):
-        with tempfile.NamedTemporaryFile('w+') as f:
-            f.write("#!/usr/bin/python\n#$ -l mem_grab={}\nprint('hello')\n"
-                    .format(k))
-            f.flush()
-            self.client.set_memlimit(f.name)
-        setrlimit.assert_called_with(
-            client.resource.RLIMIT_AS, (v, v))
-
-    def test_sets_memlimit(self):
-        for key, value in self.memlimit_tests.items():
-            self.check_sets_memlimit(key, value)
+    def test_sets_memlimit(self, setrlimit):
+        self.client.set_memlimit()
+        assert not setrlimit.called
+        self.client.memlimit = 2048
+        self.client.set_memlimit()
+        self.client.set_memlimit()
+        setrlimit.assert_called_once_with(
+            client.resource.RLIMIT_AS, (2048, 2048))
 
     def test_calls_memlimit(self):
         self.client.set_memlimit = Mock()
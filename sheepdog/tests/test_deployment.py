@@ -3,7 +3,8 @@
 #
 # Released under the MIT license. See LICENSE file for details.
 
-from nose.tools import assert_equal, assert_true
+import os
+from nose.tools import assert_equal, assert_true, assert_raises
 
 try:
     from unittest.mock import Mock, MagicMock, patch, mock_open
@@ -91,3 +92,109 @@ class TestDeployment:
         d.submit(123, "/path/to/dir")
         mock_ssh.return_value.exec_command.assert_called_with(
             "qsub /path/to/dir/sheepdog_123.py")
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_sets_keepalive(self, mock_ssh):
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        transport = mock_ssh.return_value.get_transport.return_value
+        transport.set_keepalive.assert_called_with(
+            sheepdog.deployment.KEEPALIVE)
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_reuses_sftp_session(self, mock_ssh):
+        sftp = mock_ssh.return_value.open_sftp.return_value
+        sftp.open.return_value = MagicMock()
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        d.deploy("jobfile contents", 1, "/path/to/dir")
+        d.deploy("jobfile contents", 2, "/path/to/dir")
+        assert_equal(mock_ssh.return_value.open_sftp.call_count, 1)
+        assert_equal(sftp.mkdir.call_count, 1)
+        assert_equal(sftp.open.call_count, 2)
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_reconnects_inactive_connection(self, mock_ssh):
+        mock_ssh.return_value.exec_command.return_value = (Mock(),)*3
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        transport = mock_ssh.return_value.get_transport.return_value
+        transport.is_active.return_value = False
+        d.submit(123, "/path/to/dir")
+        assert_equal(mock_ssh.return_value.connect.call_count, 2)
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_retries_after_dropped_connection(self, mock_ssh):
+        sftp = mock_ssh.return_value.open_sftp.return_value
+        sftp.open.side_effect = [EOFError(), MagicMock()]
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        d.deploy("jobfile contents", 123, "/path/to/dir")
+        assert_equal(mock_ssh.return_value.connect.call_count, 2)
+        assert_equal(sftp.open.call_count, 2)
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_does_not_resubmit_after_dropped_connection(self, mock_ssh):
+        mock_ssh.return_value.exec_command.side_effect = [
+            EOFError(), (Mock(),)*3]
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        assert_raises(RuntimeError, d.submit, 123, "/path/to/dir")
+        assert_equal(mock_ssh.return_value.exec_command.call_count, 1)
+        assert_equal(mock_ssh.return_value.connect.call_count, 1)
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_pools_deployers(self, mock_ssh):
+        get_deployer = sheepdog.deployment.get_deployer
+        try:
+            d1 = get_deployer("test", 22, "user")
+            d2 = get_deployer("test", 22, "user")
+            d3 = get_deployer("test", 22, "other")
+            assert_true(d1 is d2)
+            assert_true(d1 is not d3)
+            assert_equal(mock_ssh.return_value.connect.call_count, 2)
+        finally:
+            sheepdog.deployment._cleanup_deployers()
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_deploys_runtime(self, mock_ssh):
+        sftp = mock_ssh.return_value.open_sftp.return_value
+        sftp.stat.side_effect = IOError()
+        sftp.open.return_value = MagicMock()
+        stdout = Mock()
+        stdout.channel.recv_exit_status.return_value = 0
+        mock_ssh.return_value.exec_command.return_value = (
+            Mock(), stdout, Mock())
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        d.deploy_runtime("rt", "code", "/path/to/dir", "/usr/bin/python")
+        d.deploy_runtime("rt", "code", "/path/to/dir", "/usr/bin/python")
+        tmp_path = "/path/to/dir/rt.py.{0}.tmp".format(os.getpid())
+        sftp.open.assert_called_once_with(tmp_path, 'w')
+        sftp.rename.assert_called_once_with(tmp_path, "/path/to/dir/rt.py")
+        mock_ssh.return_value.exec_command.assert_called_once_with(
+            "/usr/bin/python -m py_compile /path/to/dir/rt.py")
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_raises_if_runtime_does_not_compile(self, mock_ssh):
+        sftp = mock_ssh.return_value.open_sftp.return_value
+        sftp.stat.side_effect = IOError()
+        sftp.open.return_value = MagicMock()
+        stdout, stderr = Mock(), Mock()
+        stdout.channel.recv_exit_status.return_value = 127
+        stderr.read.return_value = b"python: command not found"
+        mock_ssh.return_value.exec_command.return_value = (
+            Mock(), stdout, stderr)
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        try:
+            d.deploy_runtime("rt", "code", "/path/to/dir", "python")
+        except RuntimeError as e:
+            assert "command not found" in str(e)
+        else:
+            raise AssertionError("Expected RuntimeError")
+        sftp.remove.assert_called_with("/path/to/dir/rt.py")
+        assert_raises(RuntimeError, d.deploy_runtime, "rt", "code",
+                      "/path/to/dir", "python")
+
+    @patch('sheepdog.deployment.paramiko.SSHClient')
+    def test_skips_deployed_runtime(self, mock_ssh):
+        sftp = mock_ssh.return_value.open_sftp.return_value
+        d = sheepdog.deployment.Deployer("test", 22, "user")
+        d.deploy_runtime("rt", "code", "/path/to/dir", "/usr/bin/python")
+        sftp.stat.assert_called_with("/path/to/dir/rt.py")
+        assert not sftp.open.called
+        assert not mock_ssh.return_value.exec_command.called
@@ -0,0 +1,250 @@
+# Sheepdog
+# Copyright 2013 Adam Greig
+#
+# Released under the MIT license. See LICENSE file for details.
+
+import os
+import json
+import time
+import base64
+import shutil
+import tempfile
+from unittest import SkipTest
+from nose.tools import assert_equals
+
+try:
+    from urllib.error import URLError, HTTPError
+    from urllib.parse import urlencode
+    from urllib.request import urlopen, Request
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import urlopen, Request, URLError, HTTPError
+
+from sheepdog import server, storage, serialisation
+
+try:
+    from tornado import gen
+    from tornado.ioloop import IOLoop
+    from sheepdog import handlers
+except ImportError:
+    raise SkipTest("The native handlers need Tornado and concurrent.futures")
+
+
+class TestHandlers:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        self.args = serialisation.serialise_args([1, 2, 3])
+        self.storage.new_request(b"myfunc", b"ns", self.args)
+        self.password = "password"
+        self.port = server._get_free_port()
+        self.server = server.Server(self.port, self.password, self.dbfile)
+
+    def teardown(self):
+        del self.server
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+
+    def request(self, path, data=None, headers=None, password=None):
+        """Make a request to the server, waiting for it to start up."""
+        url = "http://localhost:{0}{1}".format(self.port, path)
+        userpass = ("sheepdog:" + (password or self.password)).encode()
+        authstr = base64.b64encode(userpass).decode()
+        hdrs = {"Authorization": "Basic " + authstr}
+        hdrs.update(headers or {})
+        for tries in range(100):
+            try:
+                return urlopen(Request(url, data, hdrs))
+            except HTTPError:
+                raise
+            except URLError:
+                time.sleep(0.05)
+        raise RuntimeError("Could not connect to server.")
+
+    def test_gets_config(self):
+        response = self.request("/?request_id=1&job_index=2&job_count=2")
+        result = json.loads(response.read().decode())
+        assert_equals(result['args'], self.args[1].decode())
+        assert_equals(result['tasks'], [[2, self.args[1].decode()],
+                                        [3, self.args[2].decode()]])
+
+    def test_gets_binary_config(self):
+        response = self.request("/?request_id=1&job_index=2",
+                                headers={"Accept": server.BINARY})
+        assert_equals(response.info().get("Content-Type"), server.BINARY)
+        header, payloads = serialisation.unpack_frames(response.read())
+        assert_equals(header['tasks'], [2])
+        assert_equals(payloads, [serialisation.to_raw(self.args[1])])
+
+    def test_submits_result_and_error(self):
+        data = urlencode(dict(request_id=1, job_index=1, result="abc"))
+        assert_equals(self.request("/", data.encode()).read(), b"OK")
+        data = urlencode(dict(request_id=1, job_index=2, error="oops"))
+        assert_equals(self.request("/error", data.encode()).read(), b"OK")
+        assert_equals(self.storage.get_results(1), [(self.args[0], b"abc")])
+        assert_equals(self.storage.get_errors(1), [(self.args[1], "oops")])
+
+    def test_submits_compressed_binary_batch(self):
+        data = serialisation.pack_frames(
+            {"request_id": 1, "results": [1, 3], "errors": []},
+            [b"x" * 2000, b"y"])
+        headers = {"Content-Type": server.BINARY,
+                   server.COMPRESSION: "zlib"}
+        response = self.request("/batch", serialisation.compress(data, "zlib"),
+                                headers)
+        assert_equals(response.read(), b"OK")
+        assert_equals(self.storage.get_results(1), [
+            (self.args[0], serialisation.from_raw(b"x" * 2000)),
+            (self.args[2], serialisation.from_raw(b"y"))])
+
+    def test_next_task(self):
+        data = urlencode(dict(request_id=1)).encode()
+        result = json.loads(self.request("/next", data).read().decode())
+        assert_equals(result, {"job_index": 1,
+                                "args": self.args[0].decode()})
+
+    def test_requires_correct_password(self):
+        try:
+            self.request("/?request_id=1&job_index=1", password="wrong")
+        except HTTPError as e:
+            assert_equals(e.code, 401)
+        else:
+            raise AssertionError("Expected HTTP 401")
+
+    def test_runs_several_processes(self):
+        del self.server
+        self.server = server.Server(self.port, self.password, self.dbfile,
+                                    processes=3)
+        assert_equals(len(self.server.servers), 3)
+        assert all(p.is_alive() for p in self.server.servers)
+        for job_index in (1, 2, 3):
+            data = urlencode(dict(request_id=1, job_index=job_index,
+                                  result="r{0}".format(job_index)))
+            assert_equals(self.request("/", data.encode()).read(), b"OK")
+        assert_equals(self.storage.count_results(1), 3)
+        assert_equals(self.server.progress.value, 3)
+
+    def test_gets_metrics(self):
+        data = urlencode(dict(request_id=1, job_index=1, result="abc"))
+        assert_equals(self.request("/", data.encode()).read(), b"OK")
+        lines = self.request("/metrics").read().decode().splitlines()
+        assert 'sheepdog_requests_total{endpoint="submit_result"} 1' in lines
+        assert 'sheepdog_db_commit_duration_seconds_count 1' in lines
+        assert 'sheepdog_tasks{request_id="1",state="results"} 1' in lines
+
+    def test_gets_blob(self):
+        func_hash = storage.blob_hash(b"myfunc")
+        response = self.request("/blob/" + func_hash)
+        assert_equals(response.read(), b"myfunc")
+        assert_equals(response.info().get("Etag"), '"{0}"'.format(func_hash))
+
+    def test_streams_external_blob(self):
+        threshold = storage.EXTERNAL_THRESHOLD
+        storage.EXTERNAL_THRESHOLD = 8
+        try:
+            big = os.urandom(handlers.BLOB_CHUNK * 2 + 10)
+            self.storage.new_request(b"f", b"ns", [big])
+            response = self.request("/blob/" + storage.blob_hash(big))
+            assert_equals(response.info().get("Content-Length"),
+                          str(len(big)))
+            assert response.read() == big
+        finally:
+            storage.EXTERNAL_THRESHOLD = threshold
+            shutil.rmtree(self.dbfile + ".blobs", ignore_errors=True)
+
+    def test_gets_blob_not_modified(self):
+        func_hash = storage.blob_hash(b"myfunc")
+        headers = {"If-None-Match": '"{0}"'.format(func_hash)}
+        try:
+            self.request("/blob/" + func_hash, headers=headers)
+        except HTTPError as e:
+            assert_equals(e.code, 304)
+        else:
+            raise AssertionError("Expected HTTP 304")
+
+    def test_gets_missing_blob(self):
+        try:
+            self.request("/blob/" + "0" * 64)
+        except HTTPError as e:
+            assert_equals(e.code, 404)
+        else:
+            raise AssertionError("Expected HTTP 404")
+
+    def test_falls_back_to_flask(self):
+        response = self.request("/metrics")
+        assert_equals(response.info().get("Content-Type"),
+                      "text/plain; version=0.0.4")
+
+
+class TestGroupWriter:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        self.args = serialisation.serialise_args([1, 2, 3])
+        self.request_id = self.storage.new_request(b"f", b"ns", self.args)
+        server.app.config['DBFILE'] = self.dbfile
+        self.loop = IOLoop()
+
+    def teardown(self):
+        self.loop.close()
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+
+    def store_all(self, writer, rows):
+        """Store each of *rows* with *writer*, returning a list of the
+           exceptions raised (or None) for each.
+        """
+        def run():
+            futures = [writer.store(r) for r in rows]
+            outcomes = []
+            for future in futures:
+                try:
+                    yield future
+                    outcomes.append(None)
+                except Exception as e:
+                    outcomes.append(e)
+            raise gen.Return(outcomes)
+        return self.loop.run_sync(gen.coroutine(run))
+
+    def test_commits_group_after_wait(self):
+        writer = handlers.GroupWriter(wait=0.01)
+        outcomes = self.store_all(writer, [
+            (self.request_id, [(1, b"a")], []),
+            (self.request_id, [], [(2, "oops")])])
+        assert_equals(outcomes, [None, None])
+        assert_equals(self.storage.get_results(self.request_id),
+                      [(self.args[0], b"a")])
+        assert_equals(self.storage.get_errors(self.request_id),
+                      [(self.args[1], "oops")])
+
+    def test_commits_full_group_immediately(self):
+        writer = handlers.GroupWriter(size=2, wait=3600)
+        outcomes = self.store_all(writer, [
+            (self.request_id, [(1, b"a"), (2, b"b")], [])])
+        assert_equals(outcomes, [None])
+        assert_equals(writer.timeout, None)
+        assert_equals(self.storage.count_results(self.request_id), 2)
+
+    def test_commits_lease_renewals(self):
+        writer = handlers.GroupWriter(wait=0.01)
+        writer.renew([(self.request_id, 1, time.time() + 60)])
+        outcomes = self.store_all(writer, [
+            (self.request_id, [(2, b"b")], [])])
+        assert_equals(outcomes, [None])
+        assert_equals(writer.leases, [])
+        states = self.storage.count_states(self.request_id)
+        assert_equals((states["running"], states["finished"]), (1, 1))
+
+    def test_bad_report_only_fails_itself(self):
+        writer = handlers.GroupWriter(wait=0.01)
+        outcomes = self.store_all(writer, [
+            (self.request_id, [(1, b"a")], []),
+            (self.request_id, [(99, b"b")], []),
+            (self.request_id, [(3, b"c")], [])])
+        assert_equals(outcomes[0], None)
+        assert isinstance(outcomes[1], ValueError)
+        assert_equals(outcomes[2], None)
+        assert_equals(self.storage.get_results(self.request_id),
+                      [(self.args[0], b"a"), (self.args[2], b"c")])
@@ -0,0 +1,278 @@
+# Sheepdog
+# Copyright 2013 Adam Greig
+#
+# Released under the MIT license. See LICENSE file for details.
+
+import os
+import tempfile
+import threading
+from unittest import SkipTest
+from nose.tools import assert_equals, assert_raises
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+import sheepdog
+from sheepdog import storage, serialisation
+
+
+class TestResults:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        args = serialisation.serialise_args([1, 2, 3, 4])
+        self.request_id = self.storage.new_request(b"f", b"ns", args)
+
+    def teardown(self):
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+
+    def store(self, job_index, result):
+        self.storage.store_result(self.request_id, job_index,
+                                  serialisation.serialise_pickle(result))
+
+    def test_iterates_results(self):
+        self.store(2, 20)
+        results = list(sheepdog.iter_results(self.request_id, self.dbfile,
+                                             start=1, stop=3))
+        assert_equals(results, [(1, 2, 20), (2, 3, None)])
+
+    def test_gets_range_of_results(self):
+        self.store(3, 30)
+        results = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, start=2, args=False)
+        assert_equals(results, [(None, 30), (None, None)])
+
+    def test_gets_args_without_results(self):
+        self.store(3, 30)
+        results = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, start=1, stop=3,
+                                       results=False)
+        assert_equals(results, [(2, None), (3, None)])
+
+    def test_waits_for_tasks_with_errors_and_results(self):
+        # The first copy of a speculated task fails, then its backup succeeds.
+        self.store(1, 10)
+        self.store(2, 20)
+        self.storage.store_error(self.request_id, 3, "oops")
+        self.store(3, 30)
+        self.storage.store_error(self.request_id, 4, "oops")
+        results = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=True, args=False)
+        assert_equals(results, [(None, 10), (None, 20), (None, 30),
+                                (None, None)])
+
+    def test_yields_as_completed(self):
+        self.store(3, 30)
+        self.storage.store_error(self.request_id, 2, "oops")
+        self.storage.store_error(self.request_id, 4, "oops")
+        self.store(1, 10)
+        results = list(sheepdog.as_completed(self.request_id, self.dbfile))
+        assert_equals(sorted(results, key=lambda r: r[0]),
+                      [(0, 1, 10), (1, 2, None), (2, 3, 30), (3, 4, None)])
+
+    def test_tracks_completion(self):
+        completion = sheepdog._Completion(2)
+        arg, result = (serialisation.serialise_pickle(x) for x in (1, 10))
+        assert_equals(completion.take([], []), None)
+        assert_equals(completion.take([(5, 1, arg, result)],
+                                      [(7, 1, arg, "oops")]),
+                      [(0, 1, 10)])
+        assert_equals((completion.last_result, completion.last_error), (5, 7))
+        assert not completion.finished
+        assert_equals(completion.take([], [(8, 2, arg, "oops")]),
+                      [(1, 1, None)])
+        assert completion.finished
+
+    def test_gets_status(self):
+        self.store(1, 10)
+        self.storage.mark_started(self.request_id, [2], lease=60)
+        assert_equals(sheepdog.get_status(self.request_id, self.dbfile),
+                      {"queued": 2, "running": 1, "stalled": 0, "lost": 0,
+                       "finished": 1})
+
+    def test_stacks_results(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        self.store(2, np.array([2.0, 20.0]))
+        self.store(4, np.array([4.0, 40.0]))
+        self.storage.store_error(self.request_id, 3, "oops")
+        stacked = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, start=1, stack=True)
+        assert_equals(stacked.shape, (3, 2))
+        assert_equals(stacked.mask[:, 0].tolist(), [False, True, False])
+        assert_equals(stacked[0].tolist(), [2.0, 20.0])
+        assert_equals(stacked[2].tolist(), [4.0, 40.0])
+
+    def test_stacks_tuples_into_structured_array(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        self.store(1, (1, 0.5))
+        self.store(3, (3, 1.5))
+        stacked = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, stack=True)
+        assert_equals(stacked.dtype.names, ("f0", "f1"))
+        assert_equals(stacked['f0'].tolist(), [1, None, 3, None])
+        assert_equals(stacked['f1'].tolist(), [0.5, None, 1.5, None])
+
+    def test_stacks_mixed_ints_and_floats(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        self.store(1, 1)
+        self.store(2, 2.5)
+        stacked = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, stop=2, stack=True)
+        assert_equals(stacked.tolist(), [1.0, 2.5])
+
+    def test_stacks_longer_strings_in_tuples(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        self.store(1, (1, 'ab'))
+        self.store(2, (2, 'abcdef'))
+        stacked = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, stop=2, stack=True)
+        assert_equals(stacked['f1'].tolist(), ['ab', 'abcdef'])
+
+    def test_doesnt_stack_wrong_shape(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        self.store(1, np.array([1.0, 2.0, 3.0]))
+        self.store(2, 7.0)
+        assert_raises(ValueError, sheepdog.get_results, self.request_id,
+                      self.dbfile, block=False, stack=True)
+
+    def test_stacks_no_results(self):
+        try:
+            import numpy as np
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        stacked = sheepdog.get_results(self.request_id, self.dbfile,
+                                       block=False, stack=True)
+        assert_equals(stacked.shape, (4,))
+        assert stacked.mask.all()
+
+
+@patch('sheepdog.get_deployer')
+@patch('sheepdog.get_server')
+class TestResubmit:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        args = serialisation.serialise_args([1, 2, 3, 4])
+        self.request_id = self.storage.new_request(b"f", b"ns", args)
+        self.storage.store_result(self.request_id, 1, b"ABC")
+        self.storage.store_error(self.request_id, 3, "oops")
+        self.config = {"host": "fake", "dbfile": self.dbfile}
+
+    def teardown(self):
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+
+    def deployed_job_file(self, get_deployer):
+        deployer = get_deployer.return_value
+        deployer.submit.assert_called_once_with(self.request_id, ".sheepdog")
+        return deployer.deploy.call_args[0][0]
+
+    def test_resubmits_missing(self, get_server, get_deployer):
+        get_server.return_value = Mock(port=1234)
+        n = sheepdog.resubmit(self.request_id, self.config)
+        assert_equals(n, 2)
+        assert "job_indices = [2, 4]" in self.deployed_job_file(get_deployer)
+        assert_equals(len(self.storage.get_errors(self.request_id)), 1)
+
+    def test_resubmits_errors(self, get_server, get_deployer):
+        get_server.return_value = Mock(port=1234)
+        n = sheepdog.resubmit(self.request_id, self.config, which="errors")
+        assert_equals(n, 1)
+        assert "job_indices = [3]" in self.deployed_job_file(get_deployer)
+        assert_equals(self.storage.get_errors(self.request_id), [])
+
+    def test_does_nothing_when_complete(self, get_server, get_deployer):
+        get_server.return_value = Mock(port=1234)
+        n = sheepdog.resubmit(self.request_id, self.config, which="errors")
+        n = sheepdog.resubmit(self.request_id, self.config, which="errors")
+        assert_equals(n, 0)
+        assert_equals(get_deployer.return_value.submit.call_count, 1)
+
+    def test_rejects_unknown_which(self, get_server, get_deployer):
+        with assert_raises(ValueError):
+            sheepdog.resubmit(self.request_id, self.config, which="all")
+
+
+@patch('sheepdog.get_deployer')
+@patch('sheepdog.get_server')
+class TestSpeculation:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        args = serialisation.serialise_args([1, 2, 3])
+        self.request_id = self.storage.new_request(b"f", b"ns", args)
+        self.config = {"host": "fake", "dbfile": self.dbfile,
+                       "speculate": 3.0, "workers": 2, "chunk_size": 5}
+
+    def teardown(self):
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+
+    def test_submits_backups_of_stragglers(self, get_server, get_deployer):
+        get_server.return_value = Mock(port=1234)
+        self.storage.mark_started(self.request_id, [1, 2, 3], lease=60)
+        self.storage.store_result(self.request_id, 1, b"ABC")
+        with patch.object(storage.Storage, 'get_stragglers',
+                          return_value=[2, 3]) as get_stragglers:
+            backed_up = set([3])
+            n = sheepdog.speculate_stragglers(self.request_id, self.config,
+                                              backed_up)
+            get_stragglers.assert_called_once_with(self.request_id, 3.0)
+        assert_equals(n, 1)
+        assert_equals(backed_up, set([2, 3]))
+        deployer = get_deployer.return_value
+        deployer.submit.assert_called_once_with(self.request_id, ".sheepdog")
+        job_file = deployer.deploy.call_args[0][0]
+        assert "job_indices = [2]" in job_file
+        assert "chunk = job_indices[position:position + 1]" in job_file
+        assert ".work()" not in job_file
+        # The originals keep running, so keep their leases.
+        assert_equals(self.storage.count_states(self.request_id)["running"],
+                      2)
+
+    def test_no_backups_without_stragglers(self, get_server, get_deployer):
+        n = sheepdog.speculate_stragglers(self.request_id, self.config)
+        assert_equals(n, 0)
+        assert not get_deployer.return_value.submit.called
+
+
+class TestSessionPassword:
+    def setup(self):
+        self.session_password = sheepdog.session_password
+        sheepdog.session_password = None
+
+    def teardown(self):
+        sheepdog.session_password = self.session_password
+
+    def test_chooses_one_password_across_threads(self):
+        passwords = []
+        threads = [threading.Thread(
+            target=lambda: passwords.append(sheepdog._get_session_password()))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equals(len(passwords), 8)
+        assert_equals(set(passwords), set([sheepdog.session_password]))
@@ -3,7 +3,7 @@
 #
 # Released under the MIT license. See LICENSE file for details.
 
-from sheepdog import job_file
+from sheepdog.job_file import job_file, runtime, get_memlimit
 
 class TestJobFile:
     def test_includes_client(self):
@@ -24,3 +24,63 @@ class TestJobFile:
 
     def test_array_job(self):
         assert "#$ -t 1-1000" in job_file("", "", 1, 1000, "", [])
+
+    def test_chunked_array_job(self):
+        jf = job_file("", "", 1, 1000, "", [], chunk_size=10)
+        assert "#$ -t 1-1000:10" in jf
+        assert "job_count = min(10, 1000 - job_index + 1)" in jf
+
+    def test_job_indices(self):
+        jf = job_file("", "", 1, 1000, "", [], chunk_size=2,
+                      job_indices=[3, 5, 8])
+        assert "#$ -t 1-3:2" in jf
+        assert "job_indices = [3, 5, 8]" in jf
+        assert "chunk = job_indices[position:position + 2]" in jf
+        assert "job_indices=chunk).go()" in jf
+        jf = job_file("", "", 1, 1000, "", [], workers=20,
+                      job_indices=[3, 5, 8])
+        assert "#$ -t 1-3\n" in jf
+
+    def test_worker_job(self):
+        jf = job_file("myurl", "mypass", 1, 1000, "", [], workers=20)
+        assert "#$ -t 1-20\n" in jf
+        assert "Client(\"myurl\", \"mypass\", 1, job_index," in jf
+        assert "cache_dir=cache_dir, compression=None,\n" in jf
+        assert "out_of_band=False, memlimit=None).work()" in jf
+
+    def test_cache_dir(self):
+        assert "cache_dir = None" in job_file("", "", 0, 1, "", [])
+        jf = job_file("", "", 0, 1, "", [], cache_dir=".sheepdog/cache")
+        assert "os.path.expanduser('~'), '.sheepdog/cache')" in jf
+
+    def test_compression(self):
+        jf = job_file("", "", 0, 1, "", [], compression="zlib")
+        assert "compression='zlib',\n" in jf
+
+    def test_out_of_band(self):
+        jf = job_file("", "", 0, 1, "", [], out_of_band=True)
+        assert "out_of_band=True, memlimit=None).go()" in jf
+
+    memlimit_tests = {
+        '123': 123, '3k': 3*1024, '5K': 5*1024,
+        '2M': 2*1024*1024, '2000m': 2000*1024*1024,
+        '1g': 1024*1024*1024, '8g': 8*1024*1024*1024,
+        '3t': 3*1024*1024*1024*1024, '1T': 1024*1024*1024*1024}
+
+    def test_gets_memlimit(self):
+        for key, value in self.memlimit_tests.items():
+            opts = ["-r y", "-l mem_grab={0}".format(key)]
+            assert get_memlimit(opts) == value
+        assert get_memlimit(["-r y"]) is None
+
+    def test_passes_memlimit(self):
+        jf = job_file("", "", 0, 1, "", ["-l mem_grab=2k"])
+        assert "memlimit=2048).go()" in jf
+
+    def test_imports_runtime(self):
+        name, code = runtime()
+        assert name.startswith("sheepdog_runtime_")
+        assert "Sheepdog's clientside code." in code
+        jf = job_file("", "", 0, 1, "", [], runtime_dir=".sheepdog")
+        assert "Sheepdog's clientside code." not in jf
+        assert "'.sheepdog'))\nfrom {0} import Client\n".format(name) in jf
@@ -4,6 +4,7 @@
 # Released under the MIT license. See LICENSE file for details.
 
 import base64
+import pickle
 from nose.tools import assert_equal, assert_true
 
 from sheepdog import serialisation
@@ -90,3 +91,48 @@ class TestSerialisation:
         p = base64.b64decode(s)
         proto = ord(p[1]) if type(p) is str else p[1]
         assert proto == 2
+
+    def test_converts_to_and_from_raw(self):
+        s = serialisation.serialise_pickle((1, 2, 3))
+        raw = serialisation.to_raw(s)
+        assert_equal(raw, serialisation.dump_pickle((1, 2, 3)))
+        assert_equal(serialisation.load_pickle(raw), (1, 2, 3))
+        assert_equal(serialisation.from_raw(raw), s)
+
+    def test_packs_frames(self):
+        header = {"job_index": 3, "tasks": [1, 2]}
+        payloads = [b"", b"abc", b"\x00" * 1000]
+        packed = serialisation.pack_frames(header, payloads)
+        assert_equal(type(packed), bytes)
+        assert_equal(serialisation.unpack_frames(packed), (header, payloads))
+        assert_equal(serialisation.unpack_frames(
+            serialisation.pack_frames({}, [])), ({}, []))
+
+    def test_pickles_out_of_band(self):
+        if not hasattr(pickle, 'PickleBuffer'):
+            return
+        data = b"x" * 1000
+        obj = {"buf": pickle.PickleBuffer(data), "n": 1}
+        raw = serialisation.dump_pickle(obj, out_of_band=True)
+        assert raw.startswith(serialisation.OUT_OF_BAND)
+        loaded = serialisation.load_pickle(raw)
+        assert_equal(loaded["n"], 1)
+        assert_equal(bytes(loaded["buf"]), data)
+        assert isinstance(loaded["buf"], memoryview)
+
+        serialised = serialisation.serialise_pickle(obj, out_of_band=True)
+        loaded = serialisation.deserialise_pickle(serialised)
+        assert_equal(bytes(loaded["buf"]), data)
+
+    def test_pickles_in_band_without_buffers(self):
+        raw = serialisation.dump_pickle([1, 2], out_of_band=True)
+        assert not raw.startswith(serialisation.OUT_OF_BAND)
+        assert_equal(serialisation.load_pickle(raw), [1, 2])
+
+    def test_compresses(self):
+        data = b"sheepdog" * 1000
+        assert_true("zlib" in serialisation.compressors)
+        for method in serialisation.compressors:
+            c = serialisation.compress(data, method)
+            assert_true(len(c) < len(data))
+            assert_equal(serialisation.decompress(c, method), data)
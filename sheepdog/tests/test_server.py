@@ -7,7 +7,9 @@ import os
 import json
 import time
 import base64
+import shutil
 import tempfile
+from multiprocessing import Process
 from nose.tools import assert_equals, assert_raises
 
 # The lengths I'll go to to avoid having any dependencies in the client code.
@@ -37,13 +39,16 @@ class TestServer:
         self.app = server.app.test_client()
 
     def teardown(self):
+        server.app.config['PROGRESS'] = None
+        server.app.config['METRICS'] = None
         del self.server
         os.close(self.db_fd)
         os.unlink(self.dbfile)
 
-    def authenticated_request(self, method, url, data=None):
+    def authenticated_request(self, method, url, data=None, headers=None):
         authstr = base64.b64encode(("sheepdog:" + self.password).encode())
         authhdr = {"Authorization": "Basic " + authstr.decode()}
+        authhdr.update(headers or {})
         return self.app.open(url, method=method, data=data, headers=authhdr)
 
     def get(self, url):
@@ -58,6 +63,166 @@ class TestServer:
         assert response['func'] == "myfunc"
         assert response['args'] == "b"
 
+    def test_gets_chunk_config(self):
+        response = self.get('/?request_id=1&job_index=2&job_count=5')
+        response = json.loads(response.data.decode())
+        assert response['func'] == "myfunc"
+        assert response['args'] == "b"
+        assert response['tasks'] == [[2, "b"], [3, "c"]]
+
+    def test_gets_config_for_job_indices(self):
+        response = self.get('/?request_id=1&job_index=1&job_indices=1,3')
+        response = json.loads(response.data.decode())
+        assert response['args'] == "a"
+        assert response['tasks'] == [[1, "a"], [3, "c"]]
+
+    def test_marks_tasks_started(self):
+        self.get('/?request_id=1&job_index=2')
+        c = self.storage.conn.cursor()
+        c.execute("SELECT job_index FROM tasks WHERE started IS NOT NULL")
+        assert c.fetchall() == [(2,)]
+
+    def test_leases_chunks_without_start_times(self):
+        self.get('/?request_id=1&job_index=2&job_count=5')
+        c = self.storage.conn.cursor()
+        c.execute("SELECT job_index FROM tasks WHERE started IS NOT NULL")
+        assert c.fetchall() == []
+        assert self.storage.count_states(1)["running"] == 2
+
+    def test_renews_leases_on_heartbeat(self):
+        response = self.post('/heartbeat', dict(request_id=1,
+                                                job_indices="1,3"))
+        assert response.data == b"OK"
+        states = self.storage.count_states(1)
+        assert states["running"] == 2 and states["queued"] == 1
+
+    def test_gets_config_blob_hashes(self):
+        response = self.get('/?request_id=1&job_index=2&blobs=1')
+        response = json.loads(response.data.decode())
+        assert 'func' not in response
+        assert response['func_hash'] == storage.blob_hash(b"myfunc")
+        assert response['ns_hash'] == storage.blob_hash(b"ns")
+        assert response['args'] == "b"
+
+    def test_gets_blob(self):
+        func_hash = storage.blob_hash(b"myfunc")
+        response = self.get('/blob/' + func_hash)
+        assert response.status_code == 200
+        assert response.data == b"myfunc"
+        assert response.headers['ETag'] == '"{0}"'.format(func_hash)
+
+    def test_gets_external_blob(self):
+        threshold = storage.EXTERNAL_THRESHOLD
+        storage.EXTERNAL_THRESHOLD = 8
+        try:
+            big = b"0123456789"
+            request_id = self.storage.new_request(b"f", b"ns", [big])
+            content_hash = storage.blob_hash(big)
+            response = self.get('/?request_id={0}&job_index=1&blobs=1'
+                                .format(request_id))
+            result = json.loads(response.data.decode())
+            assert_equals(result['args'], "@blob:" + content_hash)
+            response = self.get('/blob/' + content_hash)
+            assert response.status_code == 200
+            assert response.data == big
+            assert response.headers['ETag'] == '"{0}"'.format(content_hash)
+        finally:
+            storage.EXTERNAL_THRESHOLD = threshold
+            shutil.rmtree(self.dbfile + ".blobs", ignore_errors=True)
+
+    def test_gets_blob_not_modified(self):
+        func_hash = storage.blob_hash(b"myfunc")
+        authstr = base64.b64encode(("sheepdog:" + self.password).encode())
+        headers = {"Authorization": "Basic " + authstr.decode(),
+                   "If-None-Match": '"{0}"'.format(func_hash)}
+        response = self.app.get('/blob/' + func_hash, headers=headers)
+        assert response.status_code == 304
+        assert response.data == b""
+
+    def test_gets_missing_blob(self):
+        response = self.get('/blob/' + "0" * 64)
+        assert response.status_code == 404
+
+    def test_gets_binary_config(self):
+        self.storage.new_request(b"f", b"ns", [serialisation.serialise_pickle(
+                                 x) for x in ("a", "b", "c")])
+        response = self.authenticated_request(
+            'GET', '/?request_id=2&job_index=2&job_count=5',
+            headers={"Accept": server.BINARY})
+        assert response.mimetype == server.BINARY
+        header, payloads = serialisation.unpack_frames(response.data)
+        assert header == {"func": "f", "ns": "ns", "tasks": [2, 3]}
+        assert [serialisation.load_pickle(p) for p in payloads] == ["b", "c"]
+
+    def test_submits_binary_result(self):
+        result = serialisation.dump_pickle(123)
+        data = serialisation.pack_frames(
+            {"request_id": 1, "job_index": 2}, [result])
+        response = self.authenticated_request(
+            'POST', '/', data=data, headers={"Content-Type": server.BINARY})
+        assert response.data == b"OK"
+        assert self.storage.get_results(1) == [
+            (b"b", serialisation.from_raw(result))]
+
+    def test_submits_binary_batch(self):
+        result = serialisation.dump_pickle(123)
+        data = serialisation.pack_frames(
+            {"request_id": 1, "results": [3], "errors": [[1, "oops"]]},
+            [result])
+        response = self.authenticated_request(
+            'POST', '/batch', data=data,
+            headers={"Content-Type": server.BINARY})
+        assert response.data == b"OK"
+        assert self.storage.get_results(1) == [
+            (b"c", serialisation.from_raw(result))]
+        assert self.storage.get_errors(1) == [(b"a", "oops")]
+
+    def test_binary_next_task(self):
+        self.storage.new_request(b"f", b"ns", [serialisation.serialise_pickle(
+                                 x) for x in ("a", "b")])
+        binary = {"Content-Type": server.BINARY, "Accept": server.BINARY}
+        data = serialisation.pack_frames({"request_id": 2}, [])
+        response = self.authenticated_request('POST', '/next', data=data,
+                                              headers=binary)
+        header, payloads = serialisation.unpack_frames(response.data)
+        assert header == {"job_index": 1}
+        assert serialisation.load_pickle(payloads[0]) == "a"
+        data = serialisation.pack_frames({"request_id": 2, "job_index": 1},
+                                         [serialisation.dump_pickle(1)])
+        self.authenticated_request('POST', '/next', data=data, headers=binary)
+        response = self.authenticated_request('POST', '/next', data=data,
+                                              headers=binary)
+        assert serialisation.unpack_frames(response.data) == (
+            {"job_index": None}, [])
+        assert self.storage.count_results(2) == 1
+
+    def test_compresses_responses(self):
+        args = serialisation.serialise_pickle("x" * 10000)
+        self.storage.new_request(b"f", b"ns", [args])
+        headers = {server.ACCEPT_COMPRESSION: "nonsense,zlib"}
+        response = self.authenticated_request(
+            'GET', '/?request_id=2&job_index=1', headers=headers)
+        assert response.headers[server.COMPRESSION] == "zlib"
+        assert "zlib" in response.headers[server.ACCEPT_COMPRESSION]
+        data = serialisation.decompress(response.data, "zlib")
+        assert json.loads(data.decode())['args'] == args.decode()
+
+        response = self.authenticated_request(
+            'GET', '/?request_id=1&job_index=1', headers=headers)
+        assert server.COMPRESSION not in response.headers
+        assert json.loads(response.data.decode())['args'] == "a"
+
+    def test_decompresses_requests(self):
+        data = serialisation.pack_frames(
+            {"request_id": 1, "job_index": 2}, [b"x" * 10000])
+        response = self.authenticated_request(
+            'POST', '/', data=serialisation.compress(data, "zlib"),
+            headers={"Content-Type": server.BINARY,
+                     server.COMPRESSION: "zlib"})
+        assert response.data == b"OK"
+        assert self.storage.get_results(1) == [
+            (b"b", serialisation.from_raw(b"x" * 10000))]
+
     def test_submits_result(self):
         result = b"abc"
         response = self.post(
@@ -72,6 +237,73 @@ class TestServer:
         assert response.data == b"OK"
         assert self.storage.get_errors(1) == [(b"b", error)]
 
+    def test_submits_batch(self):
+        data = json.dumps({"request_id": 1, "results": [[1, "abc"]],
+                           "errors": [[3, "oops"]]})
+        response = self.post('/batch', data=data)
+        assert response.data == b"OK"
+        assert self.storage.get_results(1) == [(b"a", b"abc")]
+        assert self.storage.get_errors(1) == [(b"c", "oops")]
+
+    def test_reports_progress(self):
+        progress = server.Progress()
+        server.app.config['PROGRESS'] = progress
+        self.post('/', data=dict(request_id=1, job_index=1, result="abc"))
+        assert_equals(progress.value, 1)
+        data = json.dumps({"request_id": 1, "results": [[2, "abc"]],
+                           "errors": [[3, "oops"]]})
+        self.post('/batch', data=data)
+        assert_equals(progress.value, 3)
+        self.post('/next', data=dict(request_id=1))
+        assert_equals(progress.value, 3)
+
+    def test_next_task(self):
+        response = self.post('/next', data=dict(request_id=1))
+        assert json.loads(response.data.decode()) == {"job_index": 1,
+                                                      "args": "a"}
+        response = self.post('/next', data=dict(request_id=1, job_index=1,
+                                                result="abc"))
+        assert json.loads(response.data.decode()) == {"job_index": 2,
+                                                      "args": "b"}
+        response = self.post('/next', data=dict(request_id=1, job_index=2,
+                                                error="oops"))
+        assert json.loads(response.data.decode())['job_index'] == 3
+        response = self.post('/next', data=dict(request_id=1, job_index=3,
+                                                result="ghi"))
+        assert json.loads(response.data.decode()) == {"job_index": None}
+        assert self.storage.get_results(1) == [(b"a", b"abc"), (b"c", b"ghi")]
+        assert self.storage.get_errors(1) == [(b"b", "oops")]
+
+    def test_next_task_leases_until_next_heartbeat(self):
+        self.post('/next', data=dict(request_id=1))
+        c = self.storage.conn.cursor()
+        c.execute("SELECT lease_expires FROM tasks WHERE job_index=1")
+        assert c.fetchone()[0] <= time.time() + server.HEARTBEAT_LEASE
+
+    def test_gets_metrics(self):
+        server.app.config['METRICS'] = server.Metrics()
+        self.post('/', {'request_id': 1, 'job_index': 1, 'result': 'abc'})
+        self.post('/error', {'request_id': 1, 'job_index': 2,
+                             'error': 'oops'})
+        response = self.get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        lines = response.data.decode().splitlines()
+        assert 'sheepdog_requests_total{endpoint="submit_result"} 1' in lines
+        assert 'sheepdog_requests_total{endpoint="report_error"} 1' in lines
+        assert ('sheepdog_request_duration_seconds_count'
+                '{endpoint="submit_result"} 1') in lines
+        assert ('sheepdog_request_duration_seconds_bucket'
+                '{endpoint="report_error",le="+Inf"} 1') in lines
+        assert 'sheepdog_db_commit_duration_seconds_count 2' in lines
+        assert 'sheepdog_requests_in_flight 1' in lines
+        assert 'sheepdog_tasks{request_id="1",state="results"} 1' in lines
+        assert 'sheepdog_tasks{request_id="1",state="errors"} 1' in lines
+        assert 'sheepdog_tasks{request_id="1",state="pending"} 1' in lines
+
+    def test_metrics_require_password(self):
+        assert self.app.get('/metrics').status_code == 401
+
     def test_requires_password(self):
         response = self.app.get('/?request_id=1&job_index=2')
         assert response.status_code == 401
@@ -105,6 +337,23 @@ class TestServer:
         result = json.loads(response.read().decode())
         assert result['args'] == "b"
 
+    def test_runs_server_without_native_handlers(self):
+        if not server.USE_TORNADO:
+            return
+        del self.server
+        make_application = server.make_application
+        server.make_application = None
+        try:
+            self.server = server.Server(self.port, self.password, self.dbfile)
+        finally:
+            server.make_application = make_application
+        url = "http://localhost:{0}/?request_id=1&job_index=2".format(
+            self.port)
+        userpass = ("sheepdog:" + self.password).encode()
+        authstr = "Basic " + base64.b64encode(userpass).decode()
+        response = urlopen(Request(url, headers={"Authorization": authstr}))
+        assert json.loads(response.read().decode())['args'] == "b"
+
     def test_runs_on_some_port(self):
         del self.server
         self.server = server.Server(None, self.password, self.dbfile)
@@ -149,6 +398,15 @@ class TestServer:
         if tries == 30:
             raise RuntimeError("Could not connect to server after 30 tries.")
 
+    def test_finds_server_progress(self):
+        assert server.get_progress(self.dbfile) is None
+        port = server._get_free_port()
+        srv = server.get_server(port, self.password, self.dbfile)
+        try:
+            assert server.get_progress(self.dbfile) is srv.progress
+        finally:
+            del server._servers[port]
+
     def test_keeps_global_servers(self):
         port1 = server._get_free_port()
         server1 = server.get_server(port1, self.password, self.dbfile)
@@ -163,3 +421,69 @@ class TestServer:
             server.get_server(port2, self.password + "_", self.dbfile + "_")
         with assert_raises(RuntimeError):
             server.get_server(port2, self.password + "_", self.dbfile)
+
+
+class TestMetrics:
+    def test_fills_histogram_buckets(self):
+        metrics = server.Metrics()
+        metrics.observe_request("next_task", 0.003, 10, 20)
+        metrics.observe_request("next_task", 0.3, 10, 20)
+        metrics.observe_request("next_task", 60, 10, 20)
+        metrics.observe_request("not_an_endpoint", 0.003, 1, 2)
+        lines = metrics.render()
+        name = "sheepdog_request_duration_seconds"
+        assert name + '_bucket{endpoint="next_task",le="0.001"} 0' in lines
+        assert name + '_bucket{endpoint="next_task",le="0.005"} 1' in lines
+        assert name + '_bucket{endpoint="next_task",le="0.5"} 2' in lines
+        assert name + '_bucket{endpoint="next_task",le="5.0"} 2' in lines
+        assert name + '_bucket{endpoint="next_task",le="+Inf"} 3' in lines
+        assert name + '_count{endpoint="next_task"} 3' in lines
+        assert 'sheepdog_requests_total{endpoint="other"} 1' in lines
+        assert "sheepdog_received_bytes_total 31" in lines
+        assert "sheepdog_sent_bytes_total 62" in lines
+
+    def test_counts_across_processes(self):
+        metrics = server.Metrics()
+        p = Process(target=metrics.observe_commit, args=(0.02,))
+        p.start()
+        p.join()
+        lines = metrics.render()
+        assert "sheepdog_db_commit_duration_seconds_count 1" in lines
+
+
+class TestProgress:
+    def test_counts(self):
+        progress = server.Progress()
+        assert_equals(progress.value, 0)
+        progress.add(2)
+        assert_equals(progress.value, 2)
+
+    def test_wait_times_out(self):
+        progress = server.Progress()
+        start = time.time()
+        assert_equals(progress.wait(0, 0.1), 0)
+        assert time.time() - start >= 0.1
+
+    def test_wait_returns_if_changed(self):
+        progress = server.Progress()
+        progress.add(1)
+        start = time.time()
+        assert_equals(progress.wait(0, 10), 1)
+        assert time.time() - start < 1
+
+    def test_wait_wakes_across_processes(self):
+        def add_later(progress):
+            time.sleep(0.1)
+            progress.add(1)
+        progress = server.Progress()
+        proc = Process(target=add_later, args=(progress,))
+        proc.start()
+        start = time.time()
+        assert_equals(progress.wait(0, 10), 1)
+        assert time.time() - start < 5
+        proc.join()
+
+    def test_wait_for_progress_sleeps_without_server(self):
+        start = time.time()
+        server.wait_for_progress(None, None, 0.1)
+        assert time.time() - start >= 0.1
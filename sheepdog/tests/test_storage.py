@@ -3,7 +3,11 @@
 #
 # Released under the MIT license. See LICENSE file for details.
 
+import os
+import time
+import shutil
 import sqlite3
+import tempfile
 from nose.tools import assert_equals, assert_raises
 
 from sheepdog import storage
@@ -25,6 +29,53 @@ class TestStorage:
         assert ("results",) in names
         assert ("tasks",) in names
 
+    def test_creates_indexes(self):
+        self.c.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        names = self.c.fetchall()
+        assert ("tasks_request_job",) in names
+        assert ("results_task",) in names
+        assert ("errors_task",) in names
+        assert ("tasks_args_hash",) in names
+
+    def test_sets_schema_version(self):
+        self.c.execute("PRAGMA user_version")
+        assert_equals(self.c.fetchone()[0], storage.SCHEMA_VERSION)
+
+    def test_migrates_old_databases(self):
+        old = storage.Storage(dbfile=":memory:")
+        c = old.conn.cursor()
+        c.executescript("""
+            CREATE TABLE requests (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                function BLOB, namespace BLOB, date_submitted TEXT);
+            CREATE TABLE tasks (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                request_id INTEGER, job_index INTEGER, args BLOB);
+            CREATE TABLE results (id INTEGER PRIMARY KEY, task_id INTEGER,
+                result BLOB);
+            CREATE TABLE errors (id INTEGER PRIMARY KEY, task_id INTEGER,
+                error TEXT);
+        """)
+        c.execute("INSERT INTO requests VALUES (1, ?, ?, '2015-01-01')",
+                  (sqlite3.Binary(b"f"), sqlite3.Binary(b"ns")))
+        c.execute("INSERT INTO tasks VALUES (1, 1, 1, ?)",
+                  (sqlite3.Binary(b"a"),))
+        c.executemany("INSERT INTO results VALUES (?, 1, ?)",
+                      [(1, sqlite3.Binary(b"first")),
+                       (2, sqlite3.Binary(b"second"))])
+        c.execute("INSERT INTO errors VALUES (1, 1, 'oops')")
+        old.conn.commit()
+        old.initdb()
+        assert_equals(old.get_results(1), [(b"a", b"first")])
+        assert_equals(c.execute("SELECT * FROM errors").fetchall(),
+                      [(1, 1, "oops")])
+        c.execute("SELECT sql FROM sqlite_master WHERE name='errors'")
+        assert "AUTOINCREMENT" in c.fetchone()[0]
+        assert_equals(old.get_hashes(1), (None, None))
+        assert_equals(old.claim_task(1, 60), None)
+        old.mark_started(1, [1])
+        assert_equals(old.get_stragglers(1, 2.0, min_finished=1), [])
+        c.execute("PRAGMA user_version")
+        assert_equals(c.fetchone()[0], storage.SCHEMA_VERSION)
+
     def add_request(self):
         f = b"i'm a function!"
         ns = b"a namespace!"
@@ -55,6 +106,26 @@ class TestStorage:
         details = self.storage.get_details(reqid, 2)
         assert_equals(details, (f, ns, args[1]))
 
+    def test_gets_hashes_and_blobs(self):
+        f, ns, args, reqid = self.add_request()
+
+        hashes = self.storage.get_hashes(reqid)
+        assert_equals(hashes, (storage.blob_hash(f), storage.blob_hash(ns)))
+        assert_equals(self.storage.get_blob(hashes[0]), f)
+        assert_equals(self.storage.get_blob(hashes[1]), ns)
+        assert_raises(ValueError, self.storage.get_blob, "0" * 64)
+        assert_raises(ValueError, self.storage.get_hashes, reqid + 1)
+
+    def test_caches_details(self):
+        self.storage.cache = storage.LRUCache(1024)
+        f, ns, args, reqid = self.add_request()
+        self.storage.get_details(reqid, 2)
+
+        self.c.execute("UPDATE requests SET function=NULL, namespace=NULL")
+        self.c.execute("UPDATE tasks SET id=id+100")
+        assert_equals(self.storage._get_task_id(reqid, 2), 2)
+        assert_equals(self.storage.get_details(reqid, 2)[:2], (f, ns))
+
     def test_error_no_details(self):
         f, ns, args, reqid = self.add_request()
         
@@ -64,6 +135,70 @@ class TestStorage:
         assert_raises(ValueError, self.storage.get_details, invalid_reqid, 2)
         assert_raises(ValueError, self.storage.get_details, reqid, invalid_job)
 
+    def test_gets_chunk_details(self):
+        f, ns, args, reqid = self.add_request()
+
+        details = self.storage.get_chunk_details(reqid, 2, 5)
+        assert_equals(details, (f, ns, [(2, args[1]), (3, args[2])]))
+
+    def test_gets_tasks_details(self):
+        f, ns, args, reqid = self.add_request()
+
+        details = self.storage.get_tasks_details(reqid, [3, 1])
+        assert_equals(details, (f, ns, [(1, args[0]), (3, args[2])]))
+        assert_raises(ValueError, self.storage.get_tasks_details, reqid, [9])
+
+    def test_memoizes_results(self):
+        f, ns, args, reqid = self.add_request()
+        self.storage.store_result(reqid, 1, b"ABC")
+        self.storage.store_result(reqid, 3, b"GEH")
+        self.storage.store_error(reqid, 2, "oops")
+
+        new_reqid = self.storage.new_request(f, ns, [b"geh", b"new", b"abc"])
+        assert_equals(self.storage.memoize(new_reqid), [2])
+        assert_equals(self.storage.get_results(new_reqid),
+                      [(b"geh", b"GEH"), (b"abc", b"ABC")])
+
+    def test_memoizes_only_same_function_and_namespace(self):
+        f, ns, args, reqid = self.add_request()
+        self.store_results(reqid)
+        other_f = self.storage.new_request(b"other", ns, args)
+        other_ns = self.storage.new_request(f, b"other", args)
+        assert_equals(self.storage.memoize(other_f), [1, 2, 3])
+        assert_equals(self.storage.memoize(other_ns), [1, 2, 3])
+
+    def test_error_no_chunk_details(self):
+        f, ns, args, reqid = self.add_request()
+
+        assert_raises(ValueError, self.storage.get_chunk_details,
+                      reqid + 1, 1, 2)
+        assert_raises(ValueError, self.storage.get_chunk_details,
+                      reqid, len(args) + 1, 2)
+
+    def test_claims_tasks(self):
+        f, ns, args, reqid = self.add_request()
+        self.storage.store_result(reqid, 1, b"ABC")
+
+        assert_equals(self.storage.claim_task(reqid, 60), (2, args[1]))
+        assert_equals(self.storage.claim_task(reqid, 60), (3, args[2]))
+        assert_equals(self.storage.claim_task(reqid, 60), None)
+
+    def test_reclaims_expired_tasks(self):
+        f, ns, args, reqid = self.add_request()
+        self.storage.store_result(reqid, 1, b"ABC")
+        self.storage.store_error(reqid, 3, "oops")
+
+        assert_equals(self.storage.claim_task(reqid, -1), (2, args[1]))
+        assert_equals(self.storage.claim_task(reqid, 60), (2, args[1]))
+        assert_equals(self.storage.claim_task(reqid, 60), None)
+
+    def test_adds_missing_columns(self):
+        self.c.execute("CREATE TABLE old (id INTEGER PRIMARY KEY)")
+        self.storage._add_column("old", "new", "REAL")
+        self.storage._add_column("old", "new", "REAL")
+        self.c.execute("PRAGMA table_info(old)")
+        assert_equals([r[1] for r in self.c.fetchall()], ["id", "new"])
+
     def store_results(self, request_id):
         results = [b"ABC", b"DEF", b"GEH"]
         for idx, result in enumerate(results):
@@ -93,6 +228,179 @@ class TestStorage:
         r = self.c.fetchone()
         assert_equals(r[1], 2)
 
+    def test_stores_batch(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_batch(request_id, [(1, b"ABC"), (3, b"GEH")],
+                                 [(2, "oops")])
+
+        r = self.storage.get_tasks_with_results(request_id)
+        assert_equals(r, list(zip(args, [b"ABC", None, b"GEH"])))
+        r = self.storage.get_errors(request_id)
+        assert_equals(r, [(args[1], "oops")])
+
+    def test_stores_group(self):
+        f, ns, args, request_id = self.add_request()
+        other_id = self.storage.new_request(f, ns, args)
+        self.storage.store_group([(request_id, [(1, b"ABC")], []),
+                                  (other_id, [(2, b"DEF")], [(3, "oops")])])
+
+        r = self.storage.get_tasks_with_results(request_id)
+        assert_equals(r, list(zip(args, [b"ABC", None, None])))
+        r = self.storage.get_tasks_with_results(other_id)
+        assert_equals(r, list(zip(args, [None, b"DEF", None])))
+        assert_equals(self.storage.get_errors(other_id), [(args[2], "oops")])
+
+    def test_iterates_pages_of_tasks_with_results(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 2, b"DEF")
+        r = list(self.storage.iter_tasks_with_results(request_id, page_size=2))
+        assert_equals(r, [(1, args[0], None), (2, args[1], b"DEF"),
+                          (3, args[2], None)])
+
+    def test_iterates_range_of_tasks(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 2, b"DEF")
+        r = list(self.storage.iter_tasks_with_results(request_id, 2, 3))
+        assert_equals(r, [(2, args[1], b"DEF")])
+        r = list(self.storage.iter_tasks_with_results(request_id, start=2,
+                                                      page_size=1))
+        assert_equals(r, [(2, args[1], b"DEF"), (3, args[2], None)])
+
+    def test_iterates_projected_tasks(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 2, b"DEF")
+        r = list(self.storage.iter_tasks_with_results(request_id, args=False))
+        assert_equals(r, [(1, None, None), (2, None, b"DEF"), (3, None, None)])
+        r = list(self.storage.iter_tasks_with_results(request_id,
+                                                      results=False))
+        assert_equals(r, [(1, args[0], None), (2, args[1], None),
+                          (3, args[2], None)])
+
+    def test_counts_unfinished(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 1, b"ABC")
+        self.storage.store_error(request_id, 3, "oops")
+        assert_equals(self.storage.count_unfinished(request_id), 1)
+        assert_equals(self.storage.count_unfinished(request_id, 3), 0)
+        assert_equals(self.storage.count_unfinished(request_id, 1, 3), 1)
+
+    def test_finds_stragglers(self):
+        f, ns, args, request_id = self.add_request()
+        now = time.time()
+        self.c.executemany("UPDATE tasks SET started=? WHERE job_index=?",
+                           [(now - 10, 1), (now - 10, 2), (now - 100, 3)])
+        self.db.commit()
+        self.storage.store_result(request_id, 1, b"ABC")
+        assert_equals(self.storage.get_stragglers(request_id, 5.0), [])
+        assert_equals(self.storage.get_stragglers(request_id, 5.0,
+                                                  min_finished=1), [3])
+        assert_equals(self.storage.get_stragglers(request_id, 50.0,
+                                                  min_finished=1), [])
+        # A backup copy starting doesn't reset the original's start time.
+        self.storage.mark_started(request_id, [3])
+        assert_equals(self.storage.get_stragglers(request_id, 5.0,
+                                                  min_finished=1), [3])
+        self.storage.reset_tasks(request_id, [3])
+        assert_equals(self.storage.get_stragglers(request_id, 5.0,
+                                                  min_finished=1), [])
+
+    def test_counts_states(self):
+        f, ns, args, request_id = self.add_request()
+        other_id = self.storage.new_request(f, ns, args)
+        now = time.time()
+        self.storage.store_group([(request_id, [(1, b"ABC")], [])], [
+            (request_id, 1, now + 60), (request_id, 2, now + 60),
+            (request_id, 3, now - 60), (other_id, 1, now - 6000)])
+        assert_equals(self.storage.count_states(request_id),
+                      {"queued": 0, "running": 1, "stalled": 1, "lost": 0,
+                       "finished": 1})
+        assert_equals(self.storage.count_states(request_id, lost_after=30),
+                      {"queued": 0, "running": 1, "stalled": 0, "lost": 1,
+                       "finished": 1})
+        assert_equals(self.storage.count_states(other_id),
+                      {"queued": 2, "running": 0, "stalled": 0, "lost": 1,
+                       "finished": 0})
+
+    def test_marks_started_with_lease(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.mark_started(request_id, [1], lease=60)
+        self.storage.mark_started(request_id, [2])
+        assert_equals(self.storage.count_states(request_id)["running"], 1)
+        assert_equals(self.storage.claim_task(request_id, 60)[0], 2)
+
+    def test_marks_leased_without_start_time(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.mark_started(request_id, [1, 2], lease=60, started=False)
+        assert_equals(self.storage.count_states(request_id)["running"], 2)
+        self.c.execute("SELECT started FROM tasks")
+        assert_equals(self.c.fetchall(), [(None,)] * 3)
+
+    def test_counts_by_request(self):
+        f, ns, args, request_id = self.add_request()
+        other_id = self.storage.new_request(f, ns, args)
+        self.storage.store_result(request_id, 1, b"ABC")
+        self.storage.store_error(request_id, 2, "oops")
+        self.storage.store_error(other_id, 3, "oops")
+        self.storage.store_result(other_id, 3, b"ABC")
+        assert_equals(self.storage.count_by_request(),
+                      [(other_id, 1, 0, 2), (request_id, 1, 1, 1)])
+        assert_equals(self.storage.count_by_request(limit=1),
+                      [(other_id, 1, 0, 2)])
+
+    def test_times_commits(self):
+        f, ns, args, request_id = self.add_request()
+        times = []
+        self.storage.on_commit = times.append
+        self.storage.store_result(request_id, 1, b"ABC")
+        self.storage.store_batch(request_id, [(2, b"DEF")], [(3, "oops")])
+        assert_equals(len(times), 2)
+        assert all(t >= 0 for t in times)
+
+    def test_gets_missing_and_failed(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 1, b"ABC")
+        self.storage.store_error(request_id, 2, "oops")
+        assert_equals(self.storage.get_missing(request_id), [3])
+        assert_equals(self.storage.get_failed(request_id), [2])
+
+    def test_resets_tasks(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_error(request_id, 1, "oops")
+        self.storage.store_error(request_id, 1, "oops again")
+        self.storage.claim_task(request_id, 3600)
+        assert_equals(self.storage.claim_task(request_id, 3600)[0], 3)
+        self.storage.reset_tasks(request_id, [1, 2])
+        assert_equals(self.storage.get_errors(request_id), [])
+        assert_equals(self.storage.get_missing(request_id), [1, 2, 3])
+        assert_equals(self.storage.claim_task(request_id, 3600)[0], 1)
+
+    def test_never_reuses_error_ids(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_error(request_id, 1, "oops")
+        self.storage.store_error(request_id, 2, "oops")
+        last_error = self.storage.get_new_errors(request_id)[-1][0]
+        self.storage.reset_tasks(request_id, [1, 2])
+        self.storage.store_error(request_id, 3, "oops")
+        r = self.storage.get_new_errors(request_id, last_error)
+        assert_equals([row[1:] for row in r], [(3, args[2], "oops")])
+
+    def test_ignores_duplicate_results(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 1, b"ABC")
+        self.storage.store_result(request_id, 1, b"XYZ")
+        self.storage.store_batch(request_id, [(1, b"DEF")], [])
+
+        assert_equals(self.storage.get_results(request_id),
+                      [(args[0], b"ABC")])
+
+    def test_ignores_errors_after_results(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 1, b"ABC")
+        self.storage.store_error(request_id, 1, "oops")
+        self.storage.store_batch(request_id, [(2, b"DEF")], [(1, "oops"),
+                                                             (2, "oops")])
+        assert_equals(self.storage.get_errors(request_id), [])
+
     def test_gets_results(self):
         f, ns, args, request_id = self.add_request()
         results = self.store_results(request_id)
@@ -107,6 +415,27 @@ class TestStorage:
         r = self.storage.get_tasks_with_results(request_id)
         assert_equals(r, list(zip(args, results + [None] * len(errors))))
 
+    def test_gets_new_results(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_result(request_id, 3, b"GEH")
+        self.storage.store_result(request_id, 1, b"ABC")
+
+        r = self.storage.get_new_results(request_id)
+        assert_equals([row[1:] for row in r],
+                      [(3, args[2], b"GEH"), (1, args[0], b"ABC")])
+        assert_equals(self.storage.get_new_results(request_id, r[-1][0]), [])
+        self.storage.store_result(request_id, 2, b"DEF")
+        r = self.storage.get_new_results(request_id, r[-1][0])
+        assert_equals([row[1:] for row in r], [(2, args[1], b"DEF")])
+
+    def test_gets_new_errors(self):
+        f, ns, args, request_id = self.add_request()
+        self.storage.store_error(request_id, 2, "oops")
+
+        r = self.storage.get_new_errors(request_id)
+        assert_equals([row[1:] for row in r], [(2, args[1], "oops")])
+        assert_equals(self.storage.get_new_errors(request_id, r[-1][0]), [])
+
     def test_stores_errors(self):
         f, ns, args, request_id = self.add_request()
         results, errors = self.store_results_and_errors(request_id)
@@ -150,3 +479,83 @@ class TestStorage:
     def test_counts_tasks(self):
         f, ns, args, request_id = self.add_request()
         assert_equals(self.storage.count_tasks(request_id), len(args))
+
+
+class TestExternalBlobs:
+    def setup(self):
+        self.db_fd, self.dbfile = tempfile.mkstemp()
+        self.storage = storage.Storage(dbfile=self.dbfile)
+        self.storage.initdb()
+        self.threshold = storage.EXTERNAL_THRESHOLD
+        storage.EXTERNAL_THRESHOLD = 8
+        self.big = b"0123456789"
+        self.request_id = self.storage.new_request(b"f", b"ns",
+                                                   [b"small", self.big])
+
+    def teardown(self):
+        storage.EXTERNAL_THRESHOLD = self.threshold
+        os.close(self.db_fd)
+        os.unlink(self.dbfile)
+        shutil.rmtree(self.dbfile + ".blobs", ignore_errors=True)
+
+    def test_stores_big_args_externally(self):
+        ref = storage.BLOB_REF + storage.blob_hash(self.big).encode()
+        c = self.storage.conn.cursor()
+        c.execute("SELECT args FROM tasks ORDER BY job_index")
+        assert_equals([bytes(r[0]) for r in c.fetchall()], [b"small", ref])
+        path = self.storage.blob_path(storage.blob_hash(self.big))
+        with open(path, "rb") as f:
+            assert_equals(f.read(), self.big)
+
+    def test_loads_external_args(self):
+        assert_equals(self.storage.get_details(self.request_id, 2)[2],
+                      self.big)
+        ref = storage.BLOB_REF + storage.blob_hash(self.big).encode()
+        assert_equals(self.storage.get_details(self.request_id, 2, True)[2],
+                      ref)
+        tasks = self.storage.get_chunk_details(self.request_id, 1, 2, True)[2]
+        assert_equals(tasks, [(1, b"small"), (2, ref)])
+
+    def test_stores_big_results_externally(self):
+        self.storage.store_result(self.request_id, 1, b"9876543210")
+        self.storage.store_batch(self.request_id, [(2, b"a" * 20)], [])
+        assert os.path.exists(self.storage.blob_path(
+            storage.blob_hash(b"a" * 20)))
+        assert_equals(self.storage.get_results(self.request_id),
+                      [(b"small", b"9876543210"), (self.big, b"a" * 20)])
+        assert_equals([r[3] for r in
+                       self.storage.get_new_results(self.request_id)],
+                      [b"9876543210", b"a" * 20])
+
+    def test_no_blob_path_for_unknown_hashes(self):
+        assert self.storage.blob_path(storage.blob_hash(b"nope")) is None
+        assert self.storage.blob_path("../../etc/passwd") is None
+
+    def test_memory_databases_store_inline(self):
+        s = storage.Storage(dbfile=":memory:")
+        s.initdb()
+        request_id = s.new_request(b"f", b"ns", [self.big])
+        assert_equals(s.get_details(request_id, 1, True)[2], self.big)
+
+class TestLRUCache:
+    def test_gets_and_puts(self):
+        cache = storage.LRUCache(100)
+        cache.put("a", b"abc", 3)
+        assert "a" in cache
+        assert_equals(cache.get("a"), b"abc")
+        assert_equals(cache.get("b"), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = storage.LRUCache(100)
+        cache.put("a", 1, 40)
+        cache.put("b", 2, 40)
+        cache.get("a")
+        cache.put("c", 3, 40)
+        assert_equals(sorted(cache.items), ["a", "c"])
+        assert_equals(cache.size, 80)
+
+    def test_ignores_oversized_values(self):
+        cache = storage.LRUCache(100)
+        cache.put("a", 1, 101)
+        assert_equals(len(cache), 0)
+        assert_equals(cache.size, 0)